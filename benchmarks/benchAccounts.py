@@ -0,0 +1,84 @@
+"""Benchmark of running many accounts with `Supervisor`
+
+Each worker process installs the fake terminal, opens `--positions` positions, closes
+them through `Tonight.close_position` and sends the night back to the supervisor.
+Reports wall time from first start to last result, with staggered starts and a cap
+on concurrent workers.
+
+    python benchmarks/benchAccounts.py --accounts 6 --max-terminals 3
+"""
+import argparse
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from configobj import ConfigObj
+from nightguard import Tonight, PAK_DIR
+from nightguard.orchestrator import Supervisor
+
+N_POSITIONS = 20
+
+
+def fake_night(config_path, report_fn_prefix, nights, hour_shift, send):
+    """Worker target, one night on the fake terminal"""
+    api = fakeMt5.make_api()
+    fakeMt5.configure(latency=0.01)
+    tonight = Tonight(api, PAK_DIR / 'Config.ini')
+    tonight.tonight_start_ts = 0
+    for i in range(N_POSITIONS):
+        fakeMt5.add_position('EURUSD', magic=i % 3, profit=1.0)
+    t0 = time.perf_counter()
+    tonight.close_position('EURUSD', [Tonight.MAGIC_ALL])
+    close_sec = time.perf_counter() - t0
+    now = api.broker_time_local
+    positions = api.get_history_positions(now - timedelta(hours=1), now + timedelta(minutes=1))
+    send({
+        'event': 'night',
+        'night_date': str(tonight.tonight_date),
+        'positions': positions,
+        'metrics': {'positions': len(positions), 'close_sec': close_sec},
+    })
+
+
+def bench(n_accounts, max_terminals, stagger_sec):
+    tmp = Path(tempfile.mkdtemp())
+    configs = []
+    for i in range(n_accounts):
+        conf = ConfigObj((PAK_DIR / 'Config.ini').as_posix())
+        conf['Auth']['login'] = str(1000 + i)
+        conf.filename = (tmp / f'Config{i}.ini').as_posix()
+        conf.write()
+        configs.append(conf.filename)
+
+    supervisor = Supervisor(
+        configs, max_terminals=max_terminals, stagger_sec=stagger_sec, nights=1, backend='fakeMt5',
+        worker=fake_night, report_path=tmp / 'Accounts_PositionReport.csv', metrics_path=tmp / 'Accounts_Metrics.jsonl',
+    )
+    t0 = time.perf_counter()
+    nights = supervisor.run()
+    wall = time.perf_counter() - t0
+    assert len(nights) == n_accounts
+    n_rows = sum(1 for _ in open(tmp / 'Accounts_PositionReport.csv')) - 1
+    return {
+        'accounts': n_accounts,
+        'max_terminals': max_terminals,
+        'stagger_sec': stagger_sec,
+        'wall_sec': round(wall, 2),
+        'report_rows': n_rows,
+        'report_dir': tmp.as_posix(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=6)
+    parser.add_argument('--max-terminals', type=int, default=3)
+    parser.add_argument('--stagger', type=float, default=0.2)
+    args = parser.parse_args()
+    print(bench(args.accounts, args.max_terminals, args.stagger))
@@ -0,0 +1,119 @@
+"""Benchmark of the StopT backtest over a year of positions
+
+Generates `--nights` nights of positions on `--symbols` symbols with M1 bars of
+each night, evaluates every StopT of a 1 minute grid between 00:00 and 06:00,
+in this process, in a process pool, and as `run` chooses by `POOL_MIN_CELLS`,
+and checks a sample against a plain loop.
+
+    python benchmarks/benchBacktest.py --symbols 22 --nights 260 --per-night 20
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import numpy as np
+import pandas as pd
+
+from nightguard.barStream import RATE_DTYPE
+from nightguard.stopBacktest import StopBacktest, night_day
+
+DAY_SEC = 24 * 3600
+VALUE = 100_000  # profit per price unit and lot
+
+
+def make_history(n_symbols, n_nights, per_night, seed=0):
+    rng = np.random.default_rng(seed)
+    first_day = int(np.datetime64('2021-01-04', 'D').astype(np.int64))
+    days = np.array([d for d in range(first_day, first_day + n_nights * 7 // 5 + 7) if (d + 3) % 7 < 5][:n_nights])
+    bars, frames = {}, []
+    for s in range(n_symbols):
+        symbol = f'SYM{s:02d}'
+        # Bars from 22:00 of the day before till 09:00 of each night
+        times = (days[:, None] * DAY_SEC + np.arange(-2 * 3600, 9 * 3600, 60)[None, :]).ravel()
+        walk = 1.1 + np.cumsum(rng.normal(0, 0.0002, len(times)))
+        rates = np.zeros(len(times), dtype=RATE_DTYPE)
+        rates['time'], rates['open'] = times, walk
+        rates['close'] = walk + rng.normal(0, 0.0001, len(times))
+        bars[symbol] = rates
+
+        n = n_nights * per_night
+        night = np.repeat(days, per_night)
+        en_ts = night * DAY_SEC - 3600 + rng.integers(0, 150, n) * 60
+        ex_ts = night * DAY_SEC + rng.integers(30, 480, n) * 60
+        idx = np.searchsorted(times, [en_ts, ex_ts])
+        en_price, ex_price = walk[idx[0]], walk[idx[1]]
+        volume = np.where(rng.random(n) < 0.5, 0.1, -0.1)
+        frames.append(pd.DataFrame({
+            'En_Time': pd.to_datetime(en_ts, unit='s'), 'En_Price': en_price, 'Volume': volume,
+            'symbol': symbol, 'magic': 0,
+            'Ex_Time': pd.to_datetime(ex_ts, unit='s'), 'Ex_Price': ex_price,
+            'profit': (ex_price - en_price) * volume * VALUE,
+        }))
+    positions = pd.concat(frames, ignore_index=True)
+    positions.index.name = 'position_id'
+    return positions, bars
+
+
+def loop_pnl(positions, bars, symbol, stop_sec):
+    """Plain loop reference of the pnl of `symbol` closing at `stop_sec` after midnight"""
+    rates = bars[symbol]
+    total = 0.0
+    for pos in positions[positions.symbol == symbol].itertuples():
+        en, ex = pos.En_Time.value // 10**9, pos.Ex_Time.value // 10**9
+        stop = int(night_day([en])[0]) * DAY_SEC + stop_sec
+        if en < stop < ex:
+            i = np.searchsorted(rates['time'], stop)
+            total += (rates['open'][i] - pos.En_Price) * pos.Volume * VALUE
+        else:
+            total += pos.profit
+    return total
+
+
+def bench(n_symbols, n_nights, per_night, workers):
+    positions, bars = make_history(n_symbols, n_nights, per_night)
+    bt = StopBacktest(positions, bars)
+
+    t0 = time.perf_counter()
+    serial = bt.run(max_workers=1)
+    t_serial = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    surface = bt.run(max_workers=workers)
+    t_auto = time.perf_counter() - t0
+    suggest = bt.suggest()
+
+    pooled = StopBacktest(positions, bars)
+    pooled.POOL_MIN_CELLS = 0
+    t0 = time.perf_counter()
+    pool_surface = pooled.run(max_workers=workers)
+    t_pool = time.perf_counter() - t0
+
+    assert np.allclose(serial.values, surface.values) and np.allclose(serial.values, pool_surface.values)
+    for stop_sec in (0, 3600, 2 * 3600 + 17 * 60):
+        ref = loop_pnl(positions, bars, 'SYM00', stop_sec)
+        assert np.isclose(surface['SYM00'].iloc[stop_sec // 60], ref), (stop_sec, ref)
+
+    return {
+        'positions': len(positions),
+        'symbols': n_symbols,
+        'stop_times': len(bt.grid_sec),
+        'cells': len(positions) * len(bt.grid_sec),
+        'serial_sec': round(t_serial, 2),
+        'pool_sec': round(t_pool, 2),
+        'auto_sec': round(t_auto, 2),
+        'workers': workers,
+        'suggested_SYM00': suggest.loc['SYM00', 'StopT'],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--symbols', type=int, default=22)
+    parser.add_argument('--nights', type=int, default=260)
+    parser.add_argument('--per-night', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    print(bench(args.symbols, args.nights, args.per_night, args.workers))
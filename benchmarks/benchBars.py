@@ -0,0 +1,68 @@
+"""Benchmark of M1 bar lookback queries
+
+Compares building a dataframe from `copy_rates_from_pos` on every query (as the old
+`get_bar` did) with views of the `BarStream` ring buffer, and counts bars requested
+from the terminal when updating the cache of many symbols.
+
+    python benchmarks/benchBars.py --queries 2000 --lb 60
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+import pandas as pd
+
+
+def bench(n_queries, lb, n_symbols):
+    api = fakeMt5.make_api()
+
+    t0 = time.perf_counter()
+    for _ in range(n_queries):
+        rates_frame = pd.DataFrame(fakeMt5.copy_rates_from_pos('EURUSD', fakeMt5.TIMEFRAME_M1, 0, lb + 1))
+        rates_frame.index = pd.to_datetime(rates_frame['time'], unit='s')
+    t_old = time.perf_counter() - t0
+
+    stream = api.bar_stream
+    stream.update('EURUSD')
+    t0 = time.perf_counter()
+    for _ in range(n_queries):
+        stream.update('EURUSD')
+        bars = stream.bars('EURUSD', lb)
+    t_view = time.perf_counter() - t0
+    assert bars.base is not None and len(bars) == lb
+
+    symbols = [f'SYM{i:02d}' for i in range(n_symbols)]
+    fakeMt5.reset()
+    t0 = time.perf_counter()
+    for sym in symbols:
+        stream.update(sym)
+    t_fill = time.perf_counter() - t0
+    fill_calls = fakeMt5.calls['copy_rates_from_pos']
+    t0 = time.perf_counter()
+    for sym in symbols:
+        stream.update(sym)
+    t_refresh = time.perf_counter() - t0
+
+    return {
+        'dataframe_per_query_us': round(t_old / n_queries * 1e6, 2),
+        'ring_view_per_query_us': round(t_view / n_queries * 1e6, 2),
+        'symbols': n_symbols,
+        'cold_fill_ms': round(t_fill * 1000, 2),
+        'cold_fill_terminal_calls': fill_calls,
+        'refresh_same_minute_ms': round(t_refresh * 1000, 3),
+        'refresh_same_minute_terminal_calls': fakeMt5.calls['copy_rates_from_pos'] - fill_calls,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--lb', type=int, default=60)
+    parser.add_argument('--symbols', type=int, default=22)
+    args = parser.parse_args()
+    print(bench(args.queries, args.lb, args.symbols))
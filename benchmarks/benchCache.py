@@ -0,0 +1,110 @@
+"""Benchmark of the on-disk history cache of deals and M1 bars
+
+Fills a `HistoryCache` with `--days` days of deals and `--years` years of M1 bars
+of a symbol from the fake terminal, then reopens it as a new process would and
+reads it: deals rebuilt into positions by `DealBook`, against asking the terminal,
+and a month of bars as views of the files. Last, one more night is synced, which
+requests only that night, and a year before the cache is backfilled.
+
+    python benchmarks/benchCache.py --days 120 --per-day 400 --years 2
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+import numpy as np
+from nightguard.dealBook import DealBook
+from nightguard.historyCache import HistoryCache
+
+
+def bench(days, per_day, years):
+    fakeMt5.reset()
+    start = datetime(2021, 1, 1)
+    end = start + timedelta(days=days)
+    fakeMt5.add_history(start, days - 1, per_day)
+    bars_from = end - timedelta(days=365 * years)
+    now = [end + timedelta(days=1)]
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        cache = HistoryCache(tmp, fakeMt5.history_deals_get, fakeMt5.copy_rates_range, now=lambda: now[0])
+        t0 = time.perf_counter()
+        n_deals = cache.sync_deals(start, end)
+        n_bars = cache.sync_bars('EURUSD', bars_from, end)
+        t_fill = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        book = DealBook(fakeMt5.history_deals_get)
+        book.sync(start, end)
+        t_terminal = time.perf_counter() - t0
+
+        # A new process, reading what is cached
+        fakeMt5.calls.clear()
+        cache = HistoryCache(tmp, fakeMt5.history_deals_get, fakeMt5.copy_rates_range, now=lambda: now[0])
+        t0 = time.perf_counter()
+        cached_book = DealBook(cache.history_deals_get)
+        cached_book.sync(start, end)
+        t_cached = time.perf_counter() - t0
+        assert cached_book.closed.sort_index().equals(book.closed.sort_index())
+
+        month_from = end - timedelta(days=30)
+        t0 = time.perf_counter()
+        bars = cache.rates('EURUSD', month_from, end)
+        t_month = time.perf_counter() - t0
+        assert not bars['close'].flags.owndata and not bars['close'].flags.writeable
+        t0 = time.perf_counter()
+        mean_close = float(cache.bars('EURUSD', bars_from, end, ['close'])['close'].mean())
+        t_scan = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        expected = float(fakeMt5.copy_rates_range('EURUSD', 1, bars_from, end)['close'].mean())
+        t_scan_terminal = time.perf_counter() - t0
+        assert np.isclose(mean_close, expected)
+        reads_requests = fakeMt5.calls['history_deals_get'] + fakeMt5.calls['copy_rates_range'] - 1
+
+        # One more night
+        fakeMt5.add_history(end, 1, per_day)
+        now[0] = end + timedelta(days=2)
+        fakeMt5.calls.clear()
+        t0 = time.perf_counter()
+        n_night = cache.sync_deals(start, now[0])
+        t_night = time.perf_counter() - t0
+        assert fakeMt5.calls['history_deals_get'] == 1
+
+        t0 = time.perf_counter()
+        n_backfill = cache.sync_bars('EURUSD', bars_from - timedelta(days=365), end)
+        t_backfill = time.perf_counter() - t0
+        assert len(cache.bar_table('EURUSD')) == n_bars + n_backfill
+
+        return {
+            'deals': n_deals,
+            'bars': n_bars,
+            'cache_mb': round(sum(p.stat().st_size for p in tmp.rglob('*.bin')) / 1e6, 1),
+            'fill_ms': round(t_fill * 1000, 1),
+            'positions_terminal_ms': round(t_terminal * 1000, 1),
+            'positions_cached_ms': round(t_cached * 1000, 1),
+            'read_requests': reads_requests,
+            'month_bars_ms': round(t_month * 1000, 3),
+            'scan_close_cached_ms': round(t_scan * 1000, 2),
+            'scan_close_terminal_ms': round(t_scan_terminal * 1000, 1),
+            'night_deals': n_night,
+            'night_sync_ms': round(t_night * 1000, 1),
+            'backfill_year_ms': round(t_backfill * 1000, 1),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=120)
+    parser.add_argument('--per-day', type=int, default=400)
+    parser.add_argument('--years', type=int, default=2)
+    args = parser.parse_args()
+    print(bench(args.days, args.per_day, args.years))
@@ -0,0 +1,122 @@
+"""Benchmark of starting while the market is closed, with the session calendar
+
+Learns the sessions of `--symbols` symbols from 4 weeks of M1 bars of the fake
+terminal, trading Monday 00:00 to Friday 23:55 with a holiday, then times
+`is_open`, `next_open` and `next_close`. Last, `MT5Api` starts on a Saturday with
+the last tick of Friday, which took 10 seconds of checks and a sleep till Monday
+before, with the offset saved by a previous run, and on a first run while the market is open.
+
+    python benchmarks/benchCalendar.py --symbols 22 --queries 10000
+"""
+import argparse
+import calendar as _calendar
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+import numpy as np
+from configobj import ConfigObj
+from nightguard import MT5Api, PAK_DIR
+from nightguard.sessionCalendar import SessionCalendar, WEEK_MIN
+
+# Sunday of the week before the bench, broker time
+NOW = datetime(2021, 10, 17, 12, 0)
+HOLIDAY = datetime(2021, 10, 6).date()
+
+
+def weekday_bars(symbol, date_from, date_to):
+    """Bars of the fake terminal within Monday 00:00 - Friday 23:55, none on `HOLIDAY`"""
+    rates = fakeMt5.copy_rates_range(symbol, fakeMt5.TIMEFRAME_M1, date_from, date_to)
+    minute_of_week = (rates['time'] // 60 + 3 * 1440) % WEEK_MIN
+    day = (rates['time'] // 86400).astype('datetime64[D]')
+    keep = (minute_of_week < 5 * 1440 - 5) & (day != np.datetime64(HOLIDAY))
+    return rates[keep]
+
+
+def _config(tmp, cache_dir):
+    conf = ConfigObj((PAK_DIR / 'Config.ini').as_posix())
+    conf['Auth']['login'] = '1234'
+    conf['NightSetting']['HISTORY_CACHE_DIR'] = cache_dir.as_posix()
+    conf['NightSetting']['HOLIDAYS'] = ['2021-12-24', '2021-12-31']
+    conf.filename = (tmp / 'Config.ini').as_posix()
+    conf.write()
+    return conf.filename
+
+
+def _start(config_path):
+    t0 = time.perf_counter()
+    api = MT5Api(config_path)
+    t_start = time.perf_counter() - t0
+    api.clock.stop()
+    api.terminal.stop()
+    return api, t_start
+
+
+def bench(n_symbols, n_queries):
+    fakeMt5.reset()
+    symbols = [f'SYM{i:02d}' for i in range(n_symbols)]
+    cal = SessionCalendar(bars_fn=weekday_bars, now=lambda: NOW)
+    t0 = time.perf_counter()
+    for symbol in symbols:
+        cal.sessions(symbol)
+    t_learn = time.perf_counter() - t0
+    assert cal.sessions(symbols[0]) == SessionCalendar.DEFAULT_SESSIONS, cal.describe(symbols[0])
+
+    rng = np.random.default_rng(0)
+    times = [NOW + timedelta(minutes=int(m)) for m in rng.integers(0, 4 * WEEK_MIN, n_queries)]
+    t0 = time.perf_counter()
+    n_open = sum(cal.is_open(symbols[i % n_symbols], t) for i, t in enumerate(times))
+    t_is_open = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i, t in enumerate(times):
+        cal.next_open(symbols[i % n_symbols], t)
+        cal.next_close(symbols[i % n_symbols], t)
+    t_next = time.perf_counter() - t0
+
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        # Last run saved the offset and sessions, started on Saturday with the last tick of Friday
+        config_path = _config(tmp, tmp / 'cache')
+        utc_now = datetime.utcnow()
+        saturday = datetime.combine(utc_now.date() + timedelta(days=(5 - utc_now.weekday()) % 7), datetime.min.time())
+        saved = SessionCalendar(tmp / 'cache' / '1234' / 'Sessions.json', bars_fn=weekday_bars,
+                                now=lambda: saturday + timedelta(hours=12))
+        saved.sessions('EURUSD')
+        saved.offset = saturday + timedelta(hours=12) - utc_now
+        friday_close = saturday - timedelta(seconds=301)
+        fakeMt5.configure(tick_time=_calendar.timegm(friday_close.timetuple()))
+        api, t_closed = _start(config_path)
+        closed = api.check_market_is_open()
+        opens = api.calendar.next_open('EURUSD', api.broker_time_local)
+        assert not closed and opens == saturday + timedelta(days=2)
+
+        # First run, while the market is open
+        fakeMt5.configure(tick_time=0)
+        api, t_open = _start(_config(tmp, tmp / 'cache_first'))
+        assert api.clock.n_samples == 1
+        return {
+            'symbols': n_symbols,
+            'learn_ms': round(t_learn * 1000, 1),
+            'open_share': round(n_open / n_queries, 3),
+            'is_open_us': round(t_is_open / n_queries * 1e6, 1),
+            'next_open_close_us': round(t_next / n_queries * 1e6, 1),
+            'start_closed_ms': round(t_closed * 1000, 1),
+            'start_open_ms': round(t_open * 1000, 1),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--symbols', type=int, default=22)
+    parser.add_argument('--queries', type=int, default=10_000)
+    args = parser.parse_args()
+    print(bench(args.symbols, args.queries))
@@ -0,0 +1,59 @@
+"""Benchmark of reading broker time
+
+Reads broker time in a tight loop for `--seconds`, as `_m1_timmer` did, with
+`MT5Api.broker_time` (a terminal call and `pd.to_datetime` each) and with
+`BrokerClock` sampling in the background. Reports reads and terminal calls per second.
+
+    python benchmarks/benchClock.py --seconds 2
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from nightguard.brokerClock import BrokerClock
+
+
+def read_loop(read, seconds):
+    n = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        read()
+        n += 1
+    return n
+
+
+def bench(seconds, interval):
+    api = fakeMt5.make_api()
+
+    fakeMt5.reset()
+    n_old = read_loop(lambda: api.broker_time, seconds)
+    old_calls = fakeMt5.calls['symbol_info_tick']
+
+    fakeMt5.reset()
+    api.clock = BrokerClock(api._tick_time_msc, interval=interval)
+    api.clock.sample()
+    api.clock.start()
+    n_new = read_loop(lambda: api.broker_time_local, seconds)
+    api.clock.stop()
+    new_calls = fakeMt5.calls['symbol_info_tick']
+
+    return {
+        'broker_time_reads_per_sec': round(n_old / seconds),
+        'broker_time_terminal_calls_per_sec': round(old_calls / seconds, 2),
+        'clock_reads_per_sec': round(n_new / seconds),
+        'clock_terminal_calls_per_sec': round(new_calls / seconds, 2),
+        'clock_error_bound_ms': round(api.clock.error_bound() * 1000, 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--interval', type=float, default=BrokerClock.INTERVAL)
+    args = parser.parse_args()
+    print(bench(args.seconds, args.interval))
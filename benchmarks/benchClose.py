@@ -0,0 +1,53 @@
+"""Benchmark of closing many positions of a symbol in `Tonight.close_position`
+
+Each `order_send` of the fake terminal sleeps `--latency` seconds, the positions
+are closed with different `CLOSE_WORKERS`, reporting time of the whole close task,
+with calls made by the close workers themselves (TERMINAL_THREAD = 0) or queued to
+the single terminal thread (TERMINAL_THREAD = 1), which sends orders one by one.
+
+    python benchmarks/benchClose.py --positions 40 --latency 0.05
+"""
+import argparse
+import calendar
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from nightguard import Tonight, PAK_DIR
+
+
+def bench_close(n_positions, latency, workers, terminal_thread=False):
+    fakeMt5.reset()
+    fakeMt5.configure(latency=latency)
+    tonight = Tonight(fakeMt5.make_api(terminal_thread=terminal_thread), PAK_DIR / 'Config.ini')
+    tonight.close_workers = workers
+    opened_sec = calendar.timegm(tonight.tonight_start_dt.timetuple()) + 60
+    for i in range(n_positions):
+        fakeMt5.add_position('EURUSD', magic=i % 3, time_sec=opened_sec)
+
+    t0 = time.perf_counter()
+    tonight.close_position('EURUSD', [Tonight.MAGIC_ALL])
+    task_sec = time.perf_counter() - t0
+    if terminal_thread:
+        tonight.mt5.terminal.stop()
+    assert not fakeMt5.positions_get()
+    return {
+        'workers': workers,
+        'terminal_thread': terminal_thread,
+        'positions': n_positions,
+        'close_task_ms': round(task_sec * 1000, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--positions', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+    for terminal_thread in (False, True):
+        for workers in (1, 4, 8, 16):
+            print(bench_close(args.positions, args.latency, workers, terminal_thread))
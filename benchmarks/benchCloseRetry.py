@@ -0,0 +1,80 @@
+"""Benchmark of closing positions through requotes and partial fills
+
+The fake terminal rejects `--fail-rate` of the orders with a requote and fills
+`--partial-rate` of them only partially. Positions are closed once with a single
+order each, as before retrying, then with `MT5Api.close_positions` retrying till
+flat, reporting time to flat and attempts. Another run fails half of the reads of
+the positions, which must not be taken for flat ones, and a last run rejects every
+order to check the close gives up at the deadline.
+
+    python benchmarks/benchCloseRetry.py --positions 40 --fail-rate 0.3 --partial-rate 0.3
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+
+def _setup(n_positions, latency, fail_rate, partial_rate):
+    fakeMt5.reset()
+    fakeMt5.configure(latency=latency, fail_rate=fail_rate, partial_rate=partial_rate, seed=1)
+    api = fakeMt5.make_api()
+    api.RETRY_BACKOFF_SEC = 0.005
+    api.RETRY_BACKOFF_MAX_SEC = 0.05
+    return api, [fakeMt5.add_position('EURUSD', volume=0.1 * (1 + i % 4), magic=i % 3) for i in range(n_positions)]
+
+
+def bench(n_positions, latency, fail_rate, partial_rate, workers=8, deadline_sec=2.0):
+    api, positions = _setup(n_positions, latency, fail_rate, partial_rate)
+    single = [api._send_close(pos, 'bench') for pos in positions]
+    left_single = len(fakeMt5.positions_get())
+
+    api, positions = _setup(n_positions, latency, fail_rate, partial_rate)
+    t0 = time.perf_counter()
+    results, time_to_flat = api.close_positions(positions, 'bench', max_workers=workers, deadline_sec=deadline_sec)
+    t_close = time.perf_counter() - t0
+    assert all(res.ok for res in results), [res for res in results if not res.ok]
+    assert not fakeMt5.positions_get()
+    flat = sorted(res.time_to_flat for res in results)
+
+    # A failed read of a position is retried, not taken for a closed position
+    api, positions = _setup(n_positions, latency, fail_rate, partial_rate)
+    fakeMt5.configure(read_fail_rate=0.5)
+    unread, _ = api.close_positions(positions, 'bench', max_workers=workers, deadline_sec=deadline_sec)
+    assert all(res.ok for res in unread) and not fakeMt5.positions_get()
+    failed_reads = fakeMt5.calls['positions_get_failed']
+
+    # Every order is requoted, the close must give up at the deadline
+    api, positions = _setup(4, latency, 1.0, 0.0)
+    t0 = time.perf_counter()
+    stuck, _ = api.close_positions(positions, 'bench', max_workers=workers, deadline_sec=0.2)
+    t_stuck = time.perf_counter() - t0
+    assert all(res.status == 'deadline' for res in stuck) and len(fakeMt5.positions_get()) == 4
+
+    return {
+        'positions': n_positions,
+        'single_order_left_open': left_single,
+        'single_order_retcodes': len({retcode for retcode, _ in single}),
+        'attempts': sum(res.attempts for res in results),
+        'max_attempts': max(res.attempts for res in results),
+        'time_to_flat_ms': round(time_to_flat * 1000, 1),
+        'p50_position_flat_ms': round(flat[len(flat) // 2] * 1000, 1),
+        'close_ms': round(t_close * 1000, 1),
+        'failed_reads': failed_reads,
+        'deadline_stop_ms': round(t_stuck * 1000, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--positions', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--fail-rate', type=float, default=0.3)
+    parser.add_argument('--partial-rate', type=float, default=0.3)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    print(bench(args.positions, args.latency, args.fail_rate, args.partial_rate, args.workers))
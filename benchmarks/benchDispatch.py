@@ -0,0 +1,88 @@
+"""Benchmark of close tasks of many symbols firing at the same StopT
+
+`--symbols` symbols of `--positions` positions each fire together, each
+`order_send` of the fake terminal sleeps `--latency` seconds. Reports the time
+till the last symbol is flat when the tasks run one by one, as the serial loop
+of `runner.run` did, and through a `SymbolDispatcher`, then checks tasks of the
+same symbol never overlap.
+
+    python benchmarks/benchDispatch.py --symbols 4 --positions 5 --latency 0.05
+"""
+import argparse
+import calendar
+import sys
+import time
+from pathlib import Path
+from threading import Lock
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from nightguard import Tonight, PAK_DIR
+from nightguard.dispatcher import SymbolDispatcher
+
+
+def _setup(n_symbols, n_positions, latency):
+    fakeMt5.reset()
+    fakeMt5.configure(latency=latency)
+    tonight = Tonight(fakeMt5.make_api(), PAK_DIR / 'Config.ini')
+    opened_sec = calendar.timegm(tonight.tonight_start_dt.timetuple()) + 60
+    symbols = [f'SYM{s:02d}' for s in range(n_symbols)]
+    for symbol in symbols:
+        for i in range(n_positions):
+            fakeMt5.add_position(symbol, magic=i % 3, time_sec=opened_sec)
+    return tonight, symbols
+
+
+def bench(n_symbols, n_positions, latency, workers=8):
+    tonight, symbols = _setup(n_symbols, n_positions, latency)
+    t0 = time.perf_counter()
+    for symbol in symbols:
+        tonight.close_position(symbol, [Tonight.MAGIC_ALL])
+    t_serial = time.perf_counter() - t0
+    assert not fakeMt5.positions_get()
+
+    tonight, symbols = _setup(n_symbols, n_positions, latency)
+    dispatcher = SymbolDispatcher(max_workers=workers)
+    t0 = time.perf_counter()
+    for symbol in symbols:
+        dispatcher.submit(symbol, tonight.close_position, symbol, [Tonight.MAGIC_ALL])
+    dispatcher.join()
+    t_dispatch = time.perf_counter() - t0
+    assert not fakeMt5.positions_get()
+
+    # Tasks of a symbol run in order and one at a time
+    spans, lock = [], Lock()
+    def task(symbol, i):
+        start = time.perf_counter()
+        time.sleep(0.002)
+        with lock:
+            spans.append((symbol, i, start, time.perf_counter()))
+    for i in range(5):
+        for symbol in symbols[:2]:
+            dispatcher.submit(symbol, task, symbol, i)
+    dispatcher.join()
+    dispatcher.shutdown()
+    for symbol in symbols[:2]:
+        runs = sorted((s for s in spans if s[0] == symbol), key=lambda s: s[2])
+        assert [s[1] for s in runs] == list(range(5))
+        assert all(a[3] <= b[2] for a, b in zip(runs, runs[1:]))
+
+    return {
+        'symbols': n_symbols,
+        'positions_per_symbol': n_positions,
+        'serial_ms': round(t_serial * 1000, 1),
+        'dispatch_ms': round(t_dispatch * 1000, 1),
+        'speedup': round(t_serial / t_dispatch, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--symbols', type=int, default=4)
+    parser.add_argument('--positions', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    print(bench(args.symbols, args.positions, args.latency, args.workers))
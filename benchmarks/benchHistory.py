@@ -0,0 +1,85 @@
+"""Benchmark of reconstructing closed positions from deals
+
+Synthetic history of `--days` days, a fifth of positions are closed in two parts.
+Compares the previous groupby/join reconstruction (which drops partial closes)
+against `DealBook`, cold and when syncing one more night incrementally.
+
+    python benchmarks/benchHistory.py --days 120 --per-day 400
+"""
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+import pandas as pd
+from nightguard.dealBook import DealBook
+
+
+def legacy_history_positions(position_deals):
+    """Reconstruction as done before `DealBook`"""
+    deals_df = pd.DataFrame(list(position_deals), columns=position_deals[0]._asdict().keys())
+    deals_df = deals_df[deals_df.type.isin([0, 1])]
+    deals_df['time'] = pd.to_datetime(deals_df.time, unit='s')
+    pid_size = deals_df.groupby('position_id').size()
+    closed_pids = pid_size[pid_size == 2].index
+    deals_df = deals_df[deals_df.position_id.isin(closed_pids)]
+    deal_in = deals_df[deals_df.entry == 0].copy()
+    deal_in['type'] *= -1
+    deal_in.loc[deal_in.type == 0, 'type'] = 1
+    deal_in['Volume'] = deal_in.volume * deal_in.type
+    deal_in = deal_in.rename(columns={'time': 'En_Time', 'price': 'En_Price', 'reason': 'en_reason', 'commission': 'en_comm'})
+    deal_in.index = deal_in.position_id
+    deal_in = deal_in[['En_Time', 'En_Price', 'Volume', 'symbol', 'en_comm', 'magic', 'comment', 'en_reason']]
+    deal_out = deals_df[deals_df.entry == 1].rename(columns={'time': 'Ex_Time', 'price': 'Ex_Price', 'reason': 'ex_reason', 'commission': 'ex_comm'})
+    deal_out.index = deal_out.position_id
+    deal_out = deal_out[['Ex_Time', 'Ex_Price', 'profit', 'ex_comm', 'swap', 'ex_reason']]
+    positions = deal_in.join(deal_out)
+    positions['commision'] = positions.en_comm + positions.ex_comm
+    return positions.drop(columns=['en_comm', 'ex_comm'])
+
+
+def bench(days, per_day):
+    fakeMt5.reset()
+    start = datetime(2021, 1, 1)
+    end = start + timedelta(days=days)
+    fakeMt5.add_history(start, days - 1, per_day)
+
+    deals = fakeMt5.history_deals_get(start, end)
+    t0 = time.perf_counter()
+    legacy = legacy_history_positions(deals)
+    t_legacy = time.perf_counter() - t0
+
+    book = DealBook(lambda date_from, date_to: deals)
+    t0 = time.perf_counter()
+    book.sync(start, end)
+    t_cold = time.perf_counter() - t0
+
+    # One more night, only its deals are reconstructed
+    book = DealBook(fakeMt5.history_deals_get)
+    book.sync(start, end)
+    fakeMt5.add_history(end - timedelta(days=1), 1, per_day)
+    t0 = time.perf_counter()
+    book.sync(start, end + timedelta(days=1))
+    t_incremental = time.perf_counter() - t0
+
+    return {
+        'deals': len(deals),
+        'positions': len(book.closed),
+        'legacy_positions': len(legacy),
+        'legacy_ms': round(t_legacy * 1000, 1),
+        'dealbook_cold_ms': round(t_cold * 1000, 1),
+        'dealbook_incremental_ms': round(t_incremental * 1000, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=120)
+    parser.add_argument('--per-day', type=int, default=400)
+    args = parser.parse_args()
+    print(bench(args.days, args.per_day))
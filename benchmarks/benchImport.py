@@ -0,0 +1,64 @@
+"""Benchmark of startup import time, exits 1 if over budget
+
+Runs `python -X importtime -c "import <module>"` in fresh interpreters for the
+modules needed before the first task fires, reports the best cumulative import
+time of `--repeat` runs, and fails if it exceeds `--budget-ms` or if a heavy
+module (MetaTrader5, pandas, numpy) was imported on the way.
+
+    python benchmarks/benchImport.py --budget-ms 30
+"""
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_DIR = Path(__file__).parent.parent
+
+MODULES = ['nightguard', 'nightguard.cli', 'nightguard.runner', 'nightguard.scheduler', 'nightguard.brokerClock']
+HEAVY = ['MetaTrader5', 'pandas', 'numpy']
+
+
+def import_time(module):
+    """Returns (cumulative µs of importing `module`, set of all imported top level packages)"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_DIR, capture_output=True, text=True, env=dict(os.environ, PYTHONDONTWRITEBYTECODE=''),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{proc.stderr}')
+    cumulative, packages = None, set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cum, name = [c.strip() for c in line[len('import time:'):].split('|')]
+        packages.add(name.split('.')[0])
+        if name == module:
+            cumulative = int(cum)
+    return cumulative, packages
+
+
+def bench(budget_ms, repeat):
+    results, failures = {}, []
+    for module in MODULES:
+        runs = [import_time(module) for _ in range(repeat)]
+        best_ms = min(cum for cum, _ in runs) / 1000
+        heavy = sorted(set(HEAVY) & runs[0][1])
+        results[module] = {'import_ms': round(best_ms, 2), 'heavy_imports': heavy}
+        if best_ms > budget_ms:
+            failures.append(f'{module} imports in {best_ms:.1f} ms > budget {budget_ms} ms')
+        if heavy:
+            failures.append(f'{module} imports {heavy}')
+    return results, failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=30.0)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    results, failures = bench(args.budget_ms, args.repeat)
+    print(results)
+    for failure in failures:
+        print(f'FAIL: {failure}', file=sys.stderr)
+    sys.exit(1 if failures else 0)
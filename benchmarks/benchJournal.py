@@ -0,0 +1,128 @@
+"""Benchmark of the night journal and of resuming a night after a restart
+
+Appends `--events` events from 8 threads with batched fsyncs and with an fsync
+per event, then replays tonight from a journal holding `--nights` nights of
+`--per-night` positions, as if it was never truncated. Last, a night is cut
+after closing half of the symbols and one interrupted mid-close, and a new
+`Tonight` recovers it on the fake terminal.
+
+    python benchmarks/benchJournal.py --events 2000 --nights 7 --per-night 2000
+"""
+import argparse
+import calendar
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from nightguard import Tonight, PAK_DIR
+from nightguard.journal import Journal
+from nightguard.scheduler import TaskScheduler
+
+
+def _append_rate(path, n_events, sync_sec):
+    journal = Journal(path, sync_sec=sync_sec).start()
+    night = datetime(2021, 10, 5).date()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: journal.append(night, 'record', pid=i, fields={'ST-close_status': 'flat'}), range(n_events)))
+    journal.close()
+    return n_events / (time.perf_counter() - t0)
+
+
+def _week(path, n_nights, per_night):
+    journal = Journal(path, sync_sec=60)
+    first = datetime(2021, 10, 1)
+    for d in range(n_nights):
+        night = (first + timedelta(days=d)).date()
+        for s in range(22):
+            journal.append(night, 'arm', rule=f'SYM{s:02d}', due=first)
+            journal.append(night, 'fire', rule=f'SYM{s:02d}')
+        pids = list(range(d * per_night, (d + 1) * per_night))
+        journal.append(night, 'managed', pids=pids)
+        for pid in pids:
+            journal.append(night, 'record', pid=pid, fields={'ST-profit': 1.5, 'ST-Ex_Time': first, 'ST-Ex_Price': 1.1})
+        for s in range(22):
+            journal.append(night, 'done', rule=f'SYM{s:02d}', stop_time='01:00:00')
+    journal.sync()
+    return journal, night
+
+
+def _resume(path, n_positions):
+    fakeMt5.reset()
+    api = fakeMt5.make_api(test=True)
+    journal = Journal(path).start()
+    tonight = Tonight(api, PAK_DIR / 'Config.ini')
+    tonight.recover(journal)
+    opened_sec = calendar.timegm(tonight.tonight_start_dt.timetuple()) + 60
+    keys = sorted(tonight.rules)
+    for symbol in {rule.symbol for rule in tonight.rules.values()}:
+        for i in range(n_positions):
+            fakeMt5.add_position(symbol, magic=i % 3, time_sec=opened_sec)
+    tonight.arrange_tonight_tasks(TaskScheduler())
+    closed = keys[:len(keys) // 2]
+    for key in closed:
+        rule = tonight.rules[key]
+        tonight.close_position(rule.symbol, list(rule.magics))
+    # Killed while closing the next rule
+    interrupted = keys[len(closed)]
+    tonight._log('fire', rule=interrupted)
+    journal.close()
+
+    journal = Journal(path).start()
+    t0 = time.perf_counter()
+    restarted = Tonight(api, PAK_DIR / 'Config.ini')
+    state = restarted.recover(journal)
+    scheduler = TaskScheduler()
+    armed = restarted.arrange_tonight_tasks(scheduler)
+    t_recover = time.perf_counter() - t0
+    journal.close()
+
+    assert restarted._mangaged_pids == tonight._mangaged_pids
+    assert restarted._record == tonight._record
+    assert set(armed) == set(keys) - set(closed)
+    assert armed[interrupted].due <= api.broker_time_local
+    return state, t_recover
+
+
+def bench(n_events, n_nights, per_night, n_positions=10):
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        batched = _append_rate(tmp / 'batched.jsonl', n_events, Journal.SYNC_SEC)
+        every = _append_rate(tmp / 'every.jsonl', min(n_events, 500), 0)
+
+        journal, night = _week(tmp / 'week.jsonl', n_nights, per_night)
+        t0 = time.perf_counter()
+        state = journal.replay(night)
+        t_week = time.perf_counter() - t0
+        assert len(state.records) == per_night and len(state.done) == 22
+        size_mb = journal.path.stat().st_size / 1e6
+        journal.close()
+
+        resumed, t_recover = _resume(tmp / 'night.jsonl', n_positions)
+        return {
+            'batched_events_per_sec': round(batched),
+            'fsync_each_events_per_sec': round(every),
+            'week_journal_mb': round(size_mb, 1),
+            'week_replay_ms': round(t_week * 1000, 1),
+            'night_events': resumed.events,
+            'restart_recover_ms': round(t_recover * 1000, 1),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--nights', type=int, default=7)
+    parser.add_argument('--per-night', type=int, default=2000)
+    args = parser.parse_args()
+    print(bench(args.events, args.nights, args.per_night))
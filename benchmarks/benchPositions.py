@@ -0,0 +1,64 @@
+"""Benchmark of resolving the positions of closing tasks
+
+Compares the old per task scan of all open positions (with `pd.to_datetime` per row)
+against `PositionStore` lookups, for one task per symbol.
+
+    python benchmarks/benchPositions.py --symbols 22 --positions 2000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+import pandas as pd
+from nightguard.positionStore import PositionStore
+
+
+def scan(positions, symbol, magics, start_dt):
+    """Matching as done before `PositionStore`"""
+    return [
+        pos for pos in positions
+        if pos.symbol == symbol and pos.magic in magics and pd.to_datetime(pos.time, unit='s') >= start_dt
+    ]
+
+
+def bench(n_symbols, n_positions):
+    fakeMt5.reset()
+    symbols = [f'SYM{i:02d}' for i in range(n_symbols)]
+    start_ts = 1633129200
+    for i in range(n_positions):
+        fakeMt5.add_position(symbols[i % n_symbols], magic=i % 7, time_sec=start_ts - 3600 + i * 5)
+    magics = [1, 2, 3]
+    start_dt = pd.to_datetime(start_ts, unit='s')
+
+    t0 = time.perf_counter()
+    expected = [scan(fakeMt5.positions_get(), sym, magics, start_dt) for sym in symbols]
+    t_scan = time.perf_counter() - t0
+
+    store = PositionStore(fakeMt5.positions_get)
+    t0 = time.perf_counter()
+    matched = []
+    for sym in symbols:
+        store.refresh(sym)
+        matched.append(store.match(sym, magics, since=start_ts))
+    t_store = time.perf_counter() - t0
+
+    assert [sorted(m) for m in matched] == [sorted(e) for e in expected]
+    return {
+        'symbols': n_symbols,
+        'positions': n_positions,
+        'scan_ms': round(t_scan * 1000, 2),
+        'store_ms': round(t_store * 1000, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--symbols', type=int, default=22)
+    parser.add_argument('--positions', type=int, default=2000)
+    args = parser.parse_args()
+    print(bench(args.symbols, args.positions))
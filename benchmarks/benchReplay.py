@@ -0,0 +1,113 @@
+"""Benchmark of recording a night of terminal calls and replaying it on a virtual clock
+
+A whole night of `runner.run` on the fake terminal is recorded by a `TerminalRecorder`,
+with `--positions` positions on the symbols of symbol_stopT.csv closed at their StopT.
+It runs on a `ReplayClock` skipping idle time, the fake terminal answering in broker
+time of that clock. The log is then replayed through `runner.run` without the fake
+terminal, as `main.py --replay` does, once plainly and once with all threads profiled,
+and the positions closed by each run are compared.
+
+    python benchmarks/benchReplay.py --positions 200
+"""
+import argparse
+import calendar
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+import pandas as pd
+from configobj import ConfigObj
+from nightguard import PAK_DIR
+from nightguard.runner import run
+from nightguard.terminalReplay import ReplayClock, TerminalRecorder, TerminalReplay, replay
+
+# Monday evening in broker time, 3 hours ahead of UTC
+START = datetime(2021, 10, 18, 22, 50)
+OFFSET = timedelta(hours=3)
+
+
+class VirtualNight:
+    """The fake terminal, recorded by `recorder`, on a virtual clock, in place of a `TerminalReplay`"""
+
+    def __init__(self, path):
+        self.clock = ReplayClock(START, OFFSET)
+        fakeMt5.configure(clock=lambda: self.clock.now_ns() / 1e9)
+        self.recorder = TerminalRecorder(fakeMt5, path, clock_ns=self.clock.wall_ns).start()
+        self.recorder.broker_ns = self.clock.now_ns
+        self.module = self.recorder
+
+
+def _config(tmp):
+    conf = ConfigObj((PAK_DIR / 'Config.ini').as_posix())
+    conf['Auth']['login'] = '1234'
+    conf['Auth']['TEST'] = '0'
+    conf['NightSetting']['RULES_RELOAD_SEC'] = '0'
+    conf['NightSetting']['CLOSE_WINDOW_SEC'] = '0'
+    conf.filename = (tmp / 'Config.ini').as_posix()
+    conf.write()
+    return conf.filename
+
+
+def _run(config_path, prefix, night):
+    nights = []
+    t0 = time.perf_counter()
+    run(config_path, prefix, nights=1, on_night=lambda tonight, positions: nights.append((tonight, positions)),
+        replay=night)
+    elapsed = time.perf_counter() - t0
+    tonight, positions = nights[0]
+    tonight.mt5.scheduler.stop()
+    tonight.mt5.terminal.stop()
+    return elapsed, len(positions)
+
+
+def bench(n_positions):
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        config_path = _config(tmp)
+        fakeMt5.reset()
+        symbols = list(pd.read_csv(PAK_DIR / 'symbol_stopT.csv')['Symbol'])
+        fakeMt5.add_positions(n_positions, symbols=symbols,
+                              time_sec=calendar.timegm((START + timedelta(minutes=40)).timetuple()))
+
+        log_path = tmp / 'Records' / '1234.ngrec'
+        night = VirtualNight(log_path)
+        t_record, n_recorded = _run(config_path, (tmp / 'Record').as_posix(), night)
+        night.recorder.close()
+        night_hours = (night.clock.now() - START).total_seconds() / 3600
+        assert n_recorded == n_positions, n_recorded
+
+        fakeMt5.reset()
+        terminal_replay = TerminalReplay(log_path)
+        t_replay, n_replayed = _run(config_path, (tmp / 'Replay').as_posix(), terminal_replay)
+        assert n_replayed == n_positions, n_replayed
+        assert sum(fakeMt5.calls.values()) == 0, fakeMt5.calls
+
+        t_profiled, stats = replay(log_path, config_path, (tmp / 'Profiled').as_posix(), profile_path=tmp / 'replay.prof')
+        return {
+            'positions': n_positions,
+            'night_hours': round(night_hours, 1),
+            'calls': night.recorder.n_calls,
+            'log_kb': round(log_path.stat().st_size / 1024, 1),
+            'record_sec': round(t_record, 2),
+            'replay_sec': round(t_replay, 2),
+            'profiled_replay_sec': round(t_profiled, 2),
+            'speedup': round(night_hours * 3600 / t_replay),
+            'missed_calls': sum(terminal_replay.missed.values()),
+            'profiled_functions': len(stats.stats),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--positions', type=int, default=200)
+    args = parser.parse_args()
+    print(bench(args.positions))
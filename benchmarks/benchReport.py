@@ -0,0 +1,120 @@
+"""Benchmark of writing the nightly report in `Tonight.close`
+
+Fills a report with `--nights` previous nights of `--per-night` positions, then
+times `Tonight.close` of one more night on the fake terminal, against rewriting
+the whole CSV report as done before `ReportStore`. Also times joining the TEST
+records of `--records` positions with `merge_records` against the former loop of
+`.loc` assignments, and the rollups of a night against aggregating all nights.
+
+    python benchmarks/benchReport.py --nights 250 --per-night 200
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+import pandas as pd
+from nightguard import Tonight, PAK_DIR
+from nightguard.reportStore import merge_records
+
+
+def loop_merge(positions, records):
+    """As `Tonight.close` did before `merge_records`"""
+    positions = positions.copy()
+    for pid, info in records.items():
+        for k, v in info.items():
+            positions.loc[pid, k] = v
+    return positions
+
+
+def bench(n_nights, per_night, n_records=2000, test=True):
+    fakeMt5.reset()
+    tmp = Path(tempfile.mkdtemp())
+    # An absolute prefix puts the reports into the temporary directory
+    prefix = (tmp / 'bench').as_posix()
+    try:
+        tonight = Tonight(fakeMt5.make_api(test=test), PAK_DIR / 'Config.ini')
+        first = tonight.tonight_start_dt.replace(hour=0) - timedelta(days=n_nights)
+        fakeMt5.add_history(first, n_nights, per_night)
+        history = tonight.mt5.get_history_positions(first, tonight.tonight_start_dt)
+        if test:
+            history = history.assign(**{'ST-profit': history.profit, 'ST-Ex_Time': history.Ex_Time, 'ST-Ex_Price': history.Ex_Price})
+
+        store = Tonight.report_store(prefix)
+        # One append for the previous nights, their date does not matter here
+        store.append(first.date(), history)
+        store.close()
+        history.to_csv(Tonight.report_path(prefix).as_posix(), index=True)
+
+        # Positions of tonight after midnight, `Tonight.close` reports from 00:00
+        pids = fakeMt5.add_history(tonight.tonight_end_dt.replace(hour=0) - timedelta(days=1), 1, per_night, hour=0)
+        tonight._mangaged_pids = pids
+        if test:
+            now = datetime.utcnow()
+            tonight._record = {pid: {'ST-profit': 1.0, 'ST-Ex_Time': now, 'ST-Ex_Price': 1.1} for pid in pids}
+
+        t0 = time.perf_counter()
+        positions = tonight.close(prefix)
+        t_close = time.perf_counter() - t0
+        assert len(positions) == per_night
+
+        # Records of a large night, a tenth of them of positions not in the history
+        night = history.iloc[:n_records].drop(columns=[c for c in history if c.startswith('ST-')])
+        now = datetime.utcnow()
+        records = {pid: {'ST-profit': 1.0, 'ST-Ex_Time': now, 'ST-Ex_Price': 1.1} for pid in night.index[n_records // 10:]}
+        records.update({-pid: {'ST-close_status': 'deadline'} for pid in range(1, n_records // 10)})
+        t0 = time.perf_counter()
+        merged = merge_records(night, records)
+        t_merge = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        looped = loop_merge(night, records)
+        t_loop = time.perf_counter() - t0
+        pd.testing.assert_frame_equal(merged, looped[merged.columns], check_dtype=False)
+
+        store = Tonight.report_store(prefix)
+        t0 = time.perf_counter()
+        store._update_rollups(str(tonight.tonight_date))
+        t_rollup = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        full = store.query()
+        full_rollup = full.groupby(['night_date', 'symbol', 'magic']).profit.sum()
+        t_full = time.perf_counter() - t0
+        rollup = store.rollup()
+        assert len(rollup) == len(full_rollup)
+        assert abs(rollup.profit.sum() - full_rollup.sum()) < 1e-6 * max(1.0, abs(full_rollup.sum()))
+        store.close()
+
+        report_fn = Tonight.report_path(prefix)
+        t0 = time.perf_counter()
+        report = pd.read_csv(report_fn.as_posix(), index_col=0)
+        pd.concat([report, positions]).to_csv(tmp / 'rewrite.csv', index=True)
+        t_rewrite = time.perf_counter() - t0
+
+        return {
+            'report_rows': len(history) + len(positions),
+            'night_positions': len(positions),
+            'close_ms': round(t_close * 1000, 1),
+            'csv_rewrite_ms': round(t_rewrite * 1000, 1),
+            'merge_records_ms': round(t_merge * 1000, 1),
+            'merge_loop_ms': round(t_loop * 1000, 1),
+            'rollup_night_ms': round(t_rollup * 1000, 2),
+            'rollup_full_ms': round(t_full * 1000, 1),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nights', type=int, default=250)
+    parser.add_argument('--per-night', type=int, default=200)
+    parser.add_argument('--records', type=int, default=2000)
+    args = parser.parse_args()
+    print(bench(args.nights, args.per_night, args.records))
@@ -0,0 +1,183 @@
+"""Benchmark of finding the rule of each position among thousands of rules
+
+Writes `--rules` rules mixing exact symbols, magic numbers and ranges, prefixes
+like `S0001*`, suffixes like `*JPY` and a few other patterns, then finds the rule
+governing each of `--positions` positions with `RuleIndex`, against scanning every
+rule for each position, checked to agree on a sample. `--changed` rules are then
+edited and the index updated with `RuleIndex.updated`, against compiling it again.
+
+    python benchmarks/benchRuleIndex.py --rules 10000 --positions 10000 --changed 30
+"""
+import argparse
+import csv
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import time as dtime
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from nightguard.stopRules import MAGIC_ALL, RuleIndex, StopRule, diff_rules, is_pattern, load_rules
+
+Position = namedtuple('Position', ['symbol', 'magic'])
+
+
+def make_rows(n_rules, n_symbols, rng):
+    rows = []
+    for i in range(n_symbols):
+        rows.append([f'S{i:04d}', '01:00:00', ''])
+    for i in range(n_symbols // 2):
+        rows.append([f'S{i:04d}*', '01:30:00', ''])
+    rows += [[f'*{c}JPY', '02:00:00', '100-199'] for c in 'ABCDEFGHIJ']
+    rows += [['S00??', '02:30:00', '7'], ['S[12]*', '02:45:00', '8;9']]
+    while len(rows) < n_rules:
+        symbol = f'S{rng.randrange(n_symbols):04d}'
+        k = len(rows)
+        if k % 3:
+            magics = f'{k};{k + 1}'
+        else:
+            first = 1000 + k * 10
+            magics = f'{first}-{first + 9}'
+        rows.append([symbol if k % 5 else symbol + '*', f'0{1 + k % 5}:{k % 60:02d}:00', magics])
+    return rows[:n_rules]
+
+
+def make_positions(n_positions, n_symbols, n_rules, rng):
+    positions = []
+    for _ in range(n_positions):
+        symbol = f'S{rng.randrange(n_symbols):04d}'
+        kind = rng.random()
+        if kind < 0.3:
+            symbol += '.a'
+        elif kind < 0.4:
+            symbol += f'{"ABCDEFGHIJ"[rng.randrange(10)]}JPY'
+        magic = rng.choice([rng.randrange(1000), rng.randrange(n_rules), 1000 + rng.randrange(n_rules * 10), 7, 8])
+        positions.append(Position(symbol, magic))
+    return positions
+
+
+def scan(rules, position):
+    """Reference: rank every rule matching `position` as `RuleIndex` does"""
+    best, best_rank = None, None
+    globs = {}
+    for order, rule in enumerate(rules):
+        pattern = rule.symbol
+        if not is_pattern(pattern):
+            if pattern != position.symbol:
+                continue
+            rank = (0, 0)
+        elif pattern.endswith('*') and not is_pattern(pattern[:-1]):
+            if not position.symbol.startswith(pattern[:-1]):
+                continue
+            rank = (1, -len(pattern))
+        elif pattern.startswith('*') and not is_pattern(pattern[1:]):
+            if not position.symbol.endswith(pattern[1:]):
+                continue
+            rank = (2, -len(pattern))
+        else:
+            if not fnmatchcase(position.symbol, pattern):
+                continue
+            rank = (3, globs.setdefault(pattern, order))
+        for m in rule.magics:
+            if m == MAGIC_ALL:
+                magic_rank = (2, 0, -order)
+            elif isinstance(m, tuple):
+                if not m[0] <= position.magic <= m[1]:
+                    continue
+                magic_rank = (1, -m[0], -order)
+            elif m == position.magic:
+                magic_rank = (0, 0, -order)
+            else:
+                continue
+            if best_rank is None or rank + magic_rank < best_rank:
+                best, best_rank = rule, rank + magic_rank
+    return best
+
+
+def edit_rules(rules, n_changed, n_symbols, rng):
+    """Copy of `rules` with a third of `n_changed` rules removed, a third moved and a third added"""
+    rules = dict(rules)
+    k = n_changed // 3
+    keys = rng.sample([key for key, rule in rules.items() if not RuleIndex._is_glob(rule.symbol)], 2 * k)
+    for key in keys[:k]:
+        del rules[key]
+    for key in keys[k:]:
+        rules[key] = rules[key]._replace(stop_time=dtime(5, 30))
+    for i in range(k):
+        rule = StopRule(f'S{rng.randrange(n_symbols):04d}', dtime(4, 0), (50_000 + i,))
+        rules[rule.key] = rule
+    return rules
+
+
+def bench(n_rules, n_positions, n_symbols=2000, n_check=200, n_changed=30, seed=0):
+    rng = random.Random(seed)
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        path = tmp / 'symbol_stopT.csv'
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Symbol', 'StopT', 'Magics'])
+            writer.writerows(make_rows(n_rules, n_symbols, rng))
+        positions = make_positions(n_positions, n_symbols, n_rules, rng)
+
+        t0 = time.perf_counter()
+        rules = load_rules(path)
+        t_load = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        index = RuleIndex(rules.values())
+        t_compile = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        governing = [index.lookup(pos.symbol, pos.magic) for pos in positions]
+        t_cold = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for pos in positions:
+            index.lookup(pos.symbol, pos.magic)
+        t_warm = time.perf_counter() - t0
+
+        rule_list = list(rules.values())
+        sample = positions[:n_check]
+        t0 = time.perf_counter()
+        expected = [scan(rule_list, pos) for pos in sample]
+        t_scan = (time.perf_counter() - t0) / len(sample)
+        assert governing[:n_check] == expected
+
+        edited = edit_rules(rules, n_changed, n_symbols, rng)
+        added, removed, changed = diff_rules(rules, edited)
+        symbols = {rules[key].symbol for key in removed + changed} | {edited[key].symbol for key in added + changed}
+        t0 = time.perf_counter()
+        updated = index.updated(edited.values(), symbols)
+        t_update = time.perf_counter() - t0
+        compiled = RuleIndex(edited.values())
+        assert all(updated.lookup(*pos) == compiled.lookup(*pos) for pos in positions)
+        assert sorted(updated.conflicts) == sorted(compiled.conflicts)
+
+        return {
+            'rules': len(rules),
+            'positions': n_positions,
+            'governed': sum(rule is not None for rule in governing),
+            'conflicts': len(index.conflicts),
+            'load_ms': round(t_load * 1000, 1),
+            'compile_ms': round(t_compile * 1000, 1),
+            'changed': len(added) + len(removed) + len(changed),
+            'update_ms': round(t_update * 1000, 2),
+            'lookup_cold_ms': round(t_cold * 1000, 1),
+            'lookup_warm_ms': round(t_warm * 1000, 2),
+            'scan_est_ms': round(t_scan * n_positions * 1000),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rules', type=int, default=10_000)
+    parser.add_argument('--positions', type=int, default=10_000)
+    parser.add_argument('--changed', type=int, default=30)
+    args = parser.parse_args()
+    print(bench(args.rules, args.positions, n_changed=args.changed))
@@ -0,0 +1,90 @@
+"""Benchmark of reloading symbol_stopT.csv mid-night
+
+Arms the tasks of `--rows` rules, then edits `--changed` rows (a third moved,
+a third removed, a third added) and compares `Tonight.reload_rules`, which only
+touches the tasks of changed rows, with cancelling and arming every task again.
+
+    python benchmarks/benchRules.py --rows 2000 --changed 30
+"""
+import argparse
+import csv
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from nightguard import Tonight, PAK_DIR
+from nightguard.scheduler import TaskScheduler, VirtualClock
+from nightguard.stopRules import RuleWatcher, load_rules
+
+
+def write_rules(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Symbol', 'StopT', 'Magics'])
+        writer.writerows(rows)
+
+
+def make_rows(n_rows):
+    return [[f'SYM{i:05d}', f'{1 + i % 4:02d}:{i % 60:02d}:00', '' if i % 3 else f'{i};{i + 1}'] for i in range(n_rows)]
+
+
+def bench(n_rows, n_changed):
+    tmp = Path(tempfile.mkdtemp())
+    rules_path = tmp / 'symbol_stopT.csv'
+    rows = make_rows(n_rows)
+    write_rules(rules_path, rows)
+
+    tonight = Tonight(fakeMt5.make_api(), PAK_DIR / 'Config.ini')
+    tonight.rules_path = rules_path
+    tonight.rules = {}
+    scheduler = TaskScheduler(VirtualClock(datetime(2021, 10, 1, 23, 0)))
+    tonight.arrange_tonight_tasks(scheduler)
+    tonight.reload_rules()
+    assert len(scheduler.pending) == n_rows
+
+    watcher = RuleWatcher(rules_path, lambda: None)
+    k = n_changed // 3
+    moved = {r[0] for r in rows[:k]}
+    for r in rows[:k]:
+        r[1] = '05:30:00'
+    rows = rows[k:2 * k] + [[f'NEW{i:05d}', '04:00:00', ''] for i in range(k)] + rows[:k] + rows[3 * k:]
+    time.sleep(0.01)
+    write_rules(rules_path, rows)
+    assert watcher.changed() and not watcher.changed()
+
+    t0 = time.perf_counter()
+    added, removed, changed = tonight.reload_rules()
+    t_reload = time.perf_counter() - t0
+
+    pending = scheduler.pending
+    assert len(pending) == n_rows, 'Pending tasks do not match the rules'
+    assert all(h.due.time() == datetime.strptime('05:30', '%H:%M').time() for h in pending if h.task['symbol'] in moved)
+
+    # As a restart would, parse every row and arm every task again
+    t0 = time.perf_counter()
+    for sym in list(tonight.rules):
+        tonight._disarm(sym)
+    tonight.rules = load_rules(rules_path)
+    tonight.arrange_tonight_tasks(scheduler)
+    t_rearm = time.perf_counter() - t0
+
+    return {
+        'rows': n_rows,
+        'added': len(added), 'removed': len(removed), 'changed': len(changed),
+        'reload_ms': round(t_reload * 1000, 2),
+        'rearm_all_ms': round(t_rearm * 1000, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--changed', type=int, default=30)
+    args = parser.parse_args()
+    print(bench(args.rows, args.changed))
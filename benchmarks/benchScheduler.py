@@ -0,0 +1,100 @@
+"""Benchmark of `TaskScheduler`
+
+Virtual clock: throughput of scheduling, rescheduling, cancelling and firing
+thousands of tasks spreaded over a night, without real waiting.
+Real clock: lateness of tasks due within a couple of seconds, many sharing the same time.
+
+    python benchmarks/benchScheduler.py --tasks 5000
+"""
+import argparse
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from nightguard.scheduler import TaskScheduler, SystemClock, VirtualClock
+
+
+def bench_virtual(n_tasks):
+    start = datetime(2021, 10, 1, 23, 0)
+    clock = VirtualClock(start)
+    scheduler = TaskScheduler(clock, overdue_skip_sec=float('inf'))
+
+    t0 = time.perf_counter()
+    handles = [
+        scheduler.schedule(start + timedelta(seconds=(i * 7919) % (6 * 3600)), {'task': 'CLOSE_POSITION', 'i': i})
+        for i in range(n_tasks)
+    ]
+    for h in handles[::10]:
+        scheduler.reschedule(h, h.due + timedelta(minutes=1))
+    for h in handles[5::10]:
+        scheduler.cancel(h)
+    t_arm = time.perf_counter() - t0
+
+    expected = n_tasks - len(handles[5::10])
+    t0 = time.perf_counter()
+    scheduler.start()
+    fired = [scheduler.q_out.get() for _ in range(expected)]
+    t_fire = time.perf_counter() - t0
+    scheduler.stop()
+
+    assert all(a[0] <= b[0] for a, b in zip(fired, fired[1:])), 'Tasks fired out of order'
+    return {
+        'tasks': n_tasks,
+        'arm_sec': round(t_arm, 4),
+        'fire_sec': round(t_fire, 4),
+        'tasks_per_sec': round(expected / t_fire),
+    }
+
+
+def bench_real(n_tasks, spread_sec=2.0, n_times=4):
+    scheduler = TaskScheduler(SystemClock()).start()
+    start = datetime.utcnow() + timedelta(seconds=0.5)
+    for i in range(n_tasks):
+        # Many tasks share a few StopT, like symbols in symbol_stopT.csv
+        due = start + timedelta(seconds=spread_sec * (i % n_times) / n_times)
+        scheduler.schedule(due, {'task': 'CLOSE_POSITION', 'i': i})
+    for _ in range(n_tasks):
+        scheduler.q_out.get()
+    scheduler.stop()
+
+    lateness = sorted(scheduler.lateness)
+    return {
+        'tasks': n_tasks,
+        'lateness_ms_p50': round(statistics.median(lateness) * 1000, 3),
+        'lateness_ms_p99': round(lateness[int(len(lateness) * 0.99) - 1] * 1000, 3),
+        'lateness_ms_max': round(lateness[-1] * 1000, 3),
+    }
+
+
+def bench_timer(n_tasks, spread_sec=2.0, n_times=4):
+    """Lateness of tasks put into `MT5Api.get_timmer_Qs`, firing on the broker clock"""
+    pq_in, q_out = fakeMt5.make_api().get_timmer_Qs()
+    start = pq_in.clock.now() + timedelta(seconds=0.5)
+    for i in range(n_tasks):
+        pq_in.put((start + timedelta(seconds=spread_sec * (i % n_times) / n_times), {'task': 'CLOSE_POSITION', 'i': i}))
+    for _ in range(n_tasks):
+        q_out.get()
+    pq_in.stop()
+
+    lateness = sorted(pq_in.lateness)
+    return {
+        'tasks': n_tasks,
+        'lateness_ms_p50': round(statistics.median(lateness) * 1000, 3),
+        'lateness_ms_p99': round(lateness[int(len(lateness) * 0.99) - 1] * 1000, 3),
+        'lateness_ms_max': round(lateness[-1] * 1000, 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=5000)
+    args = parser.parse_args()
+    print('virtual clock:', bench_virtual(args.tasks))
+    print('real clock:   ', bench_real(args.tasks))
+    print('broker clock: ', bench_timer(args.tasks))
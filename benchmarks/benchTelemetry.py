@@ -0,0 +1,88 @@
+"""Benchmark of the overhead of telemetry
+
+Times a histogram observation, a counter increment and a `timed` terminal call
+against the bare call, renders and scrapes the Prometheus endpoint, and writes
+JSONL snapshots through a rotation.
+
+    python benchmarks/benchTelemetry.py --calls 200000
+"""
+import argparse
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from nightguard.telemetry import Registry, MetricsServer, JsonlExporter, timed
+
+
+def per_call_ns(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1e9
+
+
+def bench(n_calls, n_labels):
+    registry = Registry()
+    hist = registry.histogram('bench_seconds', 'bench', ['api'])
+    counter = registry.counter('bench_total', 'bench', ['retcode'])
+    child, counter_child = hist.labels('a'), counter.labels('10009')
+
+    empty_ns = per_call_ns(lambda: None, n_calls)
+    observe_ns = per_call_ns(lambda: child.observe(0.003), n_calls) - empty_ns
+    labels_observe_ns = per_call_ns(lambda: hist.labels('a').observe(0.003), n_calls) - empty_ns
+    inc_ns = per_call_ns(lambda: counter_child.inc(), n_calls) - empty_ns
+
+    tick = fakeMt5.symbol_info_tick
+    timed_tick = timed('symbol_info_tick', tick, hist)
+    raw_ns = per_call_ns(lambda: tick('EURUSD'), n_calls // 4)
+    wrapped_ns = per_call_ns(lambda: timed_tick('EURUSD'), n_calls // 4)
+
+    for i in range(n_labels):
+        hist.labels(f'SYM{i:02d}').observe(0.01 * i)
+        counter.labels(str(10000 + i)).inc()
+    t0 = time.perf_counter()
+    text = registry.exposition()
+    render_ms = (time.perf_counter() - t0) * 1000
+
+    server = MetricsServer(0, registry=registry).start()
+    t0 = time.perf_counter()
+    body = urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics').read().decode()
+    scrape_ms = (time.perf_counter() - t0) * 1000
+    server.stop()
+    assert 'bench_seconds_bucket{api="a",le="0.005"}' in body and body.count('\n') == text.count('\n')
+
+    tmp = Path(tempfile.mkdtemp()) / 'metrics.jsonl'
+    exporter = JsonlExporter(tmp, max_bytes=20_000, backups=2, registry=registry)
+    t0 = time.perf_counter()
+    for _ in range(20):
+        exporter.write()
+    write_ms = (time.perf_counter() - t0) / 20 * 1000
+    rotated = sorted(p.name for p in tmp.parent.iterdir())
+
+    return {
+        'observe_ns': round(observe_ns),
+        'labels_observe_ns': round(labels_observe_ns),
+        'counter_inc_ns': round(inc_ns),
+        'terminal_call_ns': round(raw_ns),
+        'timed_terminal_call_ns': round(wrapped_ns),
+        'timed_overhead_ns': round(wrapped_ns - raw_ns),
+        'label_sets': n_labels,
+        'render_ms': round(render_ms, 3),
+        'scrape_ms': round(scrape_ms, 2),
+        'jsonl_write_ms': round(write_ms, 3),
+        'jsonl_files': rotated,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200_000)
+    parser.add_argument('--labels', type=int, default=30)
+    args = parser.parse_args()
+    print(bench(args.calls, args.labels))
@@ -0,0 +1,107 @@
+"""Benchmark of calling the terminal from one thread, with orders first and reads coalesced
+
+`--readers` threads poll the ticks of `--symbols` symbols, as the tick capture and
+the clock do, while closes send `--orders` orders one after another. Calls go to
+the fake terminal directly from each thread, then through a `Terminal` queuing
+orders like reads, then through a `Terminal` running orders first. The fake
+terminal sleeps `--tick-latency` per tick and `--latency` per order, and counts
+calls overlapping another call. Last, a coroutine gathers ticks of all symbols
+`--rounds` times through `Terminal.aio`.
+
+    python benchmarks/benchTerminal.py --symbols 22 --readers 8 --orders 20
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+from threading import Event, Thread
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+import numpy as np
+from nightguard.terminal import Terminal
+
+
+def _run(terminal, symbols, n_readers, n_orders):
+    positions = fakeMt5.add_positions(n_orders, symbols=symbols)
+    stop = Event()
+
+    def read():
+        while not stop.is_set():
+            for symbol in symbols:
+                terminal.symbol_info_tick(symbol)
+
+    readers = [Thread(target=read) for _ in range(n_readers)]
+    for reader in readers:
+        reader.start()
+    time.sleep(0.05)
+    fakeMt5.calls.clear()
+    latencies = []
+    t0 = time.perf_counter()
+    for pos in positions:
+        t = time.perf_counter()
+        terminal.order_send({'action': fakeMt5.TRADE_ACTION_DEAL, 'symbol': pos.symbol, 'volume': pos.volume,
+                             'type': 1 - pos.type, 'position': pos.identifier})
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    for reader in readers:
+        reader.join()
+    return {
+        'order_p50_ms': round(float(np.median(latencies)) * 1000, 2),
+        'order_max_ms': round(max(latencies) * 1000, 2),
+        'ticks_per_sec': round(fakeMt5.calls['symbol_info_tick'] / elapsed),
+        'overlapping_calls': fakeMt5.calls['overlap'],
+    }
+
+
+async def _gather(terminal, symbols, rounds):
+    return await asyncio.gather(*(terminal.aio.symbol_info_tick(s) for _ in range(rounds) for s in symbols))
+
+
+def bench(n_symbols, n_readers, n_orders, latency=0.005, tick_latency=0.0005, rounds=50):
+    symbols = [f'SYM{i:02d}' for i in range(n_symbols)]
+    results = {}
+    for name in ('direct', 'fifo', 'priority'):
+        fakeMt5.reset()
+        fakeMt5.configure(latency=latency, tick_latency=tick_latency)
+        if name == 'direct':
+            terminal = fakeMt5
+        else:
+            terminal = Terminal(fakeMt5)
+            if name == 'fifo':
+                terminal.PRIORITY = {}
+            terminal.start()
+        results[name] = _run(terminal, symbols, n_readers, n_orders)
+        if name != 'direct':
+            terminal.stop()
+    assert results['priority']['overlapping_calls'] == 0
+
+    fakeMt5.reset()
+    fakeMt5.configure(tick_latency=tick_latency)
+    terminal = Terminal(fakeMt5).start()
+    t0 = time.perf_counter()
+    ticks = asyncio.run(_gather(terminal, symbols, rounds))
+    t_gather = time.perf_counter() - t0
+    terminal.stop()
+    results['aio'] = {
+        'ticks': len(ticks),
+        'terminal_calls': fakeMt5.calls['symbol_info_tick'],
+        'gather_ms': round(t_gather * 1000, 1),
+    }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--symbols', type=int, default=22)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--orders', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--tick-latency', type=float, default=0.0005)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+    print(bench(args.symbols, args.readers, args.orders, args.latency, args.tick_latency, args.rounds))
@@ -0,0 +1,80 @@
+"""Benchmark of tick capture and the close window decision
+
+Captures ticks of `--symbols` symbols for `--seconds`, each `symbol_info_tick` of the
+fake terminal taking `--tick-latency` seconds, and reports the achieved pass rate,
+overruns and the cost of a `CloseWindow.ready` decision on the buffered arrays.
+Last, a TEST mode close task of `--positions` positions fires through the close
+window, recording the exit price of each position from the last captured tick.
+
+    python benchmarks/benchTicks.py --symbols 22 --seconds 3
+"""
+import argparse
+import calendar
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import fakeMt5
+fakeMt5.install()
+
+from nightguard import Tonight, PAK_DIR
+from nightguard.tickCapture import TickCapture, CloseWindow
+
+
+def bench(n_symbols, seconds, interval, tick_latency, n_positions=20):
+    api = fakeMt5.make_api()
+    fakeMt5.reset()
+    fakeMt5.configure(tick_latency=tick_latency)
+    capture = TickCapture(fakeMt5.symbol_info_tick, api.clock, interval=interval)
+    now = api.clock.now()
+    symbols = [f'SYM{i:02d}' for i in range(n_symbols)]
+    for sym in symbols:
+        capture.watch(sym, now, now + timedelta(hours=1))
+
+    capture.start()
+    time.sleep(seconds)
+    capture.stop()
+
+    window = CloseWindow(capture, window_sec=30, baseline_sec=seconds)
+    window_open_msc = api.clock.now_ns() // 1_000_000
+    t0 = time.perf_counter()
+    for sym in symbols:
+        ok, reason = window.ready(sym, window_open_msc)
+    t_ready = (time.perf_counter() - t0) / n_symbols
+
+    # TEST mode records the price of the last captured tick instead of closing
+    tonight = Tonight(fakeMt5.make_api(test=True), PAK_DIR / 'Config.ini')
+    tonight.close_window = window
+    opened_sec = calendar.timegm(tonight.tonight_start_dt.timetuple()) + 60
+    for i in range(n_positions):
+        fakeMt5.add_position(symbols[0], type=i % 2, time_sec=opened_sec)
+    t0 = time.perf_counter()
+    tonight.close_position(symbols[0], [Tonight.MAGIC_ALL], deadline=api.clock.now())
+    t_test_close = time.perf_counter() - t0
+    last = capture.last_tick(symbols[0])
+    prices = [rec['ST-Ex_Price'] for rec in tonight._record.values()]
+    assert len(prices) == n_positions and set(prices) == {last.bid, last.ask}, prices
+
+    return {
+        'symbols': n_symbols,
+        'target_passes_per_sec': round(1 / interval, 1),
+        'passes_per_sec': round(capture.passes / seconds, 1),
+        'overruns': capture.overruns,
+        'max_pass_ms': round(capture.max_pass_sec * 1000, 2),
+        'ticks_per_symbol': len(capture.ticks(symbols[0])),
+        'ready_decision_us': round(t_ready * 1e6, 1),
+        'test_close_ms': round(t_test_close * 1000, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--symbols', type=int, default=22)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--interval', type=float, default=TickCapture.INTERVAL)
+    parser.add_argument('--tick-latency', type=float, default=0.0005)
+    parser.add_argument('--positions', type=int, default=20)
+    args = parser.parse_args()
+    print(bench(args.symbols, args.seconds, args.interval, args.tick_latency, args.positions))
@@ -0,0 +1,366 @@
+"""In-process stand-in of the `MetaTrader5` module, so NightGuard can be imported
+and benchmarked on a box without a terminal.
+
+Call `install()` before importing `nightguard`:
+
+    import fakeMt5
+    fakeMt5.install()
+    from nightguard import MT5Api
+"""
+import calendar
+import sys
+import time
+from collections import Counter, namedtuple
+from datetime import timedelta
+from threading import Lock
+
+import numpy as np
+
+TIMEFRAME_M1 = 1
+TRADE_ACTION_DEAL = 1
+ORDER_TYPE_BUY = 0
+ORDER_TYPE_SELL = 1
+ORDER_TIME_GTC = 0
+ORDER_FILLING_IOC = 1
+TRADE_RETCODE_REQUOTE = 10004
+TRADE_RETCODE_DONE = 10009
+TRADE_RETCODE_DONE_PARTIAL = 10010
+TRADE_RETCODE_TIMEOUT = 10012
+TRADE_RETCODE_MARKET_CLOSED = 10018
+TRADE_RETCODE_PRICE_CHANGED = 10020
+TRADE_RETCODE_PRICE_OFF = 10021
+TRADE_RETCODE_CLIENT_DISABLES_AT = 10027
+TRADE_RETCODE_POSITION_CLOSED = 10036
+
+TradePosition = namedtuple('TradePosition', [
+    'ticket', 'time', 'type', 'magic', 'identifier', 'volume', 'price_open',
+    'price_current', 'swap', 'profit', 'symbol', 'comment',
+])
+TradeDeal = namedtuple('TradeDeal', [
+    'ticket', 'order', 'time', 'time_msc', 'type', 'entry', 'magic', 'position_id', 'reason',
+    'volume', 'price', 'commission', 'swap', 'profit', 'fee', 'symbol', 'comment', 'external_id',
+])
+OrderSendResult = namedtuple('OrderSendResult', ['retcode', 'deal', 'order', 'volume', 'price', 'comment', 'request'])
+Tick = namedtuple('Tick', ['time', 'bid', 'ask', 'last', 'volume', 'time_msc', 'flags', 'volume_real'])
+RATE_DTYPE = np.dtype([
+    ('time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+    ('tick_volume', '<u8'), ('spread', '<i4'), ('real_volume', '<u8'),
+])
+AccountInfo = namedtuple('AccountInfo', ['login', 'server', 'balance', 'equity', 'currency'])
+
+DEFAULTS = {
+    'bid': 1.1000,
+    'ask': 1.1001,
+    'latency': 0.0,
+    'tick_latency': 0.0,
+    'tick_noise': 0.0,
+    'fail_rate': 0.0,
+    'fail_retcode': TRADE_RETCODE_REQUOTE,
+    'partial_rate': 0.0,
+    'partial_fill': 0.5,
+    'read_fail_rate': 0.0,
+    'tick_time': None,
+    'clock': time.time,
+}
+_state = dict(
+    DEFAULTS,
+    last_error=(1, 'Success'),
+    positions={},
+    deals=[],
+    next_ticket=1,
+    fail_next=[],
+    active=0,
+)
+_lock = Lock()
+_rng = np.random.default_rng(0)
+# Number of calls of each terminal function
+calls = Counter()
+
+
+def configure(latency=None, bid=None, ask=None, tick_latency=None, tick_noise=None, fail_rate=None, fail_retcode=None,
+              partial_rate=None, partial_fill=None, read_fail_rate=None, tick_time=None, clock=None, seed=None):
+    """Set the behaviour of the terminal, arguments left None are unchanged
+
+    Args:
+        latency (float): seconds slept in each `order_send`
+        bid, ask (float): quote of every symbol
+        tick_latency (float): seconds slept in each `symbol_info_tick`
+        tick_noise (float): std of a random walk added to the quote at each `symbol_info_tick`
+        fail_rate (float): fraction of `order_send` rejected with `fail_retcode`
+        fail_retcode (int): retcode of rejected orders, e.g. `TRADE_RETCODE_REQUOTE`
+        partial_rate (float): fraction of closes only partially filled, as IOC orders can be
+        partial_fill (float): fraction of the volume filled by a partial fill
+        read_fail_rate (float): fraction of `positions_get(ticket=...)` failing with None, as when disconnected
+        tick_time (float): seconds of the time of every tick, e.g. of the last tick before a weekend,
+            0 for the current time
+        clock (callable): seconds of the terminal time, e.g. of a virtual clock, `time.time` by default
+        seed (int): seed of the random failures and tick noise
+    """
+    values = dict(latency=latency, bid=bid, ask=ask, tick_latency=tick_latency, tick_noise=tick_noise,
+                  fail_rate=fail_rate, fail_retcode=fail_retcode, partial_rate=partial_rate, partial_fill=partial_fill,
+                  read_fail_rate=read_fail_rate, tick_time=tick_time, clock=clock)
+    _state.update({k: v for k, v in values.items() if v is not None})
+    if tick_time == 0:
+        _state['tick_time'] = None
+    if seed is not None:
+        global _rng
+        _rng = np.random.default_rng(seed)
+
+
+def fail_next(*retcodes):
+    """Reject the next `order_send` calls with `retcodes`, one each, before `fail_rate` applies"""
+    with _lock:
+        _state['fail_next'].extend(retcodes)
+
+
+def reset():
+    """Remove all positions and deals, reset call counts and `configure` to defaults"""
+    with _lock:
+        _state.update(DEFAULTS)
+        _state['positions'] = {}
+        _state['deals'] = []
+        _state['next_ticket'] = 1
+        _state['fail_next'] = []
+        calls.clear()
+
+
+def add_position(symbol, volume=0.01, type=ORDER_TYPE_BUY, magic=0, time_sec=None, profit=0.0, comment=''):
+    """Open a synthetic position, returns it"""
+    with _lock:
+        ticket = _state['next_ticket']
+        _state['next_ticket'] += 1
+        price = _state['ask'] if type == ORDER_TYPE_BUY else _state['bid']
+        pos = TradePosition(
+            ticket, int(_state['clock']() if time_sec is None else time_sec), type, magic, ticket,
+            volume, price, price, 0.0, profit, symbol, comment,
+        )
+        _state['positions'][ticket] = pos
+        _add_deal(pos.time, type, 0, magic, ticket, volume, price, 0.0, symbol, comment)
+        return pos
+
+
+def add_positions(n, symbols=('EURUSD',), magics=(0,), time_sec=None):
+    """Open `n` synthetic positions cycling over `symbols` and `magics`, buys and sells alternating"""
+    return [
+        add_position(symbols[i % len(symbols)], type=i % 2, magic=magics[i % len(magics)], time_sec=time_sec)
+        for i in range(n)
+    ]
+
+
+def add_history(start, days, per_day, symbols=('EURUSD', 'USDJPY', 'AUDJPY', 'EURJPY', 'GBPUSD'), hour=23):
+    """Add deals of `per_day` positions opened within an hour from `hour` of `days` days after `start`
+
+    A fifth of the positions is closed in two parts. Tickets increase with time, like MT5.
+
+    Returns:
+        list: position ids
+    """
+    pid = 10 ** 6 + calendar.timegm(start.timetuple()) // 86400 * per_day
+    deals, pids = [], []
+    for day in range(days):
+        day_sec = calendar.timegm((start + timedelta(days=day)).timetuple())
+        for i in range(per_day):
+            pid += 1
+            pids.append(pid)
+            t_in = day_sec + hour * 3600 + (i * 7) % 3600
+            side, magic, symbol = i % 2, i % 5, symbols[i % len(symbols)]
+            deals.append((t_in, side, 0, pid, 0.02, 1.1, 0.0, magic, symbol))
+            if i % 5 == 0:
+                deals.append((t_in + 600, 1 - side, 1, pid, 0.01, 1.101, 0.5, magic, symbol))
+            deals.append((t_in + 3600, 1 - side, 1, pid, 0.01 if i % 5 == 0 else 0.02, 1.102, 1.0, magic, symbol))
+    with _lock:
+        for t, side, entry, pid, volume, price, profit, magic, symbol in sorted(deals):
+            _add_deal(t, side, entry, magic, pid, volume, price, profit, symbol, '')
+    return pids
+
+
+def add_deal(time_sec, type, entry, position_id, volume, price, profit=0.0, magic=0, symbol='EURUSD', comment=''):
+    """Append a synthetic deal to the history, returns it"""
+    with _lock:
+        return _add_deal(time_sec, type, entry, magic, position_id, volume, price, profit, symbol, comment)
+
+
+def _add_deal(time_sec, type, entry, magic, position_id, volume, price, profit, symbol, comment):
+    ticket = _state['next_ticket']
+    _state['next_ticket'] += 1
+    deal = TradeDeal(
+        ticket, ticket, int(time_sec), int(time_sec * 1000), type, entry, magic, position_id, 3,
+        volume, price, 0.0, 0.0, profit, 0.0, symbol, comment, '',
+    )
+    _state['deals'].append(deal)
+    return deal
+
+
+def install():
+    """Register this module as `MetaTrader5` in `sys.modules`, returns the module"""
+    module = sys.modules[__name__]
+    sys.modules['MetaTrader5'] = module
+    return module
+
+
+def make_api(test=False, terminal_thread=False):
+    """`MT5Api` on this fake terminal, without login and market checks
+
+    With `terminal_thread` its calls run on a started `Terminal`, as with TERMINAL_THREAD = 1,
+    stop it with `api.terminal.stop()`.
+    """
+    from configobj import ConfigObj
+    from nightguard import MT5Api
+    from nightguard.positionStore import PositionStore
+    from nightguard.dealBook import DealBook
+    from nightguard.brokerClock import BrokerClock
+    from nightguard.barStream import BarStream
+    from nightguard.tickCapture import TickCapture
+    from nightguard.sessionCalendar import SessionCalendar
+    from nightguard.terminal import Terminal
+
+    api = MT5Api.__new__(MT5Api)
+    api.conf = ConfigObj({'TEST': '1' if test else '0'})
+    api.terminal = Terminal(sys.modules[__name__]).start() if terminal_thread else sys.modules[__name__]
+    api._positions_get = api.terminal.positions_get
+    api._symbol_info_tick = api.terminal.symbol_info_tick
+    api.position_store = PositionStore(api._positions_get)
+    api.history_cache = None
+    api.calendar = SessionCalendar()
+    api.deal_book = DealBook(api.terminal.history_deals_get)
+    api.clock = BrokerClock()
+    api.clock.set_offset(timedelta(0))
+    api.bar_stream = BarStream(api.terminal.copy_rates_from_pos, TIMEFRAME_M1, api.clock)
+    api.tick_capture = TickCapture(api._symbol_info_tick, api.clock)
+    return api
+
+
+def initialize(*args, **kwargs):
+    return True
+
+
+def login(login, password=None, server=None, **kwargs):
+    _state['account'] = AccountInfo(login, server, 10000.0, 10000.0, 'USD')
+    return True
+
+
+def shutdown():
+    return True
+
+
+def last_error():
+    return _state['last_error']
+
+
+def account_info():
+    return _state.get('account')
+
+
+def _enter():
+    """Count calls overlapping another call, which the real module is not designed for"""
+    with _lock:
+        _state['active'] += 1
+        if _state['active'] > 1:
+            calls['overlap'] += 1
+
+
+def _exit():
+    with _lock:
+        _state['active'] -= 1
+
+
+def symbol_info_tick(symbol):
+    calls['symbol_info_tick'] += 1
+    _enter()
+    try:
+        if _state['tick_latency']:
+            time.sleep(_state['tick_latency'])
+    finally:
+        _exit()
+    if _state['tick_noise']:
+        step = _rng.normal(0, _state['tick_noise'])
+        _state['bid'] += step
+        _state['ask'] += step
+    now = _state['clock']() if _state['tick_time'] is None else _state['tick_time']
+    return Tick(int(now), _state['bid'], _state['ask'], 0.0, 0, int(now * 1000), 0, 0.0)
+
+
+def positions_get(symbol=None, ticket=None, **kwargs):
+    calls['positions_get'] += 1
+    positions = list(_state['positions'].values())
+    if symbol is not None:
+        positions = [p for p in positions if p.symbol == symbol]
+    if ticket is not None:
+        if _state['read_fail_rate'] and _rng.random() < _state['read_fail_rate']:
+            calls['positions_get_failed'] += 1
+            _state['last_error'] = (-10004, 'No IPC connection')
+            return None
+        positions = [p for p in positions if p.ticket == ticket]
+    return tuple(positions)
+
+
+def order_send(request):
+    calls['order_send'] += 1
+    _enter()
+    try:
+        if _state['latency']:
+            time.sleep(_state['latency'])
+    finally:
+        _exit()
+    price = _state['bid'] if request['type'] == ORDER_TYPE_SELL else _state['ask']
+    with _lock:
+        if _state['fail_next'] or (_state['fail_rate'] and _rng.random() < _state['fail_rate']):
+            retcode = _state['fail_next'].pop(0) if _state['fail_next'] else _state['fail_retcode']
+            return OrderSendResult(retcode, 0, 0, 0.0, 0.0, 'Rejected', request)
+        pos = _state['positions'].get(request.get('position'))
+        if pos is None:
+            return OrderSendResult(TRADE_RETCODE_POSITION_CLOSED, 0, 0, 0.0, 0.0, 'Position closed', request)
+        volume, retcode = min(request['volume'], pos.volume), TRADE_RETCODE_DONE
+        if _state['partial_rate'] and volume > 0.01 and _rng.random() < _state['partial_rate']:
+            volume, retcode = max(round(volume * _state['partial_fill'], 2), 0.01), TRADE_RETCODE_DONE_PARTIAL
+        remaining = round(pos.volume - volume, 2)
+        profit = pos.profit * volume / pos.volume
+        if remaining > 0:
+            _state['positions'][pos.ticket] = pos._replace(volume=remaining, profit=pos.profit - profit)
+        else:
+            del _state['positions'][pos.ticket]
+        deal = _add_deal(_state['clock'](), request['type'], 1, pos.magic, pos.identifier, volume, price, profit, pos.symbol, request.get('comment', ''))
+    return OrderSendResult(retcode, deal.ticket, deal.order, volume, price, 'Request executed', request)
+
+
+def copy_rates_from_pos(symbol, timeframe, start_pos, count):
+    """M1 bars of a deterministic random walk, the newest (at `start_pos` 0) is the forming one"""
+    calls['copy_rates_from_pos'] += 1
+    cur_minute = int(_state['clock']()) // 60 * 60
+    times = cur_minute - 60 * np.arange(start_pos + count - 1, start_pos - 1, -1, dtype=np.int64)
+    return _rates(symbol, times)
+
+
+def copy_rates_range(symbol, timeframe, date_from, date_to):
+    """M1 bars between `date_from` and `date_to`, same prices as `copy_rates_from_pos`"""
+    calls['copy_rates_range'] += 1
+    t_from = -(-int(_to_sec(date_from)) // 60) * 60
+    times = np.arange(t_from, int(_to_sec(date_to)) + 1, 60, dtype=np.int64)
+    return _rates(symbol, times)
+
+
+def _rates(symbol, times):
+    count = len(times)
+    rng = np.random.default_rng(abs(hash(symbol)) % 2**32)
+    base = _state['bid'] * (1 + 0.001 * np.sin(times / 3600.0 + rng.random()))
+    rates = np.zeros(count, dtype=RATE_DTYPE)
+    rates['time'] = times
+    rates['open'] = base
+    rates['high'] = base + 0.0002
+    rates['low'] = base - 0.0002
+    rates['close'] = base + 0.0001
+    rates['tick_volume'] = 60
+    rates['spread'] = 10
+    return rates
+
+
+def history_deals_get(date_from, date_to, **kwargs):
+    calls['history_deals_get'] += 1
+    t_from, t_to = _to_sec(date_from), _to_sec(date_to)
+    return tuple(d for d in _state['deals'] if t_from <= d.time <= t_to)
+
+
+def _to_sec(dt):
+    if isinstance(dt, (int, float)):
+        return dt
+    return calendar.timegm(dt.timetuple())
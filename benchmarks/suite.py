@@ -0,0 +1,163 @@
+"""Runs the benchmarks on the fake terminal and writes machine readable results
+
+Each benchmark of `BENCHMARKS` runs with the parameters below, results are written
+as JSON with the commit they ran on, so two runs can be compared:
+
+    python benchmarks/suite.py --out base.json
+    git checkout my-branch
+    python benchmarks/suite.py --out new.json --compare base.json
+
+With `--compare`, timings worse than `--threshold` times the base are reported as
+regressions and the exit code is 1. Timings are metrics named *_ms, *_us or *_sec
+(lower is better) and *_per_sec (higher is better), other metrics are shown only.
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+import fakeMt5
+fakeMt5.install()
+
+REPO_DIR = Path(__file__).parent.parent
+
+# name: (module, function, kwargs)
+BENCHMARKS = {
+    'scheduler_virtual': ('benchScheduler', 'bench_virtual', {'n_tasks': 5000}),
+    'timer_lateness': ('benchScheduler', 'bench_timer', {'n_tasks': 2000}),
+    'close_serial': ('benchClose', 'bench_close', {'n_positions': 40, 'latency': 0.02, 'workers': 1}),
+    'close_fanout': ('benchClose', 'bench_close', {'n_positions': 40, 'latency': 0.02, 'workers': 8}),
+    'close_fanout_terminal_thread': ('benchClose', 'bench_close',
+                                     {'n_positions': 40, 'latency': 0.02, 'workers': 8, 'terminal_thread': True}),
+    'dispatch': ('benchDispatch', 'bench', {'n_symbols': 8, 'n_positions': 5, 'latency': 0.02}),
+    'close_retry': ('benchCloseRetry', 'bench', {'n_positions': 40, 'latency': 0.01, 'fail_rate': 0.3, 'partial_rate': 0.3}),
+    'terminal': ('benchTerminal', 'bench', {'n_symbols': 22, 'n_readers': 8, 'n_orders': 20}),
+    'positions': ('benchPositions', 'bench', {'n_symbols': 22, 'n_positions': 2000}),
+    'history': ('benchHistory', 'bench', {'days': 120, 'per_day': 400}),
+    'cache': ('benchCache', 'bench', {'days': 120, 'per_day': 400, 'years': 2}),
+    'report': ('benchReport', 'bench', {'n_nights': 250, 'per_night': 200}),
+    'journal': ('benchJournal', 'bench', {'n_events': 2000, 'n_nights': 7, 'per_night': 2000}),
+    'calendar': ('benchCalendar', 'bench', {'n_symbols': 22, 'n_queries': 10_000}),
+    'clock': ('benchClock', 'bench', {'seconds': 1.0, 'interval': 5.0}),
+    'bars': ('benchBars', 'bench', {'n_queries': 2000, 'lb': 60, 'n_symbols': 22}),
+    'ticks': ('benchTicks', 'bench', {'n_symbols': 22, 'seconds': 2.0, 'interval': 0.1, 'tick_latency': 0.0005}),
+    'rules': ('benchRules', 'bench', {'n_rows': 2000, 'n_changed': 30}),
+    'rule_index': ('benchRuleIndex', 'bench', {'n_rules': 10_000, 'n_positions': 10_000}),
+    'backtest': ('benchBacktest', 'bench', {'n_symbols': 22, 'n_nights': 260, 'per_night': 20, 'workers': None}),
+    'telemetry': ('benchTelemetry', 'bench', {'n_calls': 200_000, 'n_labels': 30}),
+    'import': ('benchImport', 'bench', {'budget_ms': 30.0, 'repeat': 3}),
+    'accounts': ('benchAccounts', 'bench', {'n_accounts': 4, 'max_terminals': 2, 'stagger_sec': 0.2}),
+    'replay': ('benchReplay', 'bench', {'n_positions': 200}),
+}
+
+
+def flatten(result, prefix=''):
+    """Flatten nested dicts and tuples of dicts into {'a.b': value}"""
+    if isinstance(result, tuple):
+        result = {str(i): r for i, r in enumerate(result)}
+    flat = {}
+    for key, value in result.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, (dict, tuple)):
+            flat.update(flatten(value, f'{name}.'))
+        else:
+            flat[name] = value
+    return flat
+
+
+def meta():
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        except OSError:
+            return None
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'time': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run(names):
+    results, errors = {}, {}
+    for name in names:
+        module, function, kwargs = BENCHMARKS[name]
+        print(f'{name} ...', file=sys.stderr, flush=True)
+        t0 = time.perf_counter()
+        try:
+            result = getattr(importlib.import_module(module), function)(**kwargs)
+        except Exception:
+            errors[name] = traceback.format_exc()
+            print(errors[name], file=sys.stderr)
+            continue
+        results[name] = dict(flatten(result), wall_sec=round(time.perf_counter() - t0, 3))
+    return {'meta': meta(), 'params': {n: BENCHMARKS[n][2] for n in names}, 'results': results, 'errors': errors}
+
+
+def direction(metric):
+    """1 if higher is better, -1 if lower is better, 0 if not a timing"""
+    if metric.endswith('_per_sec'):
+        return 1
+    if metric.endswith(('_ms', '_us', '_sec')) or '_ms_' in metric:
+        return -1
+    return 0
+
+
+def compare(base, new, threshold):
+    """Print metrics of `new` against `base`, returns list of regressions"""
+    regressions = []
+    print(f'{"metric":<55} {"base":>12} {"new":>12}    ratio')
+    for name, metrics in new['results'].items():
+        base_metrics = base['results'].get(name, {})
+        for metric, value in metrics.items():
+            old = base_metrics.get(metric)
+            sign = direction(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or isinstance(value, bool):
+                continue
+            ratio = value / old if old else float('inf') if value else 1.0
+            flag = ''
+            if sign and metric != 'wall_sec':
+                worse = ratio if sign < 0 else (1 / ratio if ratio else float('inf'))
+                if worse > threshold:
+                    flag = 'REGRESSION'
+                    regressions.append(f'{name}.{metric}')
+            print(f'{name + "." + metric:<55} {old:>12.4g} {value:>12.4g} {ratio:>7.2f}x {flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run, all by default')
+    parser.add_argument('--skip', nargs='+', choices=list(BENCHMARKS), default=[], help='benchmarks not to run')
+    parser.add_argument('--out', help='write results to this JSON file, printed if not given')
+    parser.add_argument('--compare', metavar='BASE', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.5, help='ratio of a timing to the base counted as regression')
+    args = parser.parse_args()
+
+    names = [n for n in (args.only or BENCHMARKS) if n not in args.skip]
+    output = run(names)
+    text = json.dumps(output, indent=2, default=str)
+    if args.out:
+        Path(args.out).write_text(text)
+    else:
+        print(text)
+
+    failed = bool(output['errors'])
+    if args.compare:
+        base = json.loads(Path(args.compare).read_text())
+        regressions = compare(base, output, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions: {regressions}', file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -1,11 +1,24 @@
-import logging
+import logging as _logging
+from pathlib import Path
 
-logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
-logging.info('test from init')
+# Package logger, modules log by `from . import logging; logging.info(...)`.
+# Handlers and level are left to the application, see `nightguard.cli.configure_logging`.
+logging = _logging.getLogger(__name__)
 
-from pathlib import Path
 PAK_DIR = Path(__file__).parent.parent.absolute().resolve()
-print(f'Package Dir: {PAK_DIR}')
 
-from .toNight import Tonight
-from .mt5Api import MT5Api
+# `MT5Api` and `Tonight` pull in MetaTrader5 and pandas, import them on first use
+# so the CLI and the scheduler start without them.
+_LAZY = {
+    'MT5Api': '.mt5Api',
+    'Tonight': '.toNight',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        from importlib import import_module
+        value = getattr(import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,129 @@
+from threading import Event
+
+import numpy as np
+
+from . import logging
+from .ringBuffer import RingBuffer
+
+
+# Same fields as the array returned by `MetaTrader5.copy_rates_from_pos`
+RATE_DTYPE = np.dtype([
+    ('time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+    ('tick_volume', '<u8'), ('spread', '<i4'), ('real_volume', '<u8'),
+])
+
+
+class BarCache(RingBuffer):
+    """Fixed size ring buffer of M1 bars of a symbol, see `RingBuffer`
+
+    Args:
+        capacity (int): max number of bars kept
+    """
+
+    def __init__(self, capacity):
+        super().__init__(capacity, RATE_DTYPE)
+
+    @property
+    def last_time(self):
+        """Open time in seconds of the newest bar, None if empty"""
+        if self._size == 0:
+            return None
+        return int(self._buf[self._head + self.capacity - 1]['time'])
+
+    def extend(self, rates):
+        """Append bars (oldest first), bars not newer than `last_time` are ignored"""
+        last_time = self.last_time
+        if last_time is not None:
+            rates = rates[rates['time'] > last_time]
+        return super().extend(rates)
+
+
+class BarStream:
+    """Closed M1 bars of symbols, emitted at minute boundaries of broker time
+
+    Bars are cached per symbol in a `BarCache`, each update only requests the bars
+    newer than the last cached one. `subscribe` sleeps until each minute boundary
+    (plus `grace` seconds for the terminal to open the new bar) instead of polling.
+
+    Example:
+        stream = BarStream(mt5.copy_rates_from_pos, mt5.TIMEFRAME_M1, clock, ['EURUSD'])
+        for symbol, bar in stream.subscribe():
+            closes = stream.bars(symbol, 10)['close']
+
+    Args:
+        copy_rates_from_pos (callable): `MetaTrader5.copy_rates_from_pos`
+        timeframe (int): `MetaTrader5.TIMEFRAME_M1`
+        clock (BrokerClock): broker time source
+        symbols (list, optional): symbols to stream. Defaults to [].
+        capacity (int, optional): bars cached per symbol. Defaults to 1440.
+        grace (float, optional): seconds waited after a minute boundary. Defaults to 0.5.
+    """
+
+    CAPACITY = 24 * 60
+    GRACE = 0.5
+
+    def __init__(self, copy_rates_from_pos, timeframe, clock, symbols=None, capacity=CAPACITY, grace=GRACE):
+        self._copy_rates = copy_rates_from_pos
+        self.timeframe = timeframe
+        self.clock = clock
+        self.capacity = capacity
+        self.grace = grace
+        self.symbols = list(symbols or [])
+        self._caches = {}
+        self._stop = Event()
+
+    def cache(self, symbol):
+        if symbol not in self._caches:
+            self._caches[symbol] = BarCache(self.capacity)
+        return self._caches[symbol]
+
+    def bars(self, symbol, n=None):
+        """View of the last `n` closed bars of `symbol` in cache, oldest first"""
+        return self.cache(symbol).last(n)
+
+    def update(self, symbol):
+        """Fetch closed bars of `symbol` newer than the cached ones
+
+        Returns:
+            ndarray: new closed bars, oldest first
+        """
+        cache = self.cache(symbol)
+        cur_minute = self.clock.now_ns() // 1_000_000_000 // 60 * 60
+        if cache.last_time is None:
+            count = self.capacity + 1
+        else:
+            # Closed bars after the last cached one, plus the forming bar
+            count = min(self.capacity + 1, (cur_minute - cache.last_time) // 60)
+            if count <= 1:
+                return cache.last(0)
+        rates = self._copy_rates(symbol, self.timeframe, 0, int(count))
+        if rates is None or len(rates) == 0:
+            logging.warning(f'No bars of {symbol} returned')
+            return cache.last(0)
+        rates = np.asarray(rates)
+        closed = rates[rates['time'] < cur_minute]
+        n = cache.extend(closed)
+        return cache.last(n)
+
+    def subscribe(self, symbols=None):
+        """Generator yielding `(symbol, bar)` of each newly closed bar, at each minute boundary
+
+        Runs until `stop` is called. Missed minutes (e.g. after a terminal hiccup) are
+        yielded at the next boundary.
+        """
+        symbols = self.symbols if symbols is None else symbols
+        self._stop.clear()
+        for symbol in symbols:
+            self.update(symbol)
+        while not self._stop.wait(self.sec_till_next_minute() + self.grace):
+            for symbol in symbols:
+                for bar in self.update(symbol):
+                    yield symbol, bar
+
+    def stop(self):
+        self._stop.set()
+
+    def sec_till_next_minute(self):
+        """Seconds of broker time till the next minute boundary"""
+        ns = self.clock.now_ns()
+        return (60_000_000_000 - ns % 60_000_000_000) / 1e9
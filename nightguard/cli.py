@@ -0,0 +1,183 @@
+"""Command line entry point, runs unattended under a service manager
+
+Every option is a flag, with an environment variable fallback:
+
+    python main.py --config Config.ini --report-prefix demo
+    NIGHTGUARD_CONFIG=acc1/Config.ini,acc2/Config.ini python main.py --max-terminals 2
+
+Only the standard library is imported until the options are parsed, MetaTrader5
+and pandas are imported when the first account starts.
+"""
+import argparse
+import logging as _logging
+import os
+import signal
+import sys
+
+from . import logging, PAK_DIR
+
+
+LOG_FORMAT = '%(asctime)s - %(message)s'
+LOG_DATEFMT = '%d-%b-%y %H:%M:%S'
+
+ENV_PREFIX = 'NIGHTGUARD_'
+
+
+def configure_logging(level='INFO', log_file=None):
+    """Log to stderr, and to `log_file` if given, with NightGuard's format
+
+    Application side only, library modules never configure logging.
+    """
+    handlers = [_logging.StreamHandler()]
+    if log_file:
+        handlers.append(_logging.FileHandler(log_file))
+    _logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATEFMT, level=level.upper(), handlers=handlers, force=True)
+
+
+def _env(name, default=None, type=str):
+    value = os.environ.get(ENV_PREFIX + name)
+    if value is None or value == '':
+        return default
+    return type(value)
+
+
+def _flag(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _paths(value):
+    return [p for p in value.split(',') if p]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='nightguard',
+        description='Close positions opened during rollover at their stop time.',
+        epilog=f'Options fall back to environment variables {ENV_PREFIX}<OPTION>, e.g. {ENV_PREFIX}CONFIG.',
+    )
+    parser.add_argument(
+        '-c', '--config', action='append', dest='configs', metavar='PATH',
+        help='Config.ini of an account, repeat for many accounts run by a supervisor. '
+             f'Defaults to {ENV_PREFIX}CONFIG (comma separated) or Config.ini',
+    )
+    parser.add_argument(
+        '-p', '--report-prefix', default=_env('REPORT_PREFIX'),
+        help='prefix of the report name prefix_PositionReport.csv. Defaults to none',
+    )
+    parser.add_argument(
+        '-n', '--nights', type=int, default=_env('NIGHTS', type=int),
+        help='number of nights to run, then exit. Defaults to run indefinitely',
+    )
+    parser.add_argument(
+        '--hour-shift', type=int, default=_env('HOUR_SHIFT', type=int),
+        help='hours of broker time ahead of UTC, needed when started while market is closed',
+    )
+    parser.add_argument(
+        '--max-terminals', type=int, default=_env('MAX_TERMINALS', 4, int),
+        help='max accounts running at the same time with many configs, at least the number of configs '
+             'unless --nights is set. Defaults to 4',
+    )
+    parser.add_argument(
+        '--log-level', default=_env('LOG_LEVEL', 'INFO'),
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], type=str.upper,
+        help='Defaults to INFO',
+    )
+    parser.add_argument(
+        '--log-file', default=_env('LOG_FILE'),
+        help='also append logs to this file',
+    )
+    parser.add_argument(
+        '--metrics-port', type=int, default=_env('METRICS_PORT', 0, int),
+        help='serve Prometheus metrics at http://127.0.0.1:PORT/metrics. Defaults to 0, off',
+    )
+    parser.add_argument(
+        '--metrics-file', default=_env('METRICS_FILE'),
+        help='append a JSON snapshot of the metrics to this file every --metrics-interval seconds',
+    )
+    parser.add_argument(
+        '--metrics-interval', type=float, default=_env('METRICS_INTERVAL', 60.0, float),
+        help='seconds between snapshots of --metrics-file. Defaults to 60',
+    )
+    parser.add_argument(
+        '--replay', default=_env('REPLAY'), metavar='LOG',
+        help='run the night recorded in LOG (see RECORD_DIR of Config.ini) without a terminal, '
+             'as fast as tasks allow. Runs 1 night and reports with prefix Replay unless given',
+    )
+    parser.add_argument(
+        '--profile', default=_env('PROFILE'), metavar='PATH',
+        help='with --replay, profile all threads and write the pstats to PATH',
+    )
+    parser.add_argument(
+        '-i', '--interactive', action='store_true', default=_env('INTERACTIVE', False, _flag),
+        help='prompt for the config path and report prefix, as older versions did',
+    )
+    return parser
+
+
+def parse_args(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.interactive:
+        config_path = input(f'\n>>> Please input the Config.ini path, press Enter for default location: ')
+        args.configs = [config_path or 'Config.ini']
+        args.report_prefix = input(f'\n>>> Please input the prefix for report name prefix_PositionReport.csv, press Enter for default: ') or None
+    if not args.configs:
+        args.configs = _env('CONFIG', ['Config.ini'], _paths)
+    return args
+
+
+def start_telemetry(args):
+    """Start the metrics endpoint and file of `args`, returns them to stop at exit
+
+    Metrics are kept per process, so they cover a single account. With many accounts,
+    see the metrics of each night in `Accounts_Metrics.jsonl` instead.
+    """
+    exporters = []
+    if args.metrics_port or args.metrics_file:
+        from .telemetry import MetricsServer, JsonlExporter
+        if args.metrics_port:
+            exporters.append(MetricsServer(args.metrics_port).start())
+        if args.metrics_file:
+            exporters.append(JsonlExporter(args.metrics_file, interval=args.metrics_interval).start())
+    return exporters
+
+
+def _terminate(signum, frame):
+    # Exit through SystemExit so a service manager stop unwinds like Control+C
+    raise SystemExit(128 + signum)
+
+
+def main(argv=None):
+    """Run NightGuard with options from `argv` (defaults to sys.argv), returns the exit code"""
+    args = parse_args(argv)
+    configure_logging(args.log_level, args.log_file)
+    signal.signal(signal.SIGTERM, _terminate)
+    logging.info(f'Package Dir: {PAK_DIR}')
+    exporters = start_telemetry(args)
+
+    try:
+        if args.replay:
+            from .terminalReplay import replay
+            _, stats = replay(args.replay, args.configs[0], args.report_prefix or 'Replay',
+                              nights=args.nights or 1, profile_path=args.profile)
+            if stats is not None:
+                stats.sort_stats('cumulative').print_stats(30)
+        elif len(args.configs) == 1:
+            from .runner import run
+            run(args.configs[0], args.report_prefix, nights=args.nights, hour_shift=args.hour_shift)
+        else:
+            from .orchestrator import Supervisor
+            Supervisor(
+                args.configs, max_terminals=args.max_terminals, nights=args.nights, hour_shift=args.hour_shift,
+                log_level=args.log_level,
+            ).run()
+    except KeyboardInterrupt:
+        logging.info('Interrupted, exiting')
+        return 130
+    finally:
+        for exporter in exporters:
+            exporter.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from . import logging
+
+
+# Columns of deals kept by `DealBook`
+DEAL_COLUMNS = [
+    'ticket', 'time', 'time_msc', 'type', 'entry', 'position_id', 'volume', 'price',
+    'commission', 'swap', 'profit', 'magic', 'reason', 'symbol', 'comment',
+]
+
+# Columns of reconstructed positions, same as `MT5Api.get_history_positions`
+POSITION_COLUMNS = [
+    'En_Time', 'En_Price', 'Volume', 'symbol', 'magic', 'comment', 'en_reason',
+    'Ex_Time', 'Ex_Price', 'profit', 'swap', 'ex_reason', 'commision',
+]
+
+# Deal entry, see: https://www.mql5.com/en/docs/constants/tradingconstants/dealproperties
+DEAL_ENTRY_IN = 0
+
+
+def empty_positions():
+    positions = pd.DataFrame(columns=POSITION_COLUMNS)
+    positions.index.name = 'position_id'
+    return positions
+
+
+def reconstruct_positions(deals):
+    """Pair buy and sell deals into positions, vectorized over all positions
+
+    Deals are sorted by (position_id, time_msc, ticket) and grouped at position id changes.
+    A position is closed once its signed volume (buy +, sell -) sums to zero, so
+    partial closes and partial entries are aggregated: entry/exit prices are volume
+    weighted over deals in/against the direction of the first deal, profit, swap and
+    commission are summed. Reversals are kept as one position until the net volume
+    returns to zero. Positions whose first deal is not an entry started before the
+    fetched history, and are dropped.
+
+    Args:
+        deals (dataframe): deals with `DEAL_COLUMNS`, buy and sell deals only
+
+    Returns:
+        tuple: (dataframe of closed positions with `POSITION_COLUMNS` indexed by position id,
+                dataframe of deals of still open positions)
+    """
+    if len(deals) == 0:
+        return empty_positions(), deals
+
+    order = np.lexsort((deals.ticket.values, deals.time_msc.values, deals.position_id.values))
+    deals = deals.iloc[order]
+    pid = deals.position_id.values
+    starts = np.flatnonzero(np.r_[True, pid[1:] != pid[:-1]])
+    counts = np.diff(np.r_[starts, len(pid)])
+    ends = starts + counts - 1
+
+    side = np.where(deals.type.values == 0, 1.0, -1.0)
+    volume = deals.volume.values.astype(float)
+    price = deals.price.values.astype(float)
+    is_in = side == np.repeat(side[starts], counts)
+    in_vol = np.add.reduceat(volume * is_in, starts)
+    out_vol = np.add.reduceat(volume * ~is_in, starts)
+    net_vol = np.add.reduceat(side * volume, starts)
+
+    complete = deals.entry.values[starts] == DEAL_ENTRY_IN
+    closed = complete & (out_vol > 0) & (np.abs(net_vol) < 1e-8)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        en_price = np.add.reduceat(price * volume * is_in, starts) / in_vol
+        ex_price = np.add.reduceat(price * volume * ~is_in, starts) / out_vol
+
+    times = deals.time.values
+    positions = pd.DataFrame({
+        'En_Time': pd.to_datetime(times[starts], unit='s'),
+        'En_Price': en_price,
+        'Volume': in_vol * side[starts],
+        'symbol': deals.symbol.values[starts],
+        'magic': deals.magic.values[starts],
+        'comment': deals.comment.values[starts],
+        'en_reason': deals.reason.values[starts],
+        'Ex_Time': pd.to_datetime(times[ends], unit='s'),
+        'Ex_Price': ex_price,
+        'profit': np.add.reduceat(deals.profit.values.astype(float), starts),
+        'swap': np.add.reduceat(deals.swap.values.astype(float), starts),
+        'ex_reason': deals.reason.values[ends],
+        'commision': np.add.reduceat(deals.commission.values.astype(float), starts),
+    }, index=pd.Index(pid[starts], name='position_id'))
+
+    still_open = np.repeat(complete & ~closed, counts)
+    return positions[closed], deals[still_open]
+
+
+class DealBook:
+    """Incrementally reconstructed history of closed positions
+
+    Keeps a watermark of the last seen deal ticket, each `sync` fetches only deals
+    from the time of that deal, and reconstructs positions from the new deals plus
+    deals of positions still open at the last sync. Closed positions are cached
+    in `closed`.
+
+    Example:
+        book = DealBook(mt5.history_deals_get)
+        book.sync(datetime(2021, 10, 1), datetime(2021, 10, 2))
+        positions = book.between(datetime(2021, 10, 1), datetime(2021, 10, 2))
+
+    Args:
+        history_deals_get (callable): `MetaTrader5.history_deals_get`, or `HistoryCache.history_deals_get`
+            returning a dataframe
+    """
+
+    def __init__(self, history_deals_get):
+        self._deals_get = history_deals_get
+        self.reset()
+
+    def reset(self):
+        """Forget all fetched deals and positions"""
+        self.watermark = None
+        self._last_dt = None
+        self._start_dt = None
+        self._open_deals = pd.DataFrame(columns=DEAL_COLUMNS)
+        self.closed = empty_positions()
+
+    def sync(self, date_from, date_to):
+        """Fetch deals newer than the watermark till `date_to`, update closed positions.
+
+        If `date_from` is earlier than history fetched so far, the book is rebuilt from `date_from`.
+
+        Args:
+            date_from (datetime): start of history
+            date_to (datetime): end of history
+
+        Returns:
+            int: number of new buy and sell deals
+        """
+        if self._start_dt is None or date_from < self._start_dt:
+            self.reset()
+            self._start_dt = date_from
+            fetch_from = date_from
+        else:
+            fetch_from = self._last_dt
+        # Fetched history starts at `date_from` even if it has no deals yet
+        if self._last_dt is None:
+            self._last_dt = fetch_from
+        if fetch_from > date_to:
+            return 0
+
+        deals = self._deals_get(fetch_from, date_to)
+        if deals is None or len(deals) == 0:
+            return 0
+        if isinstance(deals, pd.DataFrame):
+            deals_df = deals
+        else:
+            deals_df = pd.DataFrame(list(deals), columns=deals[0]._asdict().keys())
+        if self.watermark is not None:
+            deals_df = deals_df[deals_df.ticket > self.watermark]
+        if len(deals_df) == 0:
+            return 0
+        self.watermark = int(deals_df.ticket.max())
+        self._last_dt = datetime.utcfromtimestamp(int(deals_df.time.max()))
+
+        # Filt out non buy and sell deals
+        deals_df = deals_df[deals_df.type.isin([0, 1])][DEAL_COLUMNS]
+        pending = pd.concat([self._open_deals, deals_df]) if len(self._open_deals) else deals_df
+        closed, self._open_deals = reconstruct_positions(pending)
+        if len(closed):
+            self.closed = pd.concat([self.closed, closed]) if len(self.closed) else closed
+        logging.debug(f'{len(deals_df)} new deals, {len(closed)} positions closed, {len(self._open_deals)} open deals')
+        return len(deals_df)
+
+    def between(self, date_from, date_to):
+        """Return closed positions entered at or after `date_from` and exited at or before `date_to`"""
+        closed = self.closed
+        return closed[(closed.En_Time >= date_from) & (closed.Ex_Time <= date_to)]
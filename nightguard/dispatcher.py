@@ -0,0 +1,87 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Lock
+
+from . import logging
+
+
+class SymbolDispatcher:
+    """Runs tasks of different keys concurrently, and tasks of the same key in order
+
+    Each key (e.g. a symbol) has a queue of tasks drained by one worker at a
+    time, so two closes of EURUSD never overlap while EURUSD and USDJPY firing
+    at the same second are closed side by side.
+
+    Example:
+        dispatcher = SymbolDispatcher(max_workers=8)
+        dispatcher.submit('EURUSD', tonight.close_position, 'EURUSD', [2, 3])
+        dispatcher.join()    # wait till all submitted tasks are done
+
+    Args:
+        max_workers (int, optional): max number of keys running at the same time,
+            1 runs every task one by one. Defaults to 8.
+    """
+
+    MAX_WORKERS = 8
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dispatch')
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        # key -> queue of (future, fn, args, kwargs), a key is present while it has a worker
+        self._queues = {}
+        self._in_flight = 0
+
+    @property
+    def in_flight(self):
+        """Number of tasks submitted and not yet done"""
+        return self._in_flight
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` after the tasks of `key` submitted before
+
+        Returns:
+            Future: result of `fn`, exceptions are logged and set on it
+        """
+        future = Future()
+        with self._lock:
+            self._in_flight += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((future, fn, args, kwargs))
+                return future
+            self._queues[key] = deque([(future, fn, args, kwargs)])
+        self._pool.submit(self._drain, key)
+        return future
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                future, fn, args, kwargs = queue.popleft()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    logging.exception(f'Task of {key} failed: {e}')
+                    future.set_exception(e)
+            with self._lock:
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self._idle.notify_all()
+
+    def join(self, timeout=None):
+        """Wait till all submitted tasks are done
+
+        Returns:
+            bool: false if `timeout` seconds passed first
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,362 @@
+import calendar
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from threading import RLock
+
+import numpy as np
+import pandas as pd
+
+from . import logging
+from .barStream import RATE_DTYPE
+from .dealBook import DEAL_COLUMNS
+
+
+# Columns of cached deals, `DEAL_COLUMNS` with text columns stored as int32 codes
+DEAL_DTYPE = np.dtype([
+    ('ticket', '<i8'), ('time', '<i8'), ('time_msc', '<i8'), ('type', '<i8'), ('entry', '<i8'),
+    ('position_id', '<i8'), ('volume', '<f8'), ('price', '<f8'), ('commission', '<f8'), ('swap', '<f8'),
+    ('profit', '<f8'), ('magic', '<i8'), ('reason', '<i8'), ('symbol', '<i4'), ('comment', '<i4'),
+])
+DEAL_LABELS = ('symbol', 'comment')
+
+BAR_SEC = 60
+
+
+def to_sec(dt):
+    """Seconds of a broker time, as `time` of deals and bars"""
+    if isinstance(dt, (int, np.integer)):
+        return int(dt)
+    if isinstance(dt, str):
+        dt = pd.to_datetime(dt)
+    return calendar.timegm(dt.timetuple())
+
+
+class ColumnTable:
+    """Append-only table on disk sorted by `time`, a raw file per column read by `np.memmap`
+
+    Reading a range maps each column once and slices it, so it returns views of
+    the page cache without copying or parsing, however many years the table holds.
+    Text columns are stored as int32 codes of `labels`.
+
+    `meta.json`, holding the number of rows and the range of time covered, is
+    replaced after the columns are written, so rows of a write cut by a crash are
+    ignored and overwritten by the next one. Rows older than the last are merged
+    into a new generation of files, and views of the previous one stay valid.
+
+    Args:
+        path (str or Path): directory of the table, created if not exists
+        dtype (np.dtype): names and types of the columns, one named `time`
+        labels (tuple, optional): names of text columns. Defaults to ().
+    """
+
+    def __init__(self, path, dtype, labels=()):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dtype = dtype
+        self.lock = RLock()
+        meta = self._read_meta()
+        self.rows = meta.get('rows', 0)
+        self.generation = meta.get('generation', 0)
+        # Time in seconds covered by the table, both inclusive
+        self.start = meta.get('start')
+        self.end = meta.get('end')
+        self.labels = {name: meta.get('labels', {}).get(name, []) for name in labels}
+        self._codes = {name: {label: i for i, label in enumerate(values)} for name, values in self.labels.items()}
+        self._maps = {}
+
+    def _read_meta(self):
+        try:
+            with open(self.path / 'meta.json', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logging.warning(f'Ignore broken cache {self.path}: {e}')
+            return {}
+
+    def _write_meta(self):
+        tmp = self.path / 'meta.json.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'rows': self.rows, 'generation': self.generation, 'start': self.start,
+                       'end': self.end, 'labels': self.labels}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path / 'meta.json')
+
+    def _file(self, name, generation=None):
+        return self.path / f'{name}-{self.generation if generation is None else generation}.bin'
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def last_time(self):
+        """Time of the newest row, None if empty"""
+        return int(self.column('time')[-1]) if self.rows else None
+
+    def column(self, name):
+        """Whole column `name`, memory-mapped"""
+        rows = self.rows
+        cached = self._maps.get(name)
+        if cached is not None and cached[0] == (self.generation, rows):
+            return cached[1]
+        if rows == 0:
+            values = np.zeros(0, dtype=self.dtype[name])
+        else:
+            values = np.memmap(self._file(name), dtype=self.dtype[name], mode='r', shape=(rows,)).view(np.ndarray)
+        self._maps[name] = ((self.generation, rows), values)
+        return values
+
+    def bounds(self, t_from, t_to):
+        """Row slice of times from `t_from` to `t_to`, both inclusive"""
+        times = self.column('time')
+        return slice(int(np.searchsorted(times, t_from)), int(np.searchsorted(times, t_to, side='right')))
+
+    def read(self, t_from, t_to, columns=None):
+        """Views of rows of times from `t_from` to `t_to`
+
+        Returns:
+            dict: arrays by column name, read-only views of the files
+        """
+        with self.lock:
+            rows = self.bounds(t_from, t_to)
+            return {name: self.column(name)[rows] for name in (columns or self.dtype.names)}
+
+    def decode(self, name, codes):
+        """Labels of `codes` of the text column `name`"""
+        return np.asarray(self.labels[name], dtype=object)[codes]
+
+    def _encode(self, name, values):
+        codes, labels = self._codes[name], self.labels[name]
+        uniques, inverse = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+        mapping = np.empty(len(uniques), dtype=np.int32)
+        for i, label in enumerate(uniques):
+            code = codes.get(label)
+            if code is None:
+                code = codes[label] = len(labels)
+                labels.append(label)
+            mapping[i] = code
+        return mapping[inverse]
+
+    def write(self, columns, start, end):
+        """Add rows and extend the covered range to `start` - `end`
+
+        Args:
+            columns (dict): arrays of the same length by column name, text columns as strings
+            start (int): first time covered in seconds
+            end (int): last time covered in seconds
+        """
+        with self.lock:
+            n = len(columns['time'])
+            columns = {name: self._encode(name, columns[name]) if name in self.labels
+                       else np.asarray(columns[name], dtype=self.dtype[name]) for name in self.dtype.names}
+            order = np.argsort(columns['time'], kind='stable')
+            columns = {name: values[order] for name, values in columns.items()}
+            old_generation = self.generation
+            if n and self.rows and columns['time'][0] < self.last_time:
+                self._rewrite(columns)
+            elif n:
+                self._append(columns)
+            self.start = start if self.start is None else min(self.start, start)
+            self.end = end if self.end is None else max(self.end, end)
+            self.rows += n
+            self._write_meta()
+            if self.generation != old_generation:
+                self.prune()
+
+    def _append(self, columns):
+        for name, values in columns.items():
+            path = self._file(name)
+            with open(path, 'r+b' if path.exists() else 'wb') as f:
+                f.seek(self.rows * values.itemsize)
+                f.write(values.tobytes())
+                f.truncate()
+                os.fsync(f.fileno())
+
+    def _rewrite(self, columns):
+        merged = {name: np.concatenate([self.column(name), values]) for name, values in columns.items()}
+        order = np.argsort(merged['time'], kind='stable')
+        for name, values in merged.items():
+            with open(self._file(name, self.generation + 1), 'wb') as f:
+                f.write(values[order].tobytes())
+                os.fsync(f.fileno())
+        self.generation += 1
+
+    def prune(self):
+        """Remove files of previous generations, the ones still mapped (on Windows) are left for next time"""
+        for path in self.path.glob('*-*.bin'):
+            if not path.name.endswith(f'-{self.generation}.bin'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class HistoryCache:
+    """Deals and M1 bars of an account cached on disk, each fetched from mt5 once
+
+    Deals are kept in `root/deals` and bars of each symbol in `root/bars/SYMBOL`,
+    each a `ColumnTable`. A sync only requests the history outside of the range
+    cached so far: from the last cached time to now, and before the first cached
+    time. Reads return views of the memory-mapped columns, so backtests and
+    analytics over years of history run without the terminal and without copies.
+
+    History newer than the broker time `now` is not cached, nor the forming bar.
+    If a request to mt5 fails, reads serve the history cached so far.
+
+    Example:
+        cache = HistoryCache(PAK_DIR / 'HistoryCache' / login, mt5.history_deals_get, mt5.copy_rates_range, mt5.TIMEFRAME_M1)
+        bars = cache.rates('EURUSD', datetime(2021, 1, 1), datetime(2022, 1, 1))
+        closes = bars['close']
+
+    Args:
+        root (str or Path): directory of the cache of an account, created if not exists
+        history_deals_get (callable, optional): `MetaTrader5.history_deals_get`, None to read only
+        copy_rates_range (callable, optional): `MetaTrader5.copy_rates_range`, None to read only
+        timeframe (int, optional): `MetaTrader5.TIMEFRAME_M1`. Defaults to 1.
+        now (callable, optional): returns broker time as a datetime. Defaults to `datetime.utcnow`.
+    """
+
+    def __init__(self, root, history_deals_get=None, copy_rates_range=None, timeframe=1, now=datetime.utcnow):
+        self.root = Path(root)
+        self._deals_get = history_deals_get
+        self._rates_range = copy_rates_range
+        self.timeframe = timeframe
+        self.now = now
+        self._deals = None
+        self._bars = {}
+        self._lock = RLock()
+
+    @property
+    def deal_table(self):
+        with self._lock:
+            if self._deals is None:
+                self._deals = ColumnTable(self.root / 'deals', DEAL_DTYPE, DEAL_LABELS)
+            return self._deals
+
+    def bar_table(self, symbol):
+        with self._lock:
+            table = self._bars.get(symbol)
+            if table is None:
+                table = self._bars[symbol] = ColumnTable(self.root / 'bars' / symbol, RATE_DTYPE)
+            return table
+
+    def _sync(self, table, fetch, key, t_from, t_to):
+        """Fetch rows of `t_from` - `t_to` not covered by `table`, returns the number added, None if mt5 failed"""
+        if fetch is None or t_from > t_to:
+            return 0
+        with table.lock:
+            if table.start is None:
+                ranges = [(t_from, t_to)]
+            else:
+                ranges = []
+                if t_from < table.start:
+                    ranges.append((t_from, table.start))
+                if t_to > table.end:
+                    # The last second again, for rows added to it after it was fetched
+                    ranges.append((table.end, t_to))
+            added = 0
+            for lo, hi in ranges:
+                columns = fetch(lo, hi)
+                if columns is None:
+                    return None
+                times = columns['time']
+                keep = (times >= lo) & (times <= hi)
+                if table.start is not None and lo < table.start:
+                    keep &= times < table.start
+                elif table.end is not None:
+                    known = table.read(table.end, table.end, [key])[key]
+                    keep &= (times > table.end) | ~np.isin(columns[key], known)
+                columns = {name: values[keep] for name, values in columns.items()}
+                table.write(columns, lo, hi)
+                added += len(columns['time'])
+            return added
+
+    def _fetch_deals(self, t_from, t_to):
+        deals = self._deals_get(datetime.utcfromtimestamp(t_from), datetime.utcfromtimestamp(t_to))
+        if deals is None:
+            logging.warning(f'No deals returned, history cached till {self.deal_table.end} is used')
+            return None
+        if len(deals) == 0:
+            return {name: np.zeros(0, dtype=DEAL_DTYPE[name]) for name in DEAL_DTYPE.names}
+        deals_df = pd.DataFrame(list(deals), columns=deals[0]._asdict().keys())
+        return {name: deals_df[name].values for name in DEAL_DTYPE.names}
+
+    def sync_deals(self, date_from, date_to):
+        """Cache deals from `date_from` to `date_to`, only the ones not cached yet are fetched
+
+        Returns:
+            int: number of deals added, None if mt5 failed
+        """
+        t_to = min(to_sec(date_to), to_sec(self.now()))
+        fetch = None if self._deals_get is None else self._fetch_deals
+        return self._sync(self.deal_table, fetch, 'ticket', to_sec(date_from), t_to)
+
+    def deals(self, date_from, date_to, columns=None):
+        """Cached deals from `date_from` to `date_to` as views, text columns as codes, see `ColumnTable.decode`
+
+        Returns:
+            dict: arrays by column of `DEAL_DTYPE`
+        """
+        return self.deal_table.read(to_sec(date_from), to_sec(date_to), columns)
+
+    def deals_frame(self, date_from, date_to):
+        """Cached deals from `date_from` to `date_to` as a dataframe with `DEAL_COLUMNS`
+
+        Numeric columns are views of the cache, symbol and comment are decoded to strings.
+        """
+        table = self.deal_table
+        deals = self.deals(date_from, date_to)
+        for name in DEAL_LABELS:
+            deals[name] = table.decode(name, deals[name])
+        return pd.DataFrame({name: deals[name] for name in DEAL_COLUMNS}, copy=False)
+
+    def history_deals_get(self, date_from, date_to):
+        """Drop-in of `MetaTrader5.history_deals_get` for `DealBook`, syncs then reads the cache
+
+        Returns:
+            dataframe: deals with `DEAL_COLUMNS`
+        """
+        self.sync_deals(date_from, date_to)
+        return self.deals_frame(date_from, date_to)
+
+    def _fetch_bars(self, symbol):
+        def fetch(t_from, t_to):
+            rates = self._rates_range(symbol, self.timeframe, datetime.utcfromtimestamp(t_from),
+                                      datetime.utcfromtimestamp(t_to))
+            if rates is None:
+                logging.warning(f'No bars of {symbol} returned, bars cached till {self.bar_table(symbol).end} are used')
+                return None
+            return {name: rates[name] for name in RATE_DTYPE.names}
+        return fetch
+
+    def sync_bars(self, symbol, date_from, date_to):
+        """Cache M1 bars of `symbol` from `date_from` to `date_to`, only the ones not cached yet are fetched
+
+        Returns:
+            int: number of bars added, None if mt5 failed
+        """
+        # Up to the last closed bar
+        t_to = min(to_sec(date_to), to_sec(self.now()) // BAR_SEC * BAR_SEC - 1)
+        fetch = None if self._rates_range is None else self._fetch_bars(symbol)
+        return self._sync(self.bar_table(symbol), fetch, 'time', to_sec(date_from), t_to)
+
+    def bars(self, symbol, date_from, date_to, columns=None):
+        """Cached M1 bars of `symbol` opened from `date_from` to `date_to` as views
+
+        Returns:
+            dict: arrays by column of `RATE_DTYPE`, e.g. `bars['close']`
+        """
+        return self.bar_table(symbol).read(to_sec(date_from), to_sec(date_to), columns)
+
+    def rates(self, symbol, date_from, date_to):
+        """Sync then read M1 bars of `symbol`, see `bars`"""
+        self.sync_bars(symbol, date_from, date_to)
+        return self.bars(symbol, date_from, date_to)
+
+    def bars_frame(self, symbol, date_from, date_to):
+        """Cached M1 bars of `symbol` as a dataframe indexed by time, columns are views of the cache"""
+        bars = self.bars(symbol, date_from, date_to)
+        return pd.DataFrame(bars, index=pd.to_datetime(bars['time'], unit='s'), copy=False)
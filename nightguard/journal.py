@@ -0,0 +1,174 @@
+import json
+import os
+from datetime import date, datetime
+from pathlib import Path
+from threading import Event, Lock, Thread
+
+from . import logging
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return {'$dt': obj.isoformat()}
+    if isinstance(obj, date):
+        return obj.isoformat()
+    # numpy and pandas scalars
+    if hasattr(obj, 'item'):
+        return obj.item()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def _object_hook(obj):
+    if len(obj) == 1 and '$dt' in obj:
+        return datetime.fromisoformat(obj['$dt'])
+    return obj
+
+
+class NightState:
+    """State of a night rebuilt from the journal, see `Journal.replay`
+
+    Attributes:
+        armed (dict): last due time of the tasks armed, by rule key
+        fired (set): rule keys whose close task started
+        done (dict): StopT (HH:MM:SS) of the close task finished, by rule key
+        managed_pids (list): positions managed, in order
+        records (dict): fields recorded for the report, by position id
+        ended (bool): true if the report of the night was written
+        events (int): number of events of the night
+    """
+
+    def __init__(self):
+        self.armed = {}
+        self.fired = set()
+        self.done = {}
+        self.managed_pids = []
+        self.records = {}
+        self.ended = False
+        self.events = 0
+
+    @property
+    def in_flight(self):
+        """Rule keys whose close task started and did not finish"""
+        return self.fired - set(self.done)
+
+    def apply(self, event):
+        kind = event['event']
+        self.events += 1
+        if kind == 'arm':
+            self.armed[event['rule']] = event['due']
+        elif kind == 'fire':
+            self.fired.add(event['rule'])
+            self.done.pop(event['rule'], None)
+        elif kind == 'managed':
+            known = set(self.managed_pids)
+            self.managed_pids += [pid for pid in event['pids'] if pid not in known]
+        elif kind == 'record':
+            self.records.setdefault(event['pid'], {}).update(event['fields'])
+        elif kind == 'done':
+            self.done[event['rule']] = event['stop_time']
+        elif kind == 'end':
+            self.ended = True
+
+
+class Journal:
+    """Append-only journal of a night, to rebuild it after a crash or restart
+
+    Events are JSON lines starting with the night date, written when they happen
+    and fsynced by a background thread at most every `sync_sec` seconds, so a
+    burst of closes costs one fsync instead of one per position. Replaying a night
+    skips lines of other nights by their prefix, without parsing them.
+
+    Once the report of a night is written the journal is truncated, so it holds
+    a night at most and recovery stays in milliseconds however long NightGuard runs.
+
+    Example:
+        journal = Journal(PAK_DIR / 'Journal.jsonl').start()
+        journal.append(night_date, 'fire', rule='EURUSD')
+        state = journal.replay(night_date)
+
+    Args:
+        path (str or Path): path of the journal file, created if not exists
+        sync_sec (float, optional): max seconds between fsyncs, 0 fsyncs every event. Defaults to 0.05.
+    """
+
+    SYNC_SEC = 0.05
+
+    def __init__(self, path, sync_sec=SYNC_SEC):
+        self.path = Path(path)
+        self.sync_sec = sync_sec
+        self._lock = Lock()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._dirty = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        """Start the fsync thread, returns self"""
+        if self.sync_sec > 0 and self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='Journal', daemon=True)
+            self._thread.start()
+        return self
+
+    def append(self, night_date, event, **fields):
+        """Append an `event` of the night `night_date`, with JSON serializable `fields`"""
+        line = json.dumps({'night': night_date.isoformat(), 'event': event, **fields}, default=_default) + '\n'
+        with self._lock:
+            self._file.write(line)
+            if self.sync_sec <= 0 or self._thread is None:
+                self._sync()
+                return
+        self._dirty.set()
+
+    def sync(self):
+        """Flush and fsync the events appended so far"""
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._dirty.wait()
+            self._dirty.clear()
+            try:
+                self.sync()
+            except (OSError, ValueError) as e:
+                logging.warning(f'Syncing journal {self.path.name} failed: {e}')
+            self._stop.wait(self.sync_sec)
+
+    def replay(self, night_date):
+        """Rebuild the `NightState` of `night_date` from the events on disk"""
+        state = NightState()
+        prefix = json.dumps({'night': night_date.isoformat()})[:-1]
+        self.sync()
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if not line.startswith(prefix):
+                    continue
+                try:
+                    state.apply(json.loads(line, object_hook=_object_hook))
+                except ValueError:
+                    # A line cut by a crash while writing
+                    logging.warning(f'Skip broken line of journal {self.path.name}: {line[:80]!r}')
+        return state
+
+    def truncate(self):
+        """Drop all events, once the night they belong to is reported"""
+        with self._lock:
+            self._file.truncate(0)
+            self._sync()
+
+    def close(self):
+        """Stop the fsync thread and sync the last events"""
+        self._stop.set()
+        self._dirty.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
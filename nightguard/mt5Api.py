@@ -1,20 +1,57 @@
 
 from logging import log
+import sys
 import warnings
 
 warnings.filterwarnings('ignore')
 
 from datetime import time, datetime, timedelta
-from time import sleep
-from queue import Queue, PriorityQueue
+from time import sleep, perf_counter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from threading import Thread
 from pathlib import Path
 from configobj import ConfigObj
 
 import MetaTrader5 as mt5 
+import numpy as np
 import pandas as pd 
 
 from . import PAK_DIR, logging
+from .scheduler import TaskScheduler
+from .brokerClock import BrokerClock
+from .barStream import BarStream, RATE_DTYPE
+from .tickCapture import TickCapture
+from .positionStore import PositionStore
+from .dealBook import DealBook
+from .historyCache import HistoryCache
+from .terminal import Terminal
+from .terminalReplay import TerminalRecorder
+from .sessionCalendar import SessionCalendar, parse_holidays
+from .telemetry import timed, TERMINAL_CALL, CLOSE_LATENCY, ORDER_RETCODES, CLOSE_RETRIES, CLOSE_FAILURES
+
+
+CloseResult = namedtuple(
+    'CloseResult',
+    ['position_id', 'symbol', 'ok', 'retcode', 'latency', 'status', 'attempts', 'remaining', 'time_to_flat'],
+    defaults=('flat', 1, 0.0, None),
+)
+CloseResult.__doc__ = """Outcome of closing a position
+
+`retcode` and `latency` (seconds of the `order_send` round-trip) are of the last order,
+`status` is 'flat', 'rejected' or 'deadline', `remaining` the volume left open, and
+`time_to_flat` the seconds till flat from the start of the close, None if not flat.
+"""
+
+# Retcodes, see: https://www.mql5.com/en/docs/constants/errorswarnings/enum_trade_return_codes
+# Filled, fully (DONE) or partially (DONE_PARTIAL)
+FILLED_RETCODES = {10009, 10010}
+# Worth resending: requote, rejected, timeout, invalid price, price changed,
+# off quotes, too many requests, no connection, orders frozen
+RETRYABLE_RETCODES = {10004, 10006, 10012, 10015, 10020, 10021, 10024, 10031, 10029}
+# The position is already closed
+POSITION_CLOSED_RETCODE = 10036
 
 
 class MT5Api:
@@ -27,6 +64,14 @@ class MT5Api:
         get_market_open_dt: returns `datetime` of market open for current week
     """
 
+    # Age of the last EURUSD tick beyond which the market is taken as closed
+    TICK_STALE_SEC = 120
+
+    # Seconds a close keeps retrying, and backoff between retries
+    CLOSE_DEADLINE_SEC = 30.0
+    RETRY_BACKOFF_SEC = 0.05
+    RETRY_BACKOFF_MAX_SEC = 0.5
+
     @staticmethod
     def get_market_close_dt(min_before=2):
         """returns `datetime`(Broker GMT) of market for current week, shifted by `min_before`
@@ -49,37 +94,114 @@ class MT5Api:
     @staticmethod
     def get_market_open_dt(min_after=0):
         '''Return dt of market open, If make comparison, required to request mt5 '''
-        return MT5Api.et_market_close_dt(min_before=-5-min_after) + timedelta(days=2)
+        return MT5Api.get_market_close_dt(min_before=-5-min_after) + timedelta(days=2)
 
 
-    def __init__(self, config_path=PAK_DIR/'Config.ini') -> None:
-        """Login to account and checking market time condition.
+    def __init__(self, config_path=PAK_DIR/'Config.ini', hour_shift=None, replay=None) -> None:
+        """Login to account and set the broker clock, without waiting for the market to open.
 
-        When initiaized, it logging first and check if its weekend, if it is, it promote
-        to user for manually input the gmt shift. then wait until market open.
+        The offset of broker time from UTC is `hour_shift` if given, else the one saved
+        by `calendar` the last time the market was open. If the market is open, the clock
+        is then set from EURUSD ticks. If it is closed and no offset is known, the user
+        is prompted for the hour shift when running in a terminal.
 
         Args:
             config_path (str, optional): path to Config.ini file. Defaults to PAK_DIR/'Config.ini'.
+            hour_shift (int, optional): hours of broker time ahead of UTC, used when market
+                is closed. Defaults to None, the last known offset, or prompts if stdin is a terminal
+                and raise otherwise.
+            replay (TerminalReplay, optional): recorded calls and virtual clock to run on instead of
+                the terminal, see `terminalReplay.replay`. Defaults to None.
         """
         if isinstance(config_path, str): config_path = Path(config_path)
-        self.conf = ConfigObj(config_path.as_posix())['Auth']
+        config = ConfigObj(config_path.as_posix())
+        self.conf = config['Auth']
+        self.replay = replay
+        self.recorder = None
+        self.terminal = self._terminal(config)
+        # Terminal calls of the components are timed, see `telemetry.TERMINAL_CALL`
+        self._symbol_info_tick = timed('symbol_info_tick', self.terminal.symbol_info_tick)
+        self._positions_get = timed('positions_get', self.terminal.positions_get)
+        self.position_store = PositionStore(self._positions_get)
+        self.history_cache = self._history_cache(config) if replay is None else None
+        if self.history_cache is None:
+            self.deal_book = DealBook(timed('history_deals_get', self.terminal.history_deals_get))
+        else:
+            self.deal_book = DealBook(self.history_cache.history_deals_get)
+        self.clock = BrokerClock(self._tick_time_msc) if replay is None else replay.clock
+        self.calendar = self._calendar(config)
+        self.bar_stream = BarStream(timed('copy_rates_from_pos', self.terminal.copy_rates_from_pos), mt5.TIMEFRAME_M1, self.clock)
+        self.tick_capture = TickCapture(self._symbol_info_tick, self.clock)
         self.login()
-        
-        if not self.check_market_is_open():
+
+        if hour_shift is not None:
+            self.clock.set_offset(timedelta(hours=int(hour_shift)))
+        elif self.calendar.offset is not None:
+            self.clock.set_offset(self.calendar.offset)
+        if self.check_market_is_open():
+            self.clock.sample()
+            self.calendar.offset = self.clock.offset
+        elif not self.clock.synced:
+            if not sys.stdin.isatty():
+                raise ValueError('Market is closed and no hour shift given, pass --hour-shift or NIGHTGUARD_HOUR_SHIFT')
             hour_shift = input(f'\n>>> Market is closed, please manually type the hour shift of your broker: ')
-            self._time_delta = timedelta(hours=int(hour_shift))
-            market_open_dt = self.get_market_open_dt()
-            delta_till_open = self.broker_time_local() - market_open_dt
-            logging.info(f'Current broker time: {self.broker_time_local()} Market open time {market_open_dt}')
-            logging.info(f'Sleeping {round(delta_till_open.seconds/3600, 2)} Hours and 10 secs..')
-            sleep(delta_till_open.seconds + 10)
-            logging.info(f'Woke up!')
-            self.__init__(config_path=config_path)
+            self.clock.set_offset(timedelta(hours=int(hour_shift)))
+        if self.recorder is not None:
+            self.recorder.broker_ns = self.clock.now_ns
+        # Samples are only taken while EURUSD trades, see `_tick_time_msc`
+        self.clock.start()
+        self._time_delta = self.clock.offset
+        logging.info(f'Hours difference between UTC time and Broker time is {self._time_delta.total_seconds() / 3600:g}')
+
+    def _terminal(self, config):
+        """`Terminal` calling mt5 from its own thread, or the module itself if TERMINAL_THREAD is 0
+
+        Calls are logged by a `TerminalRecorder` under RECORD_DIR, if set.
+        """
+        nightConf = config['NightSetting'] if 'NightSetting' in config else {}
+        module = mt5 if self.replay is None else self.replay.module
+        # Every terminal call is logged to a file under this directory, to replay the night
+        record_dir = nightConf['RECORD_DIR'] if 'RECORD_DIR' in nightConf else ''
+        if record_dir and self.replay is None:
+            root = Path(record_dir)
+            if not root.is_absolute():
+                root = PAK_DIR / root
+            path = root / f"{self.conf.get('login') or 'default'}_{datetime.utcnow():%Y%m%d_%H%M%S}.ngrec"
+            module = self.recorder = TerminalRecorder(mt5, path).start()
+            logging.info(f'Recording terminal calls to {path}')
+        # All mt5 calls run on one thread, orders first, identical queued reads once
+        if nightConf.as_bool('TERMINAL_THREAD') if 'TERMINAL_THREAD' in nightConf else True:
+            return Terminal(module).start()
+        return module
+
+    def _calendar(self, config):
+        """`SessionCalendar` of the account, next to the history cache"""
+        nightConf = config['NightSetting'] if 'NightSetting' in config else {}
+        # Dates the market is closed, no night is managed on them
+        holidays = parse_holidays(nightConf.as_list('HOLIDAYS')) if 'HOLIDAYS' in nightConf else set()
+        if self.replay is not None:
+            path = None
+        elif self.history_cache is not None:
+            path = self.history_cache.root / 'Sessions.json'
         else:
-            self._time_delta = self.broker_time - datetime.utcnow() 
-            hour_shift = round(self._time_delta.seconds / 3600)
-        logging.info(f'Hours difference between UTC time and Broker time is {hour_shift}')
-        
+            path = PAK_DIR / f"{self.conf.get('login') or 'default'}_Sessions.json"
+        return SessionCalendar(path, holidays, bars_fn=self.get_rates_range, now=lambda: self.broker_time_local)
+
+    def _history_cache(self, config):
+        """`HistoryCache` of the account under HISTORY_CACHE_DIR, None if it is empty"""
+        nightConf = config['NightSetting'] if 'NightSetting' in config else {}
+        # Deals and M1 bars are cached on disk under this directory, per login
+        cache_dir = nightConf['HISTORY_CACHE_DIR'] if 'HISTORY_CACHE_DIR' in nightConf else 'HistoryCache'
+        if not cache_dir:
+            return None
+        root = Path(cache_dir)
+        if not root.is_absolute():
+            root = PAK_DIR / root
+        return HistoryCache(root / (self.conf.get('login') or 'default'),
+                            timed('history_deals_get', self.terminal.history_deals_get),
+                            timed('copy_rates_range', self.terminal.copy_rates_range),
+                            mt5.TIMEFRAME_M1, now=lambda: self.broker_time_local)
+
     @property
     def TEST_MODE(self):
         """In TEST MODE, close/open positions are fobidend
@@ -91,12 +213,12 @@ class MT5Api:
 
     @property
     def broker_time_local(self):
-        """Returns broker time calculated locally
+        """Returns broker time calculated locally by `clock`, without calling mt5
 
         Returns:
             datetime: datetime of current calculated broker time 
         """
-        return self._time_delta + datetime.utcnow()
+        return self.clock.now()
 
     @property
     def broker_time(self):
@@ -105,9 +227,19 @@ class MT5Api:
         Returns:
             datetime: datetime of EURUSD 
         """
-        sec = mt5.symbol_info_tick('EURUSD').time
+        sec = self.terminal.symbol_info_tick('EURUSD').time
         return pd.to_datetime(sec, unit='s')
 
+    def _tick_time_msc(self):
+        """Returns time in ms of the last EURUSD tick, None if not available or stale"""
+        tick = self._symbol_info_tick('EURUSD')
+        if tick is None or not self._is_fresh(tick.time_msc):
+            return None
+        # The last tick before the market closed is not broker time
+        if self.clock.synced and not self.calendar.is_open('EURUSD', self.clock.now()):
+            return None
+        return tick.time_msc
+
     @property
     def cur_open_position_ids(self):
         """Returns current open positions IDs
@@ -120,30 +252,30 @@ class MT5Api:
 
     @property
     def cur_positions(self):
-        """Return current open positions
+        """Return current open positions of all symbols, each call fetches all from mt5.
+        Use `position_store` to look up positions of a symbol.
         """
         try:
-            return mt5.positions_get()
+            return self.terminal.positions_get()
         except:
-            logging.warning(f'Error when get current positions, mt5 error: {mt5.last_error()}')
+            logging.warning(f'Error when get current positions, mt5 error: {self.terminal.last_error()}')
             return []
 
 
     def login(self):
         """Login mt5 account, rase Error if not succeessed
         """
-        mt5.initialize(Path(self.conf['mt5_exe_path']).as_posix())
-        authorized=mt5.login(self.conf.as_int('login'), password=self.conf['password'], server=self.conf['server'])
+        self.terminal.initialize(Path(self.conf['mt5_exe_path']).as_posix())
+        authorized=self.terminal.login(self.conf.as_int('login'), password=self.conf['password'], server=self.conf['server'])
 
         if authorized: 
-            account_info=mt5.account_info() 
+            account_info=self.terminal.account_info() 
             if account_info!=None: 
-                account_info_dict = mt5.account_info()._asdict() 
+                account_info_dict = self.terminal.account_info()._asdict() 
                 for prop in account_info_dict: 
                     logging.info("  {}={}".format(prop, account_info_dict[prop])) 
-                print() 
         else: 
-            raise ValueError("Failed to connect to trade account error code =",mt5.last_error()) 
+            raise ValueError("Failed to connect to trade account error code =",self.terminal.last_error()) 
 
 
     def sec_to_dt(self, time_in_sec):
@@ -155,95 +287,243 @@ class MT5Api:
         return pd.to_datetime(time_in_sec, unit='s')
 
     def check_market_is_open(self):
-        """Return a bool value indicates is market open or not
+        """Return a bool value indicates is market open or not, without waiting
+
+        Once broker time is known (see `clock`) by the sessions of EURUSD in `calendar`,
+        before by the last EURUSD tick, which is fresh only while the market is open.
 
-        By checking the tick time of EURUSD in an interval of 5 seconds
-        
         Returns:
             bool: true for open, false for closed
         """
-        logging.info('Checking is market open... ')
-        t1 = mt5.symbol_info_tick('EURUSD').time
-        if pd.to_datetime(t1, unit='s').weekday() <= 4: 
-            return True
-        sleep(10)
-        t2 = mt5.symbol_info_tick('EURUSD').time
-        if (t1 == t2) and (t1.time() == time(23,54,59)):
-            logging.info(' Market is closed!')
+        if self.clock.synced:
+            now = self.broker_time_local
+            if self.calendar.is_open('EURUSD', now):
+                logging.info(f'Market is open, closes at {self.calendar.next_close("EURUSD", now)}')
+                return True
+            logging.info(f'Market is closed, opens at {self.calendar.next_open("EURUSD", now)}')
             return False
-        else:
-            logging.info(' Market is open!')
-            return True
+        tick = self._symbol_info_tick('EURUSD')
+        is_open = tick is not None and self._is_fresh(tick.time_msc)
+        logging.info(f'Market is {"open" if is_open else "closed"}')
+        return is_open
+
+    def _is_fresh(self, time_msc):
+        """True if a tick time is a whole or half hour ahead of UTC time, within `TICK_STALE_SEC`"""
+        lag_sec = time_msc / 1000 - (datetime.utcnow() - datetime(1970, 1, 1)).total_seconds()
+        if abs(lag_sec) > 14 * 3600 + self.TICK_STALE_SEC:
+            return False
+        return abs(lag_sec - round(lag_sec / 1800) * 1800) <= self.TICK_STALE_SEC
 
-    def get_price_to_close(self, position):
+    def get_price_to_close(self, position, tick=None):
         """Return the price if close the `position`
 
         Args:
             position (positon): position to close
+            tick (tick, optional): tick of the symbol with `bid` and `ask`. Defaults to requesting mt5.
         """
-        tick = mt5.symbol_info_tick(position.symbol)
+        if tick is None:
+            tick = self.terminal.symbol_info_tick(position.symbol)
         volume = position.volume if position.type == 0 else -position.volume
         ex_price = tick.bid if volume > 0 else tick.ask
         return ex_price
 
-    def get_bar(lb=10):
-        """Return M1 bar dataframe with `lb` looklack period. Index sorted by datetime
+    def get_bar(self, lb=10, symbol='EURUSD'):
+        """Return closed M1 bar dataframe with `lb` looklack period. Index sorted by datetime
+
+        Bars come from the ring buffer of `bar_stream`, only bars newer than the
+        cached ones are requested from mt5. Use `bar_stream.bars` for a numpy view.
 
         Args:
             lb (int, optional): look back period. Defaults to 10.
+            symbol (str, optional): symbol of bars. Defaults to 'EURUSD'.
 
         Returns:
             dataframe: bar dataframe indexed by broker time, with columns ['open', 'high', 'low', 'close]
         """
-        rates = mt5.copy_rates_from_pos("EURUSD", mt5.TIMEFRAME_M1, 0, lb+1) 
-        rates_frame = pd.DataFrame(rates) 
+        self.bar_stream.update(symbol)
+        rates_frame = pd.DataFrame(self.bar_stream.bars(symbol, lb)) 
         rates_frame.index = pd.to_datetime(rates_frame['time'], unit='s') 
         return rates_frame
 
+    def get_rates_range(self, symbol, date_from, date_to=None):
+        """Return M1 bars of `symbol` between two dates as a numpy array, e.g. for `StopBacktest`
+
+        With `history_cache`, only bars not cached yet are requested from mt5, and the
+        bars are returned as memory-mapped views of the cache, see `HistoryCache.rates`.
+
+        Args:
+            symbol (str): symbol of bars
+            date_from (str or datetime): broker time of the first bar
+            date_to (str or datetime, optional): broker time of the last bar. Defaults to broker time now.
+
+        Returns:
+            ndarray or dict: bars with fields time, open, high, low, close, tick_volume, spread, real_volume,
+                a dict of arrays by field with `history_cache`
+        """
+        if isinstance(date_from, str): date_from = pd.to_datetime(date_from)
+        if isinstance(date_to, str): date_to = pd.to_datetime(date_to)
+        if date_to is None: date_to = self.broker_time_local
+        if self.history_cache is not None:
+            return self.history_cache.rates(symbol, date_from, date_to)
+        rates = self.terminal.copy_rates_range(symbol, mt5.TIMEFRAME_M1, date_from, date_to)
+        if rates is None:
+            logging.warning(f'No bars of {symbol} returned, mt5 error: {self.terminal.last_error()}')
+            return np.zeros(0, dtype=RATE_DTYPE)
+        return rates
+
     def get_m1_timmer_Q(self):
         """
-        Start a thread that continuesly push a datetime object into a queue when 
-        a minute finished, The queue has size 1, with element of current datetime 
+        Start a thread that push a datetime object into a queue when a minute
+        finished, The queue has size 1, with element of current datetime 
         of M1 minute bar which can use as loc bars.
 
-        It makes sure the most recent 1 minute is finished. 
-        put the datetime into `q`, which has 0 seconds It runs indefinitely.
+        The thread sleeps till each minute boundary of `clock`, put the open
+        datetime of the minute just finished into `q`. It runs indefinitely.
+        Use `bar_stream.subscribe` to receive the closed bars themselves.
         """
         q = Queue(maxsize=1)
         def _m1_timmer(self, q):
             """target function of processing m1 bar minute"""
             while True:
-                last_minute = self.broker_time.time().minute
-                while True:
-                    cur_time = self.broker_time.time()
-                    second = cur_time.second
-                    if second < 2:
-                        sleep(57)
-
-                    cur_dt = self.broker_time 
-                    if  cur_dt.time().minute > last_minute:
-                        # cur minute has run at least 57 seconds. so its the most recent minute
-                        if cur_dt.second < 30: 
-                            full_dt = cur_dt.replace(minute=cur_dt.minute-1, second=0)
-                            
-                        else:
-                            full_dt = cur_dt.replace(second=0)
-                        q.put(full_dt)
-                        break
-        m1_timmer_T = Thread(target=_m1_timmer, args=(self, q,))
+                sleep(self.bar_stream.sec_till_next_minute() + self.bar_stream.grace)
+                cur_dt = self.broker_time_local
+                q.put(cur_dt.replace(second=0, microsecond=0) - timedelta(minutes=1))
+        m1_timmer_T = Thread(target=_m1_timmer, args=(self, q,), daemon=True)
         m1_timmer_T.start()
         return q
             
                 
-    def close_position(self, position, comment='NightGuard'):
-        """Close position with market order
+    def close_position(self, position, comment='NightGuard', deadline_sec=None):
+        """Close position with market order, retried till flat, see `close_until_flat`
 
         Args:
             position (MT5 Position): position object, which to close
+            comment (str, optional): order comment. Defaults to 'NightGuard'.
+            deadline_sec (float, optional): seconds to keep retrying. Defaults to `CLOSE_DEADLINE_SEC`.
 
         Returns:
             bool: indicates closed successfully or not
         """
+        return self.close_until_flat(position, comment, deadline_sec).ok
+
+    def close_positions(self, positions, comment='NightGuard', max_workers=8, deadline_sec=None):
+        """Close many positions concurrently with market orders
+
+        `order_send` blocks for a terminal round-trip, so the orders are submitted
+        through a pool of at most `max_workers` threads instead of one by one.
+        Set `max_workers` to 1 for terminals that reject concurrent requests.
+        On a `Terminal` the orders are still sent one by one, the pool only
+        overlaps the backoffs and reads of positions retrying. Each position is retried till flat or `deadline_sec`, see `close_until_flat`.
+
+        Args:
+            positions (list): MT5 positions to close
+            comment (str, optional): order comment. Defaults to 'NightGuard'.
+            max_workers (int, optional): max number of orders in flight. Defaults to 8.
+            deadline_sec (float, optional): seconds to keep retrying. Defaults to `CLOSE_DEADLINE_SEC`.
+
+        Returns:
+            tuple: (list of `CloseResult` in order of `positions`, time to flat in seconds)
+        """
+        assert not self.TEST_MODE, f'TEST MODE forbid close position!'
+        if len(positions) == 0:
+            return [], 0.0
+        t0 = perf_counter()
+        close = lambda pos: self.close_until_flat(pos, comment, deadline_sec, t0=t0)
+        if max_workers <= 1 or len(positions) == 1:
+            results = [close(pos) for pos in positions]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(positions)), thread_name_prefix='close') as pool:
+                results = list(pool.map(close, positions))
+        time_to_flat = perf_counter() - t0
+        return results, time_to_flat
+
+    def close_until_flat(self, position, comment='NightGuard', deadline_sec=None, t0=None):
+        """Send close orders for `position` till it is flat, or give up
+
+        After a fill (`DONE` or `DONE_PARTIAL`) the position is read again, and the
+        remaining volume of a partial fill is sent again right away. On a retryable
+        retcode (requote, price changed, off quotes, timeout, no connection...) the
+        position is read again and resent after a backoff starting at
+        `RETRY_BACKOFF_SEC`, doubling up to `RETRY_BACKOFF_MAX_SEC`. A failed read of the
+        position is retried with the same backoff, it is only flat once mt5 returns no
+        position for it. It gives up on
+        other retcodes, or when the next attempt would start after `deadline_sec`.
+
+        Args:
+            position (MT5 Position): position to close
+            comment (str, optional): order comment. Defaults to 'NightGuard'.
+            deadline_sec (float, optional): seconds to keep retrying. Defaults to `CLOSE_DEADLINE_SEC`.
+            t0 (float, optional): `perf_counter` the close started, e.g. the task. Defaults to now.
+
+        Returns:
+            CloseResult: with `status` 'flat', 'rejected' or 'deadline'
+        """
+        assert not self.TEST_MODE, f'TEST MODE forbid close position!'
+        t0 = perf_counter() if t0 is None else t0
+        end = t0 + (self.CLOSE_DEADLINE_SEC if deadline_sec is None else deadline_sec)
+        pid, symbol = position.identifier, position.symbol
+        backoff = self.RETRY_BACKOFF_SEC
+        attempts = 0
+        while True:
+            retcode, latency = self._send_close(position, comment)
+            attempts += 1
+            if retcode in FILLED_RETCODES or retcode in RETRYABLE_RETCODES or retcode is None:
+                positions, backoff = self._read_position(pid, end, backoff)
+                if positions is None:
+                    logging.error(f"  Position {pid} could not be read before the deadline, "
+                                  f"{attempts} attempts, last retcode={retcode}")
+                    CLOSE_FAILURES.labels(symbol, 'deadline').inc()
+                    return CloseResult(pid, symbol, False, retcode, latency, 'deadline', attempts, position.volume, None)
+                if len(positions) == 0:
+                    return CloseResult(pid, symbol, True, retcode, latency, 'flat', attempts, 0.0, perf_counter() - t0)
+                position = positions[0]
+                if retcode in FILLED_RETCODES:
+                    wait = 0.0
+                    logging.warning(f'  Position {pid} partially closed, {position.volume} lots remaining, resending')
+                else:
+                    wait, backoff = backoff, min(backoff * 2, self.RETRY_BACKOFF_MAX_SEC)
+                    logging.warning(f'  Position {pid} close retcode={retcode}, retrying in {wait*1000:.0f}ms')
+            elif retcode == POSITION_CLOSED_RETCODE:
+                return CloseResult(pid, symbol, True, retcode, latency, 'flat', attempts, 0.0, perf_counter() - t0)
+            else:
+                if retcode == 10027:
+                    logging.warning(f'AutoTrading disabled!')
+                logging.error(f"  order_send failed for position {pid}, retcode={retcode}, not retryable")
+                CLOSE_FAILURES.labels(symbol, 'rejected').inc()
+                return CloseResult(pid, symbol, False, retcode, latency, 'rejected', attempts, position.volume, None)
+            if perf_counter() + wait >= end:
+                logging.error(f"  Position {pid} not flat after {attempts} attempts, deadline reached, "
+                              f"{position.volume} lots remaining, last retcode={retcode}")
+                CLOSE_FAILURES.labels(symbol, 'deadline').inc()
+                return CloseResult(pid, symbol, False, retcode, latency, 'deadline', attempts, position.volume, None)
+            CLOSE_RETRIES.labels(symbol).inc()
+            if wait > 0:
+                sleep(wait)
+
+    def _read_position(self, pid, end, backoff):
+        """Read the open position `pid` from mt5, retrying failed reads with backoff till `end`
+
+        `positions_get` returns None when the read failed, e.g. when disconnected, which says
+        nothing about the position, and an empty tuple when it is closed.
+
+        Returns:
+            tuple: (positions, backoff), positions is empty if `pid` is closed, None if no read
+                succeeded before `end`
+        """
+        positions = self._positions_get(ticket=pid)
+        while positions is None and perf_counter() + backoff < end:
+            logging.warning(f'  Position {pid} could not be read, mt5 error: {self.terminal.last_error()}, '
+                            f'retrying in {backoff*1000:.0f}ms')
+            sleep(backoff)
+            backoff = min(backoff * 2, self.RETRY_BACKOFF_MAX_SEC)
+            positions = self._positions_get(ticket=pid)
+        return positions, backoff
+
+    def _send_close(self, position, comment):
+        """Send one market order closing the volume of `position`, returns (retcode, latency)
+
+        retcode is None if the terminal returned no result, e.g. when disconnected.
+        """
         assert not self.TEST_MODE, f'TEST MODE forbid close position!'
         request={ 
             "action": mt5.TRADE_ACTION_DEAL, 
@@ -257,66 +537,42 @@ class MT5Api:
             "type_filling": mt5.ORDER_FILLING_IOC, 
         } 
         # send a trading request 
-        result=mt5.order_send(request)
-        
-        if result.retcode != mt5.TRADE_RETCODE_DONE:
-            if result.retcode == 10027:
-                logging.warn(f'AutoTrading disabled!')
-            logging.error(f"  order_send failed, retcode={result.retcode}") 
-            print(result)
-            return False
-        else:
-            #self.trigger_closed_positions += [position]
-            return True
-
+        t0 = perf_counter()
+        result=self.terminal.order_send(request)
+        latency = perf_counter() - t0
+        retcode = None if result is None else result.retcode
+        TERMINAL_CALL.labels('order_send').observe(latency)
+        CLOSE_LATENCY.labels(position.symbol).observe(latency)
+        ORDER_RETCODES.labels(str(retcode)).inc()
+        if retcode not in FILLED_RETCODES:
+            logging.debug(f"  order_send of position {position.identifier}: {result if result is not None else self.terminal.last_error()}")
+        return retcode, latency
 
-        
     def get_timmer_Qs(self):
         '''
         It schedules datetime priortized tasks. Useful for time based actions. 
         A thread runs infidinitely when calling.
 
-        It uses two queues, a PriortyQueue for put tasks which has time order,
-        a normal FIFO queue for get the task. The out put task always get in 
-        time order.
+        Returns a `TaskScheduler` for put tasks which has time order, and a normal 
+        FIFO queue for get the task. The out put task always get in time order,
+        and is fired at broker time (calculated locally) of the task.
         
-        pq is a PriortyQueue, element of it is a two length tuple, where the 
-        first element needs to be datetime type, the second is a dict specifies
-        the task type.
+        Element put into scheduler is a two length tuple, where the first element
+        needs to be datetime type, the second is a dict specifies the task type.
+        `put` returns a handle which can be cancelled or rescheduled.
         
         Example:
-            pq.put((pd.to_datetime('2021-2-1'), {'task': 'close'})) # 3rd,
-            pq.put((pd.to_datetime('2021-2-1'), {'task': 'close'})) # 2nd, 
+            pq.put((pd.to_datetime('2021-2-1'), {'task': 'close'})) # 2nd,
+            pq.put((pd.to_datetime('2021-2-1'), {'task': 'close'})) # 3rd, 
             pq.put((pd.to_datetime('2021-1-1'), {'task': 'news'})) #1st
             pq.put((pd.to_datetime('2021-5-1'), {'task': 'weekend'})) # last
+
+        Returns:
+            tuple: (TaskScheduler, Queue)
         '''
-        pq_in = PriorityQueue()
-        q_out = Queue()
-        
-        def _get_and_wait(pq_in, q_out):
-            while True:
-                (task_dt, task) = pq_in.get()
-                # Calculate the wait time
-                cur_dt = self.broker_time_local
-                
-                if cur_dt > task_dt:
-                    overdue_sec = (cur_dt - task_dt).seconds
-                    logging.warn(f'Task {task} overdue!')
-                    if overdue_sec >= 5*60:
-                        logging.warn(f'  Skip: overdue {overdue_sec}s, should be excuded at {task_dt}, but now is {cur_dt}')
-                        continue
-                    else:
-                        # Excute immediately
-                        logging.warn(f'  Excute: overdue {overdue_sec}s')
-                        q_out.put((task_dt, task))
-                else:
-                    wait_sec = (task_dt - cur_dt).seconds - 1 # Extra 1s conpensate the excution time
-                    logging.debug(f'{task} wait to be excuted. Wait seconds {wait_sec}')
-                    sleep(max(wait_sec, 0))
-                    q_out.put((task_dt, task))
-        t = Thread(target=_get_and_wait, args=(pq_in, q_out,))
-        t.start()
-        return pq_in, q_out
+        self.scheduler = TaskScheduler(self.clock)
+        self.scheduler.start()
+        return self.scheduler, self.scheduler.q_out
 
     def get_history_positions(self, date_from, date_to=None):
         """        Return positions dataframe indexed by position id, columns are:
@@ -328,9 +584,15 @@ class MT5Api:
         for `reason` >= 3 are excuted by EA, actual description 
         see: https://www.mql5.com/en/docs/constants/tradingconstants/dealproperties
 
+        Only closed positions entered and exited within the range are returned,
+        positions with partial closes are aggregated, see `reconstruct_positions`.
+        Deals are fetched incrementally by `deal_book`, so repeated calls only
+        fetch deals newer than the last call. With `history_cache` they are read from
+        disk, only deals newer than the cached ones are requested from mt5.
+
         Args:
             date_from (str or datetime): date for start of history
-            date_to (str or datetime, optional): date for end of history. Defaults to today.
+            date_to (str or datetime, optional): date for end of history. Defaults to broker time now.
 
         Returns:
             dataframe: retrieved histoies.
@@ -338,47 +600,8 @@ class MT5Api:
 
         if isinstance(date_from, str): date_from = pd.to_datetime(date_from)
         if isinstance(date_to, str): date_to = pd.to_datetime(date_to)
-        if date_to is None: date_to = self.broker_time()
-        position_deals = mt5.history_deals_get(date_from, date_to)
-        deals_df = pd.DataFrame(list(position_deals),columns=position_deals[0]._asdict().keys()) 
-
-        # Filt out non buy and sell deals
-        deals_df = deals_df[deals_df.type.isin([0,1])]
-        deals_df['time'] = pd.to_datetime(deals_df.time, unit='s')
-
-        # Select deals with only closed positions
-        pid_size = deals_df.groupby('position_id').size()
-        closed_pids = pid_size[pid_size==2].index
-        deals_df = deals_df[deals_df.position_id.isin(closed_pids)]
-
-        rename_cols = {
-            'time': 'En_Time',
-            'price': 'En_Price',
-            'reason': 'en_reason',
-            'commission': 'en_comm'
-        }
-        deal_in = deals_df[deals_df.entry==0]
-        deal_in['type'] *= -1
-        deal_in.loc[deal_in.type==0, 'type'] = 1
-        deal_in['Volume'] = deal_in.volume * deal_in.type
-        deal_in.rename(columns=rename_cols, inplace=True)
-        deal_in.index = deal_in.position_id
-        deal_in = deal_in[['En_Time', 'En_Price', 'Volume', 'symbol', 'en_comm', 'magic', 'comment', 'en_reason']]
-        
-        rename_cols = {
-            'time': 'Ex_Time',
-            'price': 'Ex_Price',
-            'reason': 'ex_reason',
-            'commission': 'ex_comm'
-        }
-        deal_out = deals_df[deals_df.entry==1]
-        deal_out.rename(columns=rename_cols, inplace=True)
-        deal_out.index = deal_out.position_id
-        deal_out = deal_out[['Ex_Time', 'Ex_Price', 'profit', 'ex_comm', 'swap', 'ex_reason']]
-        deal_out.head()
-
-        positions = deal_in.join(deal_out)
-        positions['commision'] = positions.en_comm + positions.ex_comm
-        positions.drop(columns=['en_comm', 'ex_comm'], inplace=True)
+        if date_to is None: date_to = self.broker_time_local
+        self.deal_book.sync(date_from, date_to)
+        positions = self.deal_book.between(date_from, date_to)
         logging.debug(f'{len(positions)} positions retrieved from mt5, dt range {date_from} - {date_to}')
-        return positions
\ No newline at end of file
+        return positions
@@ -0,0 +1,181 @@
+import importlib
+import json
+import math
+import multiprocessing as mp
+import os
+import sys
+import time
+import traceback
+from pathlib import Path
+from queue import Empty
+
+import pandas as pd
+from configobj import ConfigObj
+
+from . import logging, PAK_DIR
+from .reportStore import append_csv
+
+
+def account_name(config_path):
+    """Name of the account of a Config.ini, its login or the file name if login is empty"""
+    conf = ConfigObj(Path(config_path).as_posix())['Auth']
+    login = str(conf.get('login', '')).strip()
+    return login or Path(config_path).stem
+
+
+def run_account(config_path, report_fn_prefix, nights, hour_shift, send):
+    """Worker target, runs NightGuard on one account and sends each night's result by `send`"""
+    from .runner import run
+
+    # Fired and skipped tasks of the scheduler before tonight
+    n_fired, n_skipped = [0], [0]
+
+    def on_night(tonight, positions):
+        scheduler = tonight.mt5.scheduler
+        # Infinite until broker time was sampled, not valid JSON
+        error_bound = tonight.mt5.clock.error_bound()
+        lateness = scheduler.lateness[n_fired[0]:]
+        n_fired[0] = len(scheduler.lateness)
+        skipped = scheduler.skipped[n_skipped[0]:]
+        n_skipped[0] = len(scheduler.skipped)
+        send({
+            'event': 'night',
+            'night_date': str(tonight.tonight_date),
+            'positions': positions,
+            'metrics': {
+                'positions': len(positions),
+                'profit': float(positions.profit.sum()) if len(positions) else 0.0,
+                'tasks_fired': len(lateness),
+                'tasks_skipped': len(skipped),
+                'lateness_max_sec': max(lateness) if lateness else None,
+                'clock_error_bound_sec': error_bound if math.isfinite(error_bound) else None,
+            },
+        })
+
+    run(config_path, report_fn_prefix, nights=nights, on_night=on_night, hour_shift=hour_shift)
+
+
+def _worker(target, account, args, backend, log_level, result_q):
+    """Entry of a worker process, `MetaTrader5` binds one terminal per process"""
+    from .cli import configure_logging
+    configure_logging(log_level)
+    if backend != 'MetaTrader5':
+        sys.modules['MetaTrader5'] = importlib.import_module(backend)
+
+    def send(msg):
+        result_q.put(dict(msg, account=account, pid=os.getpid(), time=time.time()))
+
+    send({'event': 'started'})
+    try:
+        target(*args, send)
+        send({'event': 'exit'})
+    except Exception:
+        send({'event': 'error', 'error': traceback.format_exc()})
+
+
+class Supervisor:
+    """Runs many accounts, one worker process per account
+
+    Workers are started `stagger_sec` apart and at most `max_terminals` run at the
+    same time, the others wait for a slot. Workers running indefinitely never free
+    their slot, so without `nights` there can be no more accounts than `max_terminals`. Each worker runs its own `MT5Api`, scheduler
+    and `Tonight`, and sends its nights over a queue. The supervisor appends them to a
+    consolidated report with an `account` column, and their metrics to a JSONL file.
+
+    Example:
+        Supervisor(['acc1/Config.ini', 'acc2/Config.ini'], max_terminals=2).run()
+
+    Args:
+        config_paths (list): Config.ini of each account
+        max_terminals (int, optional): max number of workers at the same time. Defaults to 4.
+        stagger_sec (float, optional): seconds between worker starts. Defaults to 5.
+        nights (int, optional): nights each worker runs. Defaults to None, runs indefinitely.
+        hour_shift (int, optional): broker hours ahead of UTC of every account if started while
+            market is closed, see `MT5Api`. Defaults to None.
+        backend (str, optional): module imported as `MetaTrader5` in workers, e.g. a fake
+            for testing. Defaults to 'MetaTrader5'.
+        log_level (str, optional): log level of workers. Defaults to 'INFO'.
+        worker (callable, optional): picklable target `(config_path, report_fn_prefix, nights, hour_shift, send)`.
+            Defaults to `run_account`.
+        report_path (str or Path, optional): consolidated report. Defaults to `Accounts_PositionReport.csv`.
+        metrics_path (str or Path, optional): metrics file. Defaults to `Accounts_Metrics.jsonl`.
+    """
+
+    MAX_TERMINALS = 4
+    STAGGER_SEC = 5.0
+
+    def __init__(self, config_paths, max_terminals=MAX_TERMINALS, stagger_sec=STAGGER_SEC, nights=None, hour_shift=None,
+                 backend='MetaTrader5', log_level='INFO', worker=run_account,
+                 report_path=PAK_DIR / 'Accounts_PositionReport.csv', metrics_path=PAK_DIR / 'Accounts_Metrics.jsonl'):
+        self.accounts = [(account_name(p), Path(p)) for p in config_paths]
+        if nights is None and len(self.accounts) > max_terminals:
+            raise ValueError(f'{len(self.accounts)} accounts running indefinitely need as many terminals, '
+                             f'max_terminals is {max_terminals}')
+        self.max_terminals = max_terminals
+        self.stagger_sec = stagger_sec
+        self.nights = nights
+        self.hour_shift = hour_shift
+        self.backend = backend
+        self.log_level = log_level
+        self.worker = worker
+        self.report_path = Path(report_path)
+        self.metrics_path = Path(metrics_path)
+        self.messages = []
+
+        # spawn, same as on Windows, so workers never share a terminal connection
+        self._ctx = mp.get_context('spawn')
+
+    def run(self):
+        """Run all accounts till their workers exit, returns metrics of every night"""
+        result_q = self._ctx.Queue()
+        pending = list(self.accounts)
+        running = {}
+        next_start = 0.0
+        while pending or running:
+            if pending and len(running) < self.max_terminals and time.monotonic() >= next_start:
+                name, config_path = pending.pop(0)
+                args = (config_path.as_posix(), name, self.nights, self.hour_shift)
+                proc = self._ctx.Process(
+                    target=_worker, args=(self.worker, name, args, self.backend, self.log_level, result_q),
+                    name=f'NightGuard-{name}',
+                )
+                proc.start()
+                running[name] = proc
+                next_start = time.monotonic() + self.stagger_sec
+                logging.info(f'Started worker of account {name}, pid {proc.pid}')
+            self._drain(result_q, timeout=0.1)
+            for name, proc in list(running.items()):
+                if not proc.is_alive():
+                    proc.join()
+                    del running[name]
+                    logging.info(f'Worker of account {name} exited with code {proc.exitcode}')
+        self._drain(result_q, timeout=0)
+        return [m for m in self.messages if m['event'] == 'night']
+
+    def _drain(self, result_q, timeout):
+        while True:
+            try:
+                msg = result_q.get(timeout=timeout)
+            except Empty:
+                return
+            self._on_message(msg)
+            timeout = 0
+
+    def _on_message(self, msg):
+        account, event = msg['account'], msg['event']
+        if event == 'error':
+            logging.error(f'Worker of account {account} failed:\n{msg["error"]}')
+        elif event == 'night':
+            positions = msg.pop('positions')
+            if len(positions):
+                positions = positions.copy()
+                positions.insert(0, 'account', account)
+                positions.insert(1, 'night_date', msg['night_date'])
+                if not append_csv(self.report_path, positions):
+                    # Columns new to the report, e.g. ST-* of a TEST mode account, rewrite it once
+                    report = pd.read_csv(self.report_path.as_posix(), index_col=0)
+                    pd.concat([report, positions]).to_csv(self.report_path.as_posix(), index=True)
+            with open(self.metrics_path, 'a') as f:
+                f.write(json.dumps({'account': account, 'night_date': msg['night_date'], **msg['metrics']}) + '\n')
+            logging.info(f'Account {account} night {msg["night_date"]}: {msg["metrics"]}')
+        self.messages.append(msg)
@@ -0,0 +1,152 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+from threading import RLock
+from time import monotonic
+
+from . import logging
+
+
+class PositionStore:
+    """Snapshot of open positions indexed by (symbol, magic)
+
+    Positions of each (symbol, magic) key are kept sorted by open time (seconds
+    since 1970-1-1, as given by MT5), so a closing task resolves its targets by
+    a dict lookup and a bisect, in O(matches) instead of scanning every open position.
+
+    The snapshot is refreshed per symbol with `positions_get(symbol=...)` and merged
+    by ticket diff, a refresh within `ttl` seconds of the last one is skipped.
+    Symbols may be refreshed and matched from several threads at the same time.
+
+    Example:
+        store = PositionStore(mt5.positions_get)
+        store.refresh('EURUSD')
+        positions = store.match('EURUSD', magics=[2, 3], since=1633129200)
+
+    Args:
+        positions_get (callable): `MetaTrader5.positions_get`
+        ttl (float, optional): seconds a snapshot is considered fresh. Defaults to 0.5.
+        clock (callable, optional): monotonic seconds. Defaults to `time.monotonic`.
+    """
+
+    TTL = 0.5
+
+    def __init__(self, positions_get, ttl=TTL, clock=monotonic):
+        self._positions_get = positions_get
+        self.ttl = ttl
+        self._clock = clock
+
+        self._by_id = {}
+        # (symbol, magic) -> sorted list of (open time, position id)
+        self._index = defaultdict(list)
+        self._magics = defaultdict(set)
+        self._fetched_at = {}
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, position_id):
+        return position_id in self._by_id
+
+    def get(self, position_id):
+        return self._by_id.get(position_id)
+
+    def is_fresh(self, symbol=None):
+        """Returns true if `symbol` (or all symbols if None) was fetched within `ttl`"""
+        now = self._clock()
+        for key in (None, symbol):
+            fetched_at = self._fetched_at.get(key)
+            if fetched_at is not None and now - fetched_at <= self.ttl:
+                return True
+        return False
+
+    def refresh(self, symbol=None, force=False):
+        """Fetch open positions of `symbol` (all symbols if None) and merge them
+
+        Args:
+            symbol (str, optional): symbol to refresh. Defaults to all symbols.
+            force (bool, optional): refresh even if the snapshot is fresh. Defaults to False.
+
+        Returns:
+            bool: true if the terminal was called successfully
+        """
+        if not force and self.is_fresh(symbol):
+            return True
+        fetched_at = self._clock()
+        try:
+            positions = self._positions_get() if symbol is None else self._positions_get(symbol=symbol)
+        except Exception as e:
+            logging.warning(f'Error when get current positions: {e}')
+            positions = None
+        if positions is None:
+            logging.warning(f'Failed to refresh positions of {symbol or "all symbols"}, keep the old snapshot')
+            return False
+
+        fresh = {pos.identifier: pos for pos in positions}
+        with self._lock:
+            if symbol is None:
+                stale_ids = [pid for pid in self._by_id if pid not in fresh]
+            else:
+                stale_ids = [
+                    pid for magic in self._magics.get(symbol, ())
+                    for _, pid in self._index[(symbol, magic)] if pid not in fresh
+                ]
+            self.discard(stale_ids)
+            for pos in fresh.values():
+                self._upsert(pos)
+            self._fetched_at[symbol] = fetched_at
+        return True
+
+    def discard(self, position_ids):
+        """Remove positions from the snapshot, e.g. once they have been closed"""
+        with self._lock:
+            for pid in position_ids:
+                pos = self._by_id.pop(pid, None)
+                if pos is None:
+                    continue
+                key = (pos.symbol, pos.magic)
+                rows = self._index[key]
+                i = bisect_left(rows, (pos.time, pid))
+                if i < len(rows) and rows[i][1] == pid:
+                    del rows[i]
+                if not rows:
+                    del self._index[key]
+                    self._magics[pos.symbol].discard(pos.magic)
+
+    def symbols(self):
+        """Symbols with open positions in the snapshot"""
+        with self._lock:
+            return [symbol for symbol, magics in self._magics.items() if magics]
+
+    def match(self, symbol, magics=None, since=None):
+        """Return open positions of `symbol` with magic in `magics` opened at or after `since`
+
+        Args:
+            symbol (str): symbol of positions
+            magics (iterable, optional): magic numbers, None matches all. Defaults to None.
+            since (int, optional): open time in seconds since 1970-1-1. Defaults to None.
+
+        Returns:
+            list: matched positions ordered by magic then open time
+        """
+        with self._lock:
+            known = self._magics.get(symbol, ())
+            keys = known if magics is None else [m for m in set(magics) if m in known]
+            matched = []
+            for magic in sorted(keys):
+                rows = self._index[(symbol, magic)]
+                start = 0 if since is None else bisect_left(rows, (since, float('-inf')))
+                matched += [self._by_id[pid] for _, pid in rows[start:]]
+            return matched
+
+    def _upsert(self, pos):
+        old = self._by_id.get(pos.identifier)
+        if old is not None:
+            if (old.symbol, old.magic, old.time) == (pos.symbol, pos.magic, pos.time):
+                # Only volume, price, profit etc. changed, keep the index
+                self._by_id[pos.identifier] = pos
+                return
+            self.discard([pos.identifier])
+        self._by_id[pos.identifier] = pos
+        insort(self._index[(pos.symbol, pos.magic)], (pos.time, pos.identifier))
+        self._magics[pos.symbol].add(pos.magic)
@@ -0,0 +1,279 @@
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+from . import logging
+from .dealBook import POSITION_COLUMNS
+
+
+class ReportStore:
+    """Position reports kept in a local SQLite table, appended night by night.
+
+    Each row is a position of a night, keyed by (position_id, night_date) and indexed
+    on night date and (symbol, magic), so appending a night costs O(new rows) and
+    queries of a date, symbol or magic range don't load the whole history.
+    Columns not seen before (e.g. `ST-profit` in TEST mode) are added on the fly.
+
+    A rollup table keeps totals by night, symbol and magic: positions, profit, swap
+    and commission, and for positions with an `ST-profit` (closed or recorded at
+    StopT) their count, ST profit, the swap avoided and the difference of the ST
+    profit to the actual profit and swap. It is updated by `append` from the rows
+    of the appended night only, see `rollup`.
+
+    Example:
+        store = ReportStore(PAK_DIR / 'PositionReport.sqlite')
+        store.append(date(2021, 10, 2), pos_hist)
+        df = store.query(date_from='2021-10-01', symbols=['EURUSD'])
+        by_symbol = store.rollup(date_from='2021-10-01', by=['symbol'])
+
+    Args:
+        path (str or Path): path of the database file, created if not exists
+    """
+
+    TABLE = 'positions'
+    ROLLUP_TABLE = 'rollups'
+    ROLLUP_KEYS = ['night_date', 'symbol', 'magic']
+    ROLLUP_COLUMNS = ['positions', 'profit', 'swap', 'commission', 'st_positions', 'st_profit', 'swap_avoided', 'st_diff']
+    # Column of the profit at StopT, see `Tonight.name`
+    ST_PROFIT = 'ST-profit'
+    KEY_COLUMNS = ['position_id', 'night_date']
+    DATETIME_COLUMNS = ['En_Time', 'Ex_Time']
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(self.path.as_posix(), check_same_thread=False)
+        self._conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.TABLE} (
+                position_id INTEGER NOT NULL,
+                night_date TEXT NOT NULL,
+                symbol TEXT,
+                magic INTEGER,
+                PRIMARY KEY (position_id, night_date)
+            )''')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS idx_night_date ON {self.TABLE} (night_date)')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS idx_symbol_magic ON {self.TABLE} (symbol, magic)')
+        has_rollups = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self.ROLLUP_TABLE,)).fetchone()
+        self._conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.ROLLUP_TABLE} (
+                night_date TEXT NOT NULL,
+                symbol TEXT,
+                magic INTEGER,
+                {', '.join(f'{c} REAL' for c in self.ROLLUP_COLUMNS)},
+                PRIMARY KEY (night_date, symbol, magic)
+            )''')
+        self._conn.commit()
+        self._columns = self._table_columns()
+        if not has_rollups and len(self):
+            n = self.rebuild_rollups()
+            logging.info(f'Built rollups of {n} nights in {self.path.name}')
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        return self._conn.execute(f'SELECT COUNT(*) FROM {self.TABLE}').fetchone()[0]
+
+    @property
+    def columns(self):
+        """Report columns, without the key columns"""
+        return [c for c in self._columns if c not in self.KEY_COLUMNS]
+
+    def append(self, night_date, positions):
+        """Insert positions of a night, rows already stored for the night are replaced
+
+        Args:
+            night_date (date): night the positions belong to
+            positions (dataframe): positions indexed by position id
+
+        Returns:
+            int: number of rows written
+        """
+        if len(positions) == 0:
+            return 0
+        rows = positions.copy()
+        rows.index.name = 'position_id'
+        rows = rows.reset_index()
+        rows.insert(1, 'night_date', str(pd.to_datetime(night_date).date()))
+        for col in rows.columns:
+            if pd.api.types.is_datetime64_any_dtype(rows[col]):
+                rows[col] = rows[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+        rows = rows.astype(object).where(rows.notna(), None)
+
+        with self._conn:
+            for col in rows.columns:
+                if col not in self._columns:
+                    self._conn.execute(f'ALTER TABLE {self.TABLE} ADD COLUMN {_quote(col)}')
+                    self._columns.append(col)
+            cols = ', '.join(_quote(c) for c in rows.columns)
+            marks = ', '.join('?' * len(rows.columns))
+            self._conn.executemany(
+                f'INSERT OR REPLACE INTO {self.TABLE} ({cols}) VALUES ({marks})',
+                rows.itertuples(index=False, name=None),
+            )
+            self._update_rollups(rows['night_date'].iloc[0])
+        logging.debug(f'{len(rows)} positions of night {night_date} written to {self.path}')
+        return len(rows)
+
+    def query(self, date_from=None, date_to=None, symbols=None, magics=None, columns=None):
+        """Return stored positions filtered by night date range (inclusive), symbols and magics
+
+        Args:
+            date_from (str or date, optional): first night date. Defaults to None.
+            date_to (str or date, optional): last night date. Defaults to None.
+            symbols (list, optional): symbols to select. Defaults to None.
+            magics (list, optional): magic numbers to select. Defaults to None.
+            columns (list, optional): columns to select. Defaults to all.
+
+        Returns:
+            dataframe: positions indexed by position id, with column `night_date`
+        """
+        where, params = [], []
+        if date_from is not None:
+            where.append('night_date >= ?')
+            params.append(str(pd.to_datetime(date_from).date()))
+        if date_to is not None:
+            where.append('night_date <= ?')
+            params.append(str(pd.to_datetime(date_to).date()))
+        if symbols is not None:
+            where.append(f'symbol IN ({", ".join("?" * len(symbols))})')
+            params += list(symbols)
+        if magics is not None:
+            where.append(f'magic IN ({", ".join("?" * len(magics))})')
+            params += [int(m) for m in magics]
+
+        select = self._columns if columns is None else self.KEY_COLUMNS + [c for c in columns if c not in self.KEY_COLUMNS]
+        sql = f'SELECT {", ".join(_quote(c) for c in select)} FROM {self.TABLE}'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY night_date, position_id'
+        df = pd.read_sql_query(sql, self._conn, params=params, index_col='position_id')
+        for col in self.DATETIME_COLUMNS:
+            if col in df:
+                df[col] = pd.to_datetime(df[col])
+        return df
+
+    def _update_rollups(self, night_date=None):
+        """Aggregate the rollups of `night_date` from its stored rows, all nights if None"""
+        col = lambda name: _quote(name) if name in self._columns else 'NULL'
+        profit, swap, st = col('profit'), col('swap'), col(self.ST_PROFIT)
+        where, params = ('WHERE night_date = ?', [night_date]) if night_date is not None else ('', [])
+        self._conn.execute(f'DELETE FROM {self.ROLLUP_TABLE} {where}', params)
+        self._conn.execute(f'''
+            INSERT INTO {self.ROLLUP_TABLE} ({', '.join(self.ROLLUP_KEYS + self.ROLLUP_COLUMNS)})
+            SELECT night_date, symbol, magic,
+                COUNT(*), TOTAL({profit}), TOTAL({swap}), TOTAL({col('commision')}),
+                COUNT({st}), TOTAL({st}),
+                -TOTAL(CASE WHEN {st} IS NOT NULL THEN {swap} END),
+                TOTAL({st} - {profit} - COALESCE({swap}, 0))
+            FROM {self.TABLE} {where}
+            GROUP BY night_date, symbol, magic''', params)
+
+    def rebuild_rollups(self):
+        """Aggregate the rollups of all nights again, returns the number of nights"""
+        with self._conn:
+            self._update_rollups()
+        return self._conn.execute(f'SELECT COUNT(DISTINCT night_date) FROM {self.ROLLUP_TABLE}').fetchone()[0]
+
+    def rollup(self, date_from=None, date_to=None, by=ROLLUP_KEYS):
+        """Return totals of the rollup table between two night dates (inclusive)
+
+        Columns are `ROLLUP_COLUMNS`: `positions`, `profit`, `swap`, `commission`, and of
+        positions with an ST profit `st_positions`, `st_profit`, `swap_avoided` (minus
+        their swap) and `st_diff` (ST profit minus their profit and swap).
+
+        Args:
+            date_from (str or date, optional): first night date. Defaults to None.
+            date_to (str or date, optional): last night date. Defaults to None.
+            by (list, optional): keys to group by, of `ROLLUP_KEYS`. Defaults to all of them.
+
+        Returns:
+            dataframe: totals indexed by `by`
+        """
+        by = list(by)
+        assert set(by) <= set(self.ROLLUP_KEYS), f'Rollups are by {self.ROLLUP_KEYS}'
+        where, params = [], []
+        if date_from is not None:
+            where.append('night_date >= ?')
+            params.append(str(pd.to_datetime(date_from).date()))
+        if date_to is not None:
+            where.append('night_date <= ?')
+            params.append(str(pd.to_datetime(date_to).date()))
+        sql = f'SELECT {", ".join(by + [f"TOTAL({c}) AS {c}" for c in self.ROLLUP_COLUMNS])} FROM {self.ROLLUP_TABLE}'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if by:
+            sql += f' GROUP BY {", ".join(by)} ORDER BY {", ".join(by)}'
+        df = pd.read_sql_query(sql, self._conn, params=params)
+        df[['positions', 'st_positions']] = df[['positions', 'st_positions']].astype(int)
+        return df.set_index(by) if by else df
+
+    def export_csv(self, path, **query):
+        """Write positions selected by `query` (see `query`) to a CSV in the old report format"""
+        df = self.query(**query).drop(columns=['night_date'])
+        ordered = [c for c in POSITION_COLUMNS if c in df]
+        df = df[ordered + [c for c in df.columns if c not in ordered]]
+        df.to_csv(Path(path).as_posix(), index=True)
+        return len(df)
+
+    def import_csv(self, path):
+        """Load an old `PositionReport.csv`, night date of each row is taken from its `Ex_Time`"""
+        df = pd.read_csv(Path(path).as_posix(), index_col=0, parse_dates=self.DATETIME_COLUMNS)
+        n = 0
+        for night_date, rows in df.groupby(df.Ex_Time.dt.date):
+            n += self.append(night_date, rows)
+        return n
+
+    def _table_columns(self):
+        return [row[1] for row in self._conn.execute(f'PRAGMA table_info({self.TABLE})')]
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def merge_records(positions, records):
+    """Join fields recorded by position id (e.g. `ST-profit`) to `positions` at once
+
+    Records of positions not in `positions` are added as rows, recorded fields
+    overwrite existing values.
+
+    Args:
+        positions (dataframe): positions indexed by position id
+        records (dict): {position id: {column: value}}
+
+    Returns:
+        dataframe: `positions` with the recorded columns, rows in order of `positions` then new ones
+    """
+    if not records:
+        return positions
+    records = pd.DataFrame.from_dict(records, orient='index')
+    records.index.name = positions.index.name
+    index = positions.index.append(records.index.difference(positions.index, sort=False))
+    merged = positions.reindex(index).join(records[records.columns.difference(positions.columns, sort=False)])
+    overlap = records.columns.intersection(positions.columns)
+    if len(overlap):
+        merged.update(records[overlap])
+    return merged
+
+
+def append_csv(path, positions):
+    """Append `positions` to a report CSV without reading the rows already in it
+
+    Only the header of an existing file is read. If `positions` has columns not in
+    the header, returns False and writes nothing, the caller should re-export instead.
+
+    Returns:
+        bool: true if appended
+    """
+    path = Path(path)
+    if not path.exists():
+        positions.to_csv(path.as_posix(), index=True)
+        return True
+    with open(path, 'r') as f:
+        header = f.readline().rstrip('\r\n').split(',')[1:]
+    if not set(positions.columns) <= set(header):
+        return False
+    positions.reindex(columns=header).to_csv(path.as_posix(), mode='a', header=False, index=True)
+    return True
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+class RingBuffer:
+    """Fixed size ring buffer of numpy records
+
+    Every record is written twice, at `i` and `i + capacity` of a buffer of twice the
+    capacity, so the last `n <= capacity` records are always contiguous and `last`
+    returns a view without copying.
+
+    Args:
+        capacity (int): max number of records kept
+        dtype (np.dtype): dtype of records
+    """
+
+    def __init__(self, capacity, dtype):
+        self.capacity = capacity
+        self._buf = np.zeros(2 * capacity, dtype=dtype)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, records):
+        """Append records (oldest first), returns number appended"""
+        records = records[-self.capacity:]
+        cap = self.capacity
+        idx = (self._head + np.arange(len(records))) % cap
+        self._buf[idx] = records
+        self._buf[idx + cap] = records
+        self._head = (self._head + len(records)) % cap
+        self._size = min(cap, self._size + len(records))
+        return len(records)
+
+    def append(self, record):
+        """Append one record, a tuple in order of the dtype fields"""
+        cap = self.capacity
+        self._buf[self._head] = record
+        self._buf[self._head + cap] = record
+        self._head = (self._head + 1) % cap
+        if self._size < cap:
+            self._size += 1
+
+    def last(self, n=None):
+        """View of the last `n` records (all if None), oldest first"""
+        n = self._size if n is None else min(n, self._size)
+        end = self._head + self.capacity
+        return self._buf[end - n:end]
@@ -0,0 +1,88 @@
+from . import logging
+
+
+def run(config_path, report_fn_prefix, nights=None, on_night=None, hour_shift=None, replay=None):
+    """Manage positions night after night
+
+    Arranges tonight's tasks, processes them as they fire, and writes the report
+    at the end of the night. Close tasks run in a `SymbolDispatcher`, so symbols
+    firing together are closed concurrently, while tasks of a symbol keep their
+    order. The report waits for closes still in flight.
+
+    Events of the night are logged to a `Journal`, so a restart during the night
+    resumes it without closing twice or losing the managed positions of the report.
+
+    Args:
+        config_path (str or Path): path to Config.ini
+        report_fn_prefix (str): prefix of the report name, None for default
+        nights (int, optional): number of nights to run. Defaults to None, runs indefinitely.
+        on_night (callable, optional): called with `(tonight, positions)` after each night. Defaults to None.
+        hour_shift (int, optional): broker hours ahead of UTC if started while market is closed,
+            see `MT5Api`. Defaults to None.
+        replay (TerminalReplay, optional): run on recorded terminal calls, see `terminalReplay.replay`.
+            Defaults to None.
+    """
+    # MetaTrader5 and pandas are only imported once there is something to run
+    from .mt5Api import MT5Api
+    from .toNight import Tonight
+    from .stopRules import RuleWatcher
+    from .dispatcher import SymbolDispatcher
+    from .journal import Journal
+
+    mt5api = MT5Api(config_path, hour_shift=hour_shift, replay=replay)
+    pq_in, q_out = mt5api.get_timmer_Qs()
+
+    # Changes of symbol_stopT.csv are applied by a task, in between closes
+    watcher = None
+    def on_rules_change():
+        pq_in.put((mt5api.broker_time_local, {'task': Tonight.RELOAD_RULES}))
+
+    dispatcher = None
+    journal = None
+    n_night = 0
+    while nights is None or n_night < nights:
+        tonight = Tonight(mt5api, config_path)
+        if journal is None:
+            journal = Journal(Tonight.journal_path(report_fn_prefix), sync_sec=tonight.journal_sync_sec).start()
+        tonight.recover(journal)
+        tonight.arrange_tonight_tasks(pq_in)
+        if watcher is None and tonight.rules_reload_sec > 0:
+            watcher = RuleWatcher(tonight.rules_path, on_rules_change, interval=tonight.rules_reload_sec).start()
+        if dispatcher is None:
+            dispatcher = SymbolDispatcher(max_workers=tonight.symbol_workers)
+            # A replay skips time only once the tasks fired are handed over and done
+            if replay is not None:
+                mt5api.clock.busy = lambda: q_out.unfinished_tasks or dispatcher.in_flight
+        pq_in.put((
+            tonight.tonight_end_dt, {'task': Tonight.END}
+        ))
+        logging.info(f'All tasks arranged, will end tonight at {tonight.tonight_end_dt}. Waiting for first task...')
+
+        while True:
+            _, task = q_out.get()
+            task_name = task['task']
+            logging.debug(f'Get a task {task}')
+            if task_name == Tonight.CLOSE_POSITION:
+                dispatcher.submit(task['symbol'], tonight.close_position, task['symbol'], task['magics'], task.get('deadline'))
+            elif task_name == Tonight.RELOAD_RULES:
+                tonight.reload_rules()
+            elif task_name == Tonight.END:
+                if dispatcher.in_flight:
+                    logging.info(f'Waiting for {dispatcher.in_flight} close tasks in flight...')
+                dispatcher.join()
+                positions = tonight.close(report_fn_prefix=report_fn_prefix)
+                q_out.task_done()
+                break
+            q_out.task_done()
+        # Kept for a start while the market is closed, when broker time can't be read
+        if mt5api.clock.n_samples:
+            mt5api.calendar.offset = mt5api.clock.offset
+        n_night += 1
+        if on_night is not None:
+            on_night(tonight, positions)
+    if watcher is not None:
+        watcher.stop()
+    if dispatcher is not None:
+        dispatcher.shutdown()
+    if journal is not None:
+        journal.close()
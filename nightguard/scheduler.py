@@ -0,0 +1,254 @@
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import Condition, Thread
+
+from . import logging
+from .telemetry import TASK_LATENESS, TASKS_SKIPPED
+
+
+class SystemClock:
+    """Real time clock, `now` is given by a callable and waits really block.
+
+    Args:
+        now_fn (callable, optional): returns current datetime. Defaults to `datetime.utcnow`.
+    """
+
+    def __init__(self, now_fn=datetime.utcnow):
+        self._now_fn = now_fn
+
+    def now(self):
+        return self._now_fn()
+
+    def error_bound(self):
+        """Seconds the clock may be off, unknown for a plain callable"""
+        return 0.0
+
+    def wait(self, cond, timeout):
+        """Block on `cond` (already acquired) for at most `timeout` seconds"""
+        return cond.wait(timeout)
+
+
+class VirtualClock:
+    """Clock which jumps forward instead of sleeping.
+
+    A wait with timeout advances the clock by the timeout and returns immediately,
+    so thousands of tasks spreaded over a night run in a fraction of a second.
+    Waits without timeout still block until the condition is notified.
+
+    Args:
+        start (datetime): initial time of the clock
+    """
+
+    def __init__(self, start):
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def error_bound(self):
+        return 0.0
+
+    def advance(self, seconds):
+        self._now += timedelta(seconds=seconds)
+
+    def wait(self, cond, timeout):
+        if timeout is None:
+            return cond.wait()
+        self.advance(timeout)
+        return False
+
+
+def _task_name(task):
+    return task.get('task') if isinstance(task, dict) else type(task).__name__
+
+
+class ScheduledTask:
+    """Handle of a task in `TaskScheduler`, returned by `schedule`
+
+    Attributes:
+        due (datetime): time the task should fire
+        task (dict): the task itself
+        fired_at (datetime): time the task actually fired, None if not fired yet
+        clock_error (float): error bound in seconds of the clock when fired
+        cancelled (bool): true if cancelled
+    """
+    __slots__ = ('due', 'task', 'seq', 'fired_at', 'clock_error', 'cancelled')
+
+    def __init__(self, due, task, seq):
+        self.due = due
+        self.task = task
+        self.seq = seq
+        self.fired_at = None
+        self.clock_error = None
+        self.cancelled = False
+
+    @property
+    def pending(self):
+        return self.fired_at is None and not self.cancelled
+
+    @property
+    def lateness(self):
+        """Seconds between due time and fired time, None if not fired"""
+        if self.fired_at is None:
+            return None
+        return (self.fired_at - self.due).total_seconds()
+
+    def __repr__(self):
+        return f'ScheduledTask(due={self.due}, task={self.task}, fired_at={self.fired_at}, cancelled={self.cancelled})'
+
+
+class TaskScheduler:
+    """Heap backed scheduler firing time ordered tasks into a FIFO queue.
+
+    A single thread sleeps on a condition variable until the earliest deadline,
+    it is woken up whenever a task is scheduled, cancelled or rescheduled, so a task
+    pushed later with an earlier time never waits behind others.
+
+    Cancelled or rescheduled tasks are left in the heap and dropped when they
+    surface (lazy deletion), so both operations are O(log n).
+
+    The fired element put into `q_out` is a tuple `(due, task)`, same as the
+    element put into the old `PriorityQueue`, and `put` accepts the same tuple,
+    so it can be used as a drop in replacement of it.
+
+    Example:
+        scheduler = TaskScheduler(SystemClock())
+        scheduler.start()
+        handle = scheduler.schedule(pd.to_datetime('2021-2-1'), {'task': 'close'})
+        scheduler.reschedule(handle, pd.to_datetime('2021-1-1'))
+        due, task = scheduler.q_out.get()
+
+    Args:
+        clock (SystemClock, VirtualClock or BrokerClock, optional): time source. Defaults to `SystemClock()`.
+        q_out (Queue, optional): queue to put fired tasks. Defaults to a new `Queue`.
+        overdue_skip_sec (float, optional): tasks late more than this are skipped. Defaults to 5 minutes.
+        max_wait_sec (float, optional): longest single wait, the clock is re-read after it,
+            which bounds the error if the clock is corrected while waiting. Defaults to 30.
+    """
+
+    OVERDUE_SKIP_SEC = 5 * 60
+    MAX_WAIT_SEC = 30
+
+    def __init__(self, clock=None, q_out=None, overdue_skip_sec=OVERDUE_SKIP_SEC, max_wait_sec=MAX_WAIT_SEC):
+        self.clock = clock if clock is not None else SystemClock()
+        self.q_out = q_out if q_out is not None else Queue()
+        self.overdue_skip_sec = overdue_skip_sec
+        self.max_wait_sec = max_wait_sec
+
+        self._heap = []
+        self._cond = Condition()
+        self._seq = itertools.count()
+        self._thread = None
+        self._running = False
+
+        # Seconds late of each fired task, and handles of skipped ones
+        self.lateness = []
+        self.skipped = []
+
+    def schedule(self, due, task):
+        """Schedule `task` to fire at `due`, returns a `ScheduledTask` handle"""
+        with self._cond:
+            handle = ScheduledTask(due, task, next(self._seq))
+            self._push(handle)
+            return handle
+
+    def put(self, item, block=True, timeout=None):
+        """`PriorityQueue.put` compatible, `item` is a tuple `(due, task)`"""
+        due, task = item
+        return self.schedule(due, task)
+
+    def cancel(self, handle):
+        """Cancel a pending task, returns False if it has fired or been cancelled"""
+        with self._cond:
+            if not handle.pending:
+                return False
+            handle.cancelled = True
+            self._cond.notify()
+            return True
+
+    def reschedule(self, handle, due):
+        """Move a pending task to `due`, returns False if it has fired or been cancelled"""
+        with self._cond:
+            if not handle.pending:
+                return False
+            handle.due = due
+            handle.seq = next(self._seq)
+            self._push(handle)
+            return True
+
+    @property
+    def pending(self):
+        """Pending task handles in firing order"""
+        with self._cond:
+            live = [(due, seq, h) for due, seq, h in self._heap if h.pending and h.seq == seq]
+        return [h for _, _, h in sorted(live, key=lambda e: (e[0], e[1]))]
+
+    def start(self):
+        """Start the firing thread, returns self"""
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = Thread(target=self._run, name='TaskScheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the firing thread, pending tasks are kept"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _push(self, handle):
+        heapq.heappush(self._heap, (handle.due, handle.seq, handle))
+        # Only the earliest deadline matters to the waiting thread
+        if self._heap[0][2] is handle:
+            self._cond.notify()
+
+    def _peek(self):
+        """Return the earliest live heap entry, dropping stale ones"""
+        heap = self._heap
+        while heap:
+            _, seq, handle = heap[0]
+            if handle.pending and handle.seq == seq:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def _run(self):
+        with self._cond:
+            while self._running:
+                entry = self._peek()
+                if entry is None:
+                    self.clock.wait(self._cond, None)
+                    continue
+                due, _, handle = entry
+                now = self.clock.now()
+                delay = (due - now).total_seconds()
+                if delay > 0:
+                    self.clock.wait(self._cond, min(delay, self.max_wait_sec))
+                    continue
+                heapq.heappop(self._heap)
+                self._fire(handle, now)
+
+    def _fire(self, handle, now):
+        handle.fired_at = now
+        handle.clock_error = self.clock.error_bound()
+        overdue_sec = handle.lateness
+        if overdue_sec >= self.overdue_skip_sec:
+            logging.warning(f'Task {handle.task} overdue!')
+            logging.warning(f'  Skip: overdue {overdue_sec:.3f}s, should be excuted at {handle.due}, but now is {now}')
+            self.skipped.append(handle)
+            TASKS_SKIPPED.labels(_task_name(handle.task)).inc()
+            return
+        if overdue_sec >= 1:
+            logging.warning(f'Task {handle.task} overdue!')
+            logging.warning(f'  Excute: overdue {overdue_sec:.3f}s (clock error bound {handle.clock_error:.3f}s)')
+        self.lateness.append(overdue_sec)
+        TASK_LATENESS.labels(_task_name(handle.task)).observe(overdue_sec)
+        self.q_out.put((handle.due, handle.task))
@@ -0,0 +1,232 @@
+import json
+import os
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from threading import RLock
+
+import numpy as np
+
+from . import logging
+
+
+_EPOCH = datetime(1970, 1, 1)
+DAY_MIN = 24 * 60
+WEEK_MIN = 7 * DAY_MIN
+# 1970-1-1 was a Thursday, minutes since epoch plus this are minutes since a Monday 00:00
+_MONDAY_MIN = 3 * DAY_MIN
+
+
+def _minutes(dt):
+    return (dt - _EPOCH).total_seconds() / 60
+
+
+def _datetime(minutes):
+    return _EPOCH + timedelta(minutes=minutes)
+
+
+def parse_holidays(values):
+    """Parse dates like 2021-12-25 of the HOLIDAYS setting into a set of `date`"""
+    if isinstance(values, str):
+        values = values.split(',')
+    return {date.fromisoformat(v.strip()) for v in values if v.strip()}
+
+
+def sessions_from_bars(times, gap_min=30):
+    """Weekly sessions of a symbol from the open times of its M1 bars over past weeks
+
+    A minute of the week is in session if a bar opened at it in any of the weeks, so
+    a holiday in one week does not close it. Gaps of at most `gap_min` minutes without
+    bars, e.g. of quiet symbols, are part of the session.
+
+    Args:
+        times (ndarray): open times of M1 bars in seconds of broker time
+        gap_min (int, optional): longest gap kept in a session. Defaults to 30.
+
+    Returns:
+        tuple: ((start, end), ...) minutes since Monday 00:00, end excluded
+    """
+    opened = np.zeros(WEEK_MIN, dtype=bool)
+    opened[(np.asarray(times, dtype=np.int64) // 60 + _MONDAY_MIN) % WEEK_MIN] = True
+    minutes = np.flatnonzero(opened)
+    if len(minutes) == 0:
+        return ()
+    breaks = np.flatnonzero(np.diff(minutes) > gap_min + 1)
+    starts = np.r_[minutes[0], minutes[breaks + 1]]
+    ends = np.r_[minutes[breaks], minutes[-1]] + 1
+    return tuple((int(s), int(e)) for s, e in zip(starts, ends))
+
+
+class SessionCalendar:
+    """Trading sessions of symbols by minute of the week, closed on holidays
+
+    Answers whether a symbol trades at a broker time, and when it opens or closes
+    next, from memory without calling the terminal or waiting for ticks. Weekly
+    sessions of a symbol are learnt from the M1 bars of the last `learn_weeks` weeks
+    through `bars_fn` (the `MetaTrader5` Python API gives no session times), saved
+    to `path` and learnt again after `REFRESH_DAYS`. Symbols without bars trade
+    `DEFAULT_SESSIONS`.
+
+    The offset of broker time from UTC, which can not be read from the terminal while
+    the market is closed, is saved to `path` as well, see `offset`.
+
+    Example:
+        calendar = SessionCalendar(PAK_DIR / 'Sessions.json', holidays=parse_holidays('2021-12-25'))
+        if not calendar.is_open('EURUSD', now):
+            print(f'EURUSD opens at {calendar.next_open("EURUSD", now)}')
+
+    Args:
+        path (str or Path, optional): JSON file the calendar is cached in. Defaults to None, not cached.
+        holidays (iterable, optional): dates all symbols are closed. Defaults to ().
+        bars_fn (callable, optional): `bars_fn(symbol, date_from, date_to)` returns M1 bars with
+            field `time`, e.g. `MT5Api.get_rates_range`. Defaults to None, no learning.
+        now (callable, optional): returns broker time. Defaults to `datetime.utcnow`.
+        learn_weeks (int, optional): weeks of bars sessions are learnt from. Defaults to 4.
+    """
+
+    # Monday 00:00 to Friday 23:55, as forex at most brokers
+    DEFAULT_SESSIONS = ((0, 5 * DAY_MIN - 5),)
+    LEARN_WEEKS = 4
+    REFRESH_DAYS = 7
+    # Weeks searched for the next open or close
+    HORIZON_WEEKS = 8
+
+    def __init__(self, path=None, holidays=(), bars_fn=None, now=datetime.utcnow, learn_weeks=LEARN_WEEKS):
+        self.path = None if path is None else Path(path)
+        self.holidays = set(holidays)
+        self.bars_fn = bars_fn
+        self.now = now
+        self.learn_weeks = learn_weeks
+        self._lock = RLock()
+        # symbol -> {'sessions': ((start, end), ...), 'learnt': iso datetime}
+        self._symbols = {}
+        self._offset_sec = None
+        self._load()
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                cached = json.load(f)
+        except ValueError as e:
+            logging.warning(f'Ignore broken session calendar {self.path}: {e}')
+            return
+        self._symbols = {
+            symbol: {'sessions': tuple(tuple(s) for s in entry['sessions']), 'learnt': entry['learnt']}
+            for symbol, entry in cached.get('symbols', {}).items()
+        }
+        self._offset_sec = cached.get('offset_sec')
+
+    def save(self):
+        """Write the calendar to `path`"""
+        if self.path is None:
+            return
+        with self._lock:
+            symbols = {symbol: entry for symbol, entry in self._symbols.items() if not entry.get('failed')}
+            cached = {'offset_sec': self._offset_sec, 'symbols': symbols}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(cached, f)
+            os.replace(tmp, self.path)
+
+    @property
+    def offset(self):
+        """Last known offset of broker time from UTC as a `timedelta`, None if never known"""
+        return None if self._offset_sec is None else timedelta(seconds=self._offset_sec)
+
+    @offset.setter
+    def offset(self, delta):
+        offset_sec = round(delta.total_seconds())
+        if offset_sec != self._offset_sec:
+            self._offset_sec = offset_sec
+            self.save()
+
+    def learn(self, symbol):
+        """Learn the sessions of `symbol` from its bars of the last `learn_weeks` weeks"""
+        now = self.now()
+        bars = self.bars_fn(symbol, now - timedelta(weeks=self.learn_weeks), now)
+        sessions = sessions_from_bars(bars['time'])
+        if not sessions:
+            logging.warning(f'No bars of {symbol} to learn its sessions, using default sessions')
+            sessions = self.DEFAULT_SESSIONS
+        with self._lock:
+            self._symbols[symbol] = {'sessions': sessions, 'learnt': now.isoformat()}
+            self.save()
+        logging.debug(f'Sessions of {symbol}: {self.describe(symbol)}')
+        return sessions
+
+    def sessions(self, symbol):
+        """Weekly sessions of `symbol`, ((start, end), ...) minutes since Monday 00:00"""
+        entry = self._symbols.get(symbol)
+        if self.bars_fn is not None:
+            stale = entry is not None and \
+                self.now() - datetime.fromisoformat(entry['learnt']) > timedelta(days=self.REFRESH_DAYS)
+            if entry is None or stale:
+                try:
+                    return self.learn(symbol)
+                except Exception as e:
+                    logging.warning(f'Learning sessions of {symbol} failed: {e}')
+                    # Not saved, learnt again by the next run
+                    entry = self._symbols[symbol] = {
+                        'sessions': self.DEFAULT_SESSIONS if entry is None else entry['sessions'],
+                        'learnt': self.now().isoformat(), 'failed': True,
+                    }
+        return self.DEFAULT_SESSIONS if entry is None else entry['sessions']
+
+    def describe(self, symbol):
+        """Sessions of `symbol` like 'Mon 00:00-Fri 23:55'"""
+        def fmt(minute):
+            return _datetime(minute + 4 * DAY_MIN).strftime('%a %H:%M')
+        return ', '.join(f'{fmt(start)}-{fmt(end)}' for start, end in self.sessions(symbol))
+
+    def is_holiday(self, day):
+        """True if `day` is a holiday, all symbols closed"""
+        return day in self.holidays
+
+    def _intervals(self, symbol, dt):
+        """Open intervals of `symbol` in minutes since 1970-1-1, from the week of `dt`, holidays cut out"""
+        sessions = self.sessions(symbol)
+        minute = _minutes(dt)
+        week = int((minute + _MONDAY_MIN) // WEEK_MIN) * WEEK_MIN - _MONDAY_MIN
+        last = None
+        for w in range(self.HORIZON_WEEKS):
+            for start, end in sessions:
+                cur, end = week + w * WEEK_MIN + start, week + w * WEEK_MIN + end
+                while cur < end:
+                    day_end = min(end, (cur // DAY_MIN + 1) * DAY_MIN)
+                    if _datetime(cur).date() not in self.holidays:
+                        if last is not None and last[1] == cur:
+                            last = (last[0], day_end)
+                        else:
+                            if last is not None:
+                                yield last
+                            last = (cur, day_end)
+                    cur = day_end
+        if last is not None:
+            yield last
+
+    def _session_at(self, symbol, dt):
+        """First open interval of `symbol` ending after `dt`, None beyond `HORIZON_WEEKS`"""
+        minute = _minutes(dt)
+        for start, end in self._intervals(symbol, dt):
+            if end > minute:
+                return start, end
+        return None
+
+    def is_open(self, symbol, dt):
+        """True if `symbol` trades at broker time `dt`"""
+        session = self._session_at(symbol, dt)
+        return session is not None and session[0] <= _minutes(dt)
+
+    def next_open(self, symbol, dt):
+        """Broker time `symbol` opens at or after `dt`, `dt` itself if open, None if not within `HORIZON_WEEKS`"""
+        session = self._session_at(symbol, dt)
+        if session is None:
+            return None
+        return dt if session[0] <= _minutes(dt) else _datetime(session[0])
+
+    def next_close(self, symbol, dt):
+        """Broker time the session of `symbol` open at `dt`, or the next one, closes"""
+        session = self._session_at(symbol, dt)
+        return None if session is None else _datetime(session[1])
@@ -0,0 +1,396 @@
+import csv
+import os
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime, time
+from fnmatch import fnmatchcase
+from threading import Event, Thread
+
+from . import logging
+
+
+# Magics of a rule closing positions of any magic number
+MAGIC_ALL = -3418239482
+
+GLOB_CHARS = '*?['
+
+
+class StopRule(namedtuple('StopRule', ['symbol', 'stop_time', 'magics'])):
+    """A row of symbol_stopT.csv, `stop_time` is a `datetime.time` and `magics` a tuple
+
+    `symbol` is a symbol name or a pattern, see `RuleIndex`. Items of `magics` are
+    magic numbers or `(first, last)` ranges, `(MAGIC_ALL,)` for all magics.
+    """
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """Identifies the rule, its symbol followed by its magics unless all magics"""
+        return rule_key(self.symbol, self.magics)
+
+
+def rule_key(symbol, magics):
+    """Key of the rule of `symbol` and `magics`, same as `StopRule.key`"""
+    magics = tuple(tuple(m) if isinstance(m, list) else m for m in magics)
+    if magics == (MAGIC_ALL,):
+        return symbol
+    return f'{symbol}:{format_magics(magics)}'
+
+
+def is_pattern(symbol):
+    return any(c in symbol for c in GLOB_CHARS)
+
+
+def parse_magics(value):
+    """Parse the `Magics` field, numbers or ranges like `100-199` joined by `;`, empty for all magics"""
+    value = (value or '').strip()
+    if value == '':
+        return (MAGIC_ALL,)
+    magics = []
+    for m in value.split(';'):
+        m = m.strip()
+        if not m:
+            continue
+        first, sep, last = m[1:].partition('-')
+        if sep:
+            first, last = int(float(m[0] + first)), int(float(last))
+            if first > last:
+                raise ValueError(f'Empty magic range {m}')
+            magics.append((first, last))
+        else:
+            magics.append(int(float(m)))
+    return tuple(magics)
+
+
+def format_magics(magics):
+    """Format `magics` as in the `Magics` field, 'ALL' for all magics"""
+    if tuple(magics) == (MAGIC_ALL,):
+        return 'ALL'
+    return ';'.join(f'{m[0]}-{m[1]}' if isinstance(m, (tuple, list)) else str(m) for m in magics)
+
+
+def parse_stop_time(value):
+    """Parse `StopT` of form HH:MM:SS into a `datetime.time`"""
+    value = value.strip()
+    try:
+        return time.fromisoformat(value)
+    except ValueError:
+        # e.g. single digit hours like 5:00:00
+        return datetime.strptime(value, '%H:%M:%S').time()
+
+
+def load_rules(path, cache=None):
+    """Read symbol_stopT.csv into a dict of `StopRule` by key
+
+    Args:
+        path (str or Path): path to symbol_stopT.csv, with columns Symbol, StopT, Magics
+        cache (dict, optional): parsed rules by raw row, filled and reused across calls
+            so only new or edited rows are parsed. Defaults to None.
+
+    Returns:
+        dict: {`StopRule.key`: StopRule}, rows with no magics are dropped, of rows
+            with the same symbol and magics the last is kept
+    """
+    cache = {} if cache is None else cache
+    rules = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            key = (row.get('Symbol'), row.get('StopT'), row.get('Magics'))
+            rule = cache.get(key)
+            if rule is None:
+                symbol = (key[0] or '').strip()
+                magics = parse_magics(key[2])
+                if not symbol or len(magics) == 0:
+                    continue
+                rule = cache[key] = StopRule(symbol, parse_stop_time(key[1]), magics)
+            if rule.key in rules:
+                logging.warning(f'Duplicate rule {rule.key} in {os.path.basename(path)}, the last row is kept')
+            rules[rule.key] = rule
+    return rules
+
+
+def diff_rules(old, new):
+    """Compare two rule dicts by key
+
+    Returns:
+        tuple: (added, removed, changed), lists of rule keys
+    """
+    added = [sym for sym in new if sym not in old]
+    removed = [sym for sym in old if sym not in new]
+    changed = [sym for sym in new if sym in old and new[sym] != old[sym]]
+    return added, removed, changed
+
+
+class _MagicTable:
+    """Rules of one symbol pattern by magic: explicit magics, ranges, and all magics"""
+
+    __slots__ = ('pattern', 'magics', 'starts', 'ranges', 'overlap', 'all', 'conflicts')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.magics = {}
+        self.starts = []
+        self.ranges = []
+        self.overlap = False
+        self.all = None
+        self.conflicts = []
+
+    def add(self, rule):
+        conflicts = self.conflicts
+        for m in rule.magics:
+            if m == MAGIC_ALL:
+                self.all = rule
+            elif isinstance(m, tuple):
+                self.ranges.append((m[0], m[1], rule))
+            else:
+                if m in self.magics and self.magics[m] is not rule:
+                    conflicts.append(f'{self.pattern}: magic {m} is in rules {self.magics[m].key} and {rule.key}, '
+                                     f'{rule.key} is used')
+                self.magics[m] = rule
+
+    def compile(self):
+        conflicts = self.conflicts
+        self.ranges.sort(key=lambda r: (r[0], r[1]))
+        self.starts = [r[0] for r in self.ranges]
+        for (first, last, rule), (first2, last2, rule2) in zip(self.ranges, self.ranges[1:]):
+            if first2 <= last:
+                self.overlap = True
+                conflicts.append(f'{self.pattern}: magics {first2}-{min(last, last2)} are in rules {rule.key} '
+                                 f'and {rule2.key}, {rule2.key} is used')
+        for m, rule in self.magics.items():
+            ranged = self._range(m)
+            if ranged is not None and ranged.stop_time != rule.stop_time:
+                conflicts.append(f'{self.pattern}: magic {m} of rule {rule.key} is also in rule {ranged.key}, '
+                                 f'{rule.key} is used')
+
+    def _range(self, magic):
+        i = bisect_right(self.starts, magic) - 1
+        if not self.overlap:
+            return self.ranges[i][2] if i >= 0 and self.ranges[i][1] >= magic else None
+        # Of overlapping ranges the one starting last wins
+        for first, last, rule in reversed(self.ranges[:i + 1]):
+            if last >= magic:
+                return rule
+        return None
+
+    def get(self, magic):
+        rule = self.magics.get(magic)
+        if rule is None and self.ranges:
+            rule = self._range(magic)
+        return rule if rule is not None else self.all
+
+
+class RuleIndex:
+    """Rules compiled to answer which rule governs a position, in O(1)
+
+    Symbols of rules are symbol names, or patterns:
+
+    * `EURUSD*`, a prefix, e.g. for broker suffixes like `EURUSD.a`
+    * `*JPY`, a suffix
+    * any other `fnmatch` pattern, e.g. `EUR???` or `[AE]URJPY`
+
+    A position is governed by the rule of the most specific symbol covering its
+    magic: the exact symbol, then the longest prefix, then the longest suffix, then
+    other patterns in file order. Of the rules of one symbol, an explicit magic wins
+    over a range, which wins over all magics.
+
+    Exact symbols, prefixes and suffixes are dict lookups, the rules applying to a
+    symbol are resolved once and `lookup` results are cached, so thousands of rules
+    cost no more per position than a few. Magics of one symbol found in two rules
+    are reported in `conflicts` when compiled. `updated` compiles again only the
+    symbols of changed rules.
+
+    Example:
+        index = RuleIndex(load_rules(symstop_fn).values())
+        rule = index.lookup('EURUSD.a', 12)
+
+    Args:
+        rules (iterable): `StopRule`s, in file order
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._exact, self._prefix, self._suffix, self._globs = {}, {}, {}, []
+        for rule in self.rules:
+            self._table(rule.symbol).add(rule)
+        for table in self._tables():
+            table.compile()
+        self._reset()
+
+    def _reset(self):
+        self._prefix_lens = sorted({len(p) for p in self._prefix}, reverse=True)
+        self._suffix_lens = sorted({len(p) for p in self._suffix}, reverse=True)
+        self._by_symbol = {}
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    @property
+    def conflicts(self):
+        """Magics of one symbol found in two rules, as messages"""
+        return [conflict for table in self._tables() for conflict in table.conflicts]
+
+    def updated(self, rules, symbols):
+        """New index of `rules`, compiling again only the tables of `symbols`
+
+        The index itself is unchanged, lookups may run on it meanwhile. Tables of other
+        symbols are shared with it. Other patterns than prefixes and suffixes are ranked
+        in file order, so if one of `symbols` is such a pattern all rules are compiled again.
+
+        Args:
+            rules (iterable): `StopRule`s, in file order
+            symbols (set): symbols, or patterns, of the rules added, removed or changed
+        """
+        if any(self._is_glob(symbol) for symbol in symbols):
+            return RuleIndex(rules)
+        index = RuleIndex.__new__(RuleIndex)
+        index.rules = list(rules)
+        index._exact, index._prefix, index._suffix = dict(self._exact), dict(self._prefix), dict(self._suffix)
+        index._globs = self._globs
+        for symbol in symbols:
+            tables, key = index._tables_of(symbol)
+            tables.pop(key, None)
+        new = {}
+        for rule in index.rules:
+            if rule.symbol in symbols:
+                new[rule.symbol] = table = index._table(rule.symbol)
+                table.add(rule)
+        for table in new.values():
+            table.compile()
+        index._reset()
+        return index
+
+    @staticmethod
+    def _is_glob(pattern):
+        return is_pattern(pattern) and not (
+            pattern.endswith('*') and not is_pattern(pattern[:-1])
+            or pattern.startswith('*') and not is_pattern(pattern[1:]))
+
+    def _tables_of(self, pattern):
+        """Dict of the tables of prefixes, suffixes or exact symbols, and key of `pattern` in it"""
+        if not is_pattern(pattern):
+            return self._exact, pattern
+        if pattern.endswith('*') and not is_pattern(pattern[:-1]):
+            return self._prefix, pattern[:-1]
+        return self._suffix, pattern[1:]
+
+    def _table(self, pattern):
+        if self._is_glob(pattern):
+            for glob, table in self._globs:
+                if glob == pattern:
+                    return table
+            table = _MagicTable(pattern)
+            self._globs.append((pattern, table))
+            return table
+        tables, key = self._tables_of(pattern)
+        table = tables.get(key)
+        if table is None:
+            table = tables[key] = _MagicTable(pattern)
+        return table
+
+    def _tables(self):
+        yield from self._exact.values()
+        yield from self._prefix.values()
+        yield from self._suffix.values()
+        yield from (table for _, table in self._globs)
+
+    def tables(self, symbol):
+        """Magic tables of the patterns matching `symbol`, most specific first"""
+        tables = self._by_symbol.get(symbol)
+        if tables is None:
+            tables = []
+            if symbol in self._exact:
+                tables.append(self._exact[symbol])
+            tables += [self._prefix[symbol[:n]] for n in self._prefix_lens
+                       if n <= len(symbol) and symbol[:n] in self._prefix]
+            tables += [self._suffix[symbol[-n:] if n else ''] for n in self._suffix_lens
+                       if n <= len(symbol) and (symbol[-n:] if n else '') in self._suffix]
+            tables += [table for glob, table in self._globs if fnmatchcase(symbol, glob)]
+            self._by_symbol[symbol] = tables
+        return tables
+
+    def lookup(self, symbol, magic):
+        """Rule governing the position of `symbol` and `magic`, None if no rule does"""
+        key = (symbol, magic)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        rule = None
+        for table in self.tables(symbol):
+            rule = table.get(magic)
+            if rule is not None:
+                break
+        self._cache[key] = rule
+        return rule
+
+    def governs(self, rule, position):
+        """Returns true if `rule` is the rule of `position`"""
+        governing = self.lookup(position.symbol, position.magic)
+        return governing is not None and governing.key == rule.key
+
+
+class RuleWatcher:
+    """Watches symbol_stopT.csv and calls `on_change` when it changes
+
+    The file's mtime and size are polled every `interval` seconds, a `stat` call, so
+    the rules are only parsed again when the file was actually written. This works
+    the same on Windows, where the terminal runs, as on Linux.
+
+    Example:
+        watcher = RuleWatcher(symstop_fn, lambda: print('rules changed')).start()
+
+    Args:
+        path (str or Path): file to watch
+        on_change (callable): called without arguments from the watcher thread
+        interval (float, optional): seconds between polls. Defaults to 1.
+    """
+
+    INTERVAL = 1.0
+
+    def __init__(self, path, on_change, interval=INTERVAL):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._stamp = self._stat()
+        self._stop = Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def changed(self):
+        """Return True if the file changed since the last call"""
+        stamp = self._stat()
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        return stamp is not None
+
+    def start(self):
+        """Start polling in a background thread, returns self"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='RuleWatcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.changed():
+                logging.info(f'{self.path} changed')
+                try:
+                    self.on_change()
+                except Exception as e:
+                    logging.warning(f'Handling change of {self.path} failed: {e}')
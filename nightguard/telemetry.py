@@ -0,0 +1,348 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from functools import wraps
+from threading import Event, Lock, Thread
+
+from . import logging
+
+
+# Seconds, from sub-millisecond terminal calls to multi-second closes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric:
+    """A metric with one child per combination of label values"""
+
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = Lock()
+
+    def labels(self, *values):
+        """Child of the label `values`, in order of `labelnames`"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _label_str(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def samples(self):
+        """Items of (label values, child), copied so it can be read while updated"""
+        return list(self._children.items())
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """Monotonic counter, e.g. `ORDER_RETCODES.labels('10004').inc()`"""
+
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        """Increment the counter without labels"""
+        self.labels().inc(amount)
+
+    def exposition(self):
+        for values, child in self.samples():
+            yield f'{self.name}{self._label_str(values)} {child.value:g}'
+
+    def snapshot(self):
+        return {','.join(map(str, values)): child.value for values, child in self.samples()}
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile, inf if above the last bucket"""
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return None
+        rank, cum = q * count, 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            cum += n
+            if cum >= rank:
+                return bound
+        return float('inf')
+
+
+class Histogram(_Metric):
+    """Histogram of fixed buckets, observing is a bisect and three increments
+
+    Args:
+        name (str): metric name
+        help (str): description
+        labelnames (tuple, optional): label names. Defaults to ().
+        buckets (tuple, optional): upper bounds of buckets. Defaults to `DEFAULT_BUCKETS`.
+    """
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        """Observe `value` without labels"""
+        self.labels().observe(value)
+
+    def exposition(self):
+        for values, child in self.samples():
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cum = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cum += n
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                yield f'{self.name}_bucket{self._label_str(values, [("le", le)])} {cum}'
+            yield f'{self.name}_sum{self._label_str(values)} {total:g}'
+            yield f'{self.name}_count{self._label_str(values)} {count}'
+
+    def snapshot(self):
+        """Count, sum and p50, p99 of each child, with `overflow` the count above the last bucket
+
+        A quantile above the last bucket is None, inf is not valid JSON.
+        """
+        snap = {}
+        for values, child in self.samples():
+            p50, p99 = child.quantile(0.5), child.quantile(0.99)
+            snap[','.join(map(str, values))] = {
+                'count': child.count, 'sum': round(child.sum, 6),
+                'p50': None if p50 == float('inf') else p50,
+                'p99': None if p99 == float('inf') else p99,
+                'overflow': child.counts[-1],
+            }
+        return snap
+
+
+class Registry:
+    """Set of metrics, rendered as Prometheus text or as a JSON snapshot"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def exposition(self):
+        """Metrics in the Prometheus text format"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(metric.exposition())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Metrics as a dict `{name: {label values: value}}`"""
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
+
+
+REGISTRY = Registry()
+
+TASK_LATENESS = REGISTRY.histogram(
+    'nightguard_task_lateness_seconds', 'Seconds between due time and firing of scheduled tasks', ['task'])
+TASKS_SKIPPED = REGISTRY.counter(
+    'nightguard_tasks_skipped_total', 'Tasks skipped as overdue', ['task'])
+TERMINAL_CALL = REGISTRY.histogram(
+    'nightguard_terminal_call_seconds', 'Seconds of MetaTrader5 calls', ['api'])
+TERMINAL_QUEUE_WAIT = REGISTRY.histogram(
+    'nightguard_terminal_queue_wait_seconds', 'Seconds MetaTrader5 calls waited for the terminal thread', ['api'])
+TERMINAL_COALESCED = REGISTRY.counter(
+    'nightguard_terminal_coalesced_total', 'MetaTrader5 reads answered by an identical queued call', ['api'])
+CLOSE_LATENCY = REGISTRY.histogram(
+    'nightguard_close_latency_seconds', 'Seconds of order_send closing a position', ['symbol'])
+TIME_TO_FLAT = REGISTRY.histogram(
+    'nightguard_time_to_flat_seconds', 'Seconds to close all positions of a close task', ['symbol'])
+ORDER_RETCODES = REGISTRY.counter(
+    'nightguard_order_retcodes_total', 'Retcodes of order_send', ['retcode'])
+CLOSE_RETRIES = REGISTRY.counter(
+    'nightguard_close_retries_total', 'Close orders resent after a partial fill or a retryable retcode', ['symbol'])
+CLOSE_FAILURES = REGISTRY.counter(
+    'nightguard_close_failures_total', 'Positions left open, rejected or at the deadline', ['symbol', 'status'])
+
+
+def timed(api, fn, histogram=TERMINAL_CALL):
+    """Wrap the terminal function `fn` to observe its latency as `api`"""
+    child = histogram.labels(api)
+
+    @wraps(fn)
+    def call(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            child.observe(time.perf_counter() - t0)
+    return call
+
+
+class MetricsServer:
+    """Serves `registry` as Prometheus text at http://host:port/metrics, in a daemon thread
+
+    Args:
+        port (int): port to listen, 0 picks a free one, see `port` after `start`
+        host (str, optional): address to bind. Defaults to '127.0.0.1', local only.
+        registry (Registry, optional): metrics to serve. Defaults to `REGISTRY`.
+    """
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        # Imported here, http.server is slow to import and only needed when serving
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry_.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f'Metrics request: {format % args}')
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        """Start serving, returns self"""
+        self._thread = Thread(target=self._server.serve_forever, name='MetricsServer', daemon=True)
+        self._thread.start()
+        logging.info(f'Serving metrics at http://{self._server.server_address[0]}:{self.port}/metrics')
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class JsonlExporter:
+    """Appends a snapshot of `registry` to a JSONL file every `interval` seconds
+
+    The file is rotated when above `max_bytes`, keeping `backups` old files
+    named `path.1` (newest) to `path.N`.
+
+    Args:
+        path (str or Path): file to append
+        interval (float, optional): seconds between snapshots. Defaults to 60.
+        max_bytes (int, optional): size which triggers rotation. Defaults to 10 MB.
+        backups (int, optional): number of rotated files kept. Defaults to 5.
+        registry (Registry, optional): metrics to export. Defaults to `REGISTRY`.
+    """
+
+    INTERVAL = 60.0
+    MAX_BYTES = 10 * 1024 * 1024
+    BACKUPS = 5
+
+    def __init__(self, path, interval=INTERVAL, max_bytes=MAX_BYTES, backups=BACKUPS, registry=REGISTRY):
+        self.path = str(path)
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.registry = registry
+        self._stop = Event()
+        self._thread = None
+
+    def write(self):
+        """Append one snapshot now"""
+        line = json.dumps({'time': time.time(), 'metrics': self.registry.snapshot()}) + '\n'
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+            self._rotate()
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f'{self.path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def start(self):
+        """Start writing in a background thread, returns self"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='JsonlExporter', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop and write a last snapshot"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.warning(f'Writing metrics to {self.path} failed: {e}')
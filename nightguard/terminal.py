@@ -0,0 +1,195 @@
+import asyncio
+import heapq
+import itertools
+import time
+from concurrent.futures import Future
+from threading import Condition, Thread, local
+
+from . import logging
+from .telemetry import TERMINAL_COALESCED, TERMINAL_QUEUE_WAIT
+
+
+class Terminal:
+    """Owner of the `MetaTrader5` module, all its calls run one by one on a single thread
+
+    Functions of the module are called through `Terminal` the same way, from any
+    thread, e.g. `terminal.positions_get(symbol='EURUSD')`, or awaited from a
+    coroutine through `aio`. Constants like `TIMEFRAME_M1` are the module's.
+
+    Calls are queued by priority: orders (`order_send`, `order_check`) run before
+    any read waiting, so a close is not held behind ticks of 20 symbols. A read
+    identical to one still queued (same function and arguments) is not queued
+    again, both callers get the result of one call. Reads already running are not
+    joined, so a read started after an order always sees its effect.
+
+    `last_error` returns the error of the last failed call of the calling thread,
+    taken right after the call, as calls of other threads run in between.
+
+    Example:
+        terminal = Terminal(mt5).start()
+        tick = terminal.symbol_info_tick('EURUSD')
+        ticks = await asyncio.gather(*(terminal.aio.symbol_info_tick(s) for s in symbols))
+
+    Args:
+        module (module): `MetaTrader5`, or a module with the same functions
+    """
+
+    # Reads coalesced while queued
+    COALESCED = frozenset({
+        'symbol_info_tick', 'symbol_info', 'symbols_get', 'account_info', 'terminal_info',
+        'positions_get', 'positions_total', 'orders_get', 'orders_total',
+        'copy_rates_from_pos', 'copy_rates_from', 'copy_rates_range', 'copy_ticks_from', 'copy_ticks_range',
+        'history_deals_get', 'history_orders_get',
+    })
+    # Priority of calls, lower runs first
+    ORDER_PRIORITY = 0
+    READ_PRIORITY = 1
+    PRIORITY = {'order_send': ORDER_PRIORITY, 'order_check': ORDER_PRIORITY}
+
+    def __init__(self, module):
+        self.module = module
+        self._cond = Condition()
+        self._queue = []
+        self._queued = {}
+        self._seq = itertools.count()
+        self._calls = {}
+        self._local = local()
+        self._thread = None
+        self._stopped = False
+        self.aio = AsyncTerminal(self)
+
+    def start(self):
+        """Start the thread calling the terminal, returns self"""
+        if self._thread is None:
+            self._stopped = False
+            self._thread = Thread(target=self._run, name='Terminal', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop after the calls queued, calls made afterwards run on the calling thread"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _key(self, name, args, kwargs):
+        if name not in self.COALESCED:
+            return None
+        key = (name, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def submit(self, name, *args, **kwargs):
+        """Queue the call of `name` of the module
+
+        Returns:
+            Future: result of the call, with `error` set to `last_error()` if it returned None
+        """
+        fn = getattr(self.module, name)
+        key = self._key(name, args, kwargs)
+        with self._cond:
+            if self._thread is not None and not self._stopped:
+                future = self._queued.get(key) if key is not None else None
+                if future is not None:
+                    TERMINAL_COALESCED.labels(name).inc()
+                    return future
+                future = Future()
+                future.error = None
+                priority = self.PRIORITY.get(name, self.READ_PRIORITY)
+                job = (priority, next(self._seq), time.perf_counter(), name, fn, args, kwargs, key, future)
+                heapq.heappush(self._queue, job)
+                if key is not None:
+                    self._queued[key] = future
+                self._cond.notify()
+                return future
+        # Not started or stopped, call on this thread
+        future = Future()
+        future.error = None
+        self._call(name, fn, args, kwargs, future)
+        return future
+
+    def _call(self, name, fn, args, kwargs, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+            if result is None and name != 'last_error':
+                future.error = self.module.last_error()
+        except Exception as e:
+            logging.debug(f'Terminal call {name} raised {e!r}')
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                priority, seq, t_queued, name, fn, args, kwargs, key, future = heapq.heappop(self._queue)
+                if key is not None:
+                    self._queued.pop(key, None)
+            TERMINAL_QUEUE_WAIT.labels(name).observe(time.perf_counter() - t_queued)
+            self._call(name, fn, args, kwargs, future)
+
+    def call(self, name, *args, **kwargs):
+        """Call `name` of the module and wait for its result"""
+        future = self.submit(name, *args, **kwargs)
+        result = future.result()
+        self._local.error = future.error
+        return result
+
+    def last_error(self):
+        """Error of the last call of this thread that returned None"""
+        error = getattr(self._local, 'error', None)
+        return error if error is not None else self.call('last_error')
+
+    def __getattr__(self, name):
+        # Only called for names not found on `Terminal`: functions and constants of the module
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = getattr(self.module, name)
+        if not callable(value):
+            return value
+        call = self._calls.get(name)
+        if call is None:
+            def call(*args, **kwargs):
+                return self.call(name, *args, **kwargs)
+            call.__name__ = name
+            self._calls[name] = call
+        return call
+
+
+class AsyncTerminal:
+    """Functions of the module of `terminal` as coroutines, see `Terminal`
+
+    Example:
+        positions = await terminal.aio.positions_get(symbol='EURUSD')
+    """
+
+    def __init__(self, terminal):
+        self._terminal = terminal
+
+    async def call(self, name, *args, **kwargs):
+        """Call `name` of the module on the terminal thread and await its result"""
+        return await asyncio.wrap_future(self._terminal.submit(name, *args, **kwargs))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = getattr(self._terminal.module, name)
+        if not callable(value):
+            return value
+
+        async def call(*args, **kwargs):
+            return await self.call(name, *args, **kwargs)
+        call.__name__ = name
+        return call
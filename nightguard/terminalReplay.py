@@ -0,0 +1,502 @@
+import atexit
+import bisect
+import cProfile
+import pickle
+import pstats
+import struct
+import sys
+import threading
+import time
+import types
+import zlib
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from threading import Event, Lock, Thread
+
+from . import logging
+
+
+_EPOCH = datetime(1970, 1, 1)
+MAGIC = b'NGREC1\n'
+_FRAME = struct.Struct('<I')
+
+Call = namedtuple('Call', ['wall_ns', 'broker_ns', 'duration_ns', 'name', 'args', 'kwargs', 'result', 'error'])
+Call.__doc__ = """A call of the terminal in a log of `TerminalRecorder`
+
+`wall_ns` is the UTC time the call started and `broker_ns` the broker time then, 0
+before the broker clock was set, both ns since 1970-1-1. `error` is the exception
+raised as a `RuntimeError`, None if it returned.
+"""
+
+# Stand-in of the result types of the module, e.g. `Tick`, so a log is read without MetaTrader5
+_Struct = namedtuple('_Struct', ['type', 'fields', 'values'])
+
+
+def _encode(value):
+    if isinstance(value, tuple):
+        fields = getattr(value, '_fields', None)
+        if fields is not None:
+            return _Struct(type(value).__name__, tuple(fields), tuple(_encode(v) for v in value))
+        return tuple(_encode(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    return value
+
+
+_types = {}
+
+
+def _decode(value):
+    if isinstance(value, _Struct):
+        cls = _types.get((value.type, value.fields))
+        if cls is None:
+            cls = _types[(value.type, value.fields)] = namedtuple(value.type, value.fields)
+        return cls(*(_decode(v) for v in value.values))
+    if isinstance(value, tuple):
+        return tuple(_decode(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _decode(v) for k, v in value.items()}
+    return value
+
+
+def _shape(value):
+    """Hashable form of an argument, without times and prices which differ in a replay"""
+    if isinstance(value, (datetime, date, float)):
+        return None
+    if isinstance(value, dict):
+        return tuple(sorted((k, _shape(v)) for k, v in value.items()))
+    if isinstance(value, (tuple, list)):
+        return tuple(_shape(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def call_key(name, args, kwargs):
+    """Key calls are matched on in a replay, see `TerminalReplay`"""
+    return name, _shape(args), _shape(kwargs)
+
+
+def read_log(path):
+    """Read a log of `TerminalRecorder`
+
+    Returns:
+        tuple: (header dict, list of `Call` in order of start)
+    """
+    header, calls = None, []
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a terminal log')
+        while True:
+            size = f.read(_FRAME.size)
+            if len(size) < _FRAME.size:
+                break
+            data = f.read(_FRAME.unpack(size)[0])
+            try:
+                frame = pickle.loads(zlib.decompress(data))
+            except (zlib.error, EOFError, pickle.UnpicklingError):
+                logging.warning(f'Ignore the last frame of {path}, cut while written')
+                break
+            if header is None:
+                header = frame
+            else:
+                calls += [Call(*c) for c in frame]
+    if header is None:
+        raise ValueError(f'{path} has no header')
+    calls.sort(key=lambda c: c.wall_ns)
+    return header, calls
+
+
+class TerminalRecorder:
+    """Wrapper of the `MetaTrader5` module logging every call to a file, for `TerminalReplay`
+
+    Functions of the module are called through the recorder the same way, e.g.
+    `Terminal(TerminalRecorder(mt5, path))`. Each call is logged with its
+    arguments, result or exception, wall and broker time it started and its
+    duration, see `Call`. Results like `Tick` or `TradePosition` are logged with
+    their field names, so the log is read without `MetaTrader5`, e.g. on Linux.
+
+    The log starts with a header holding the constants of the module, followed by
+    frames of the calls since the previous one, pickled and zlib compressed. Frames are
+    written by a background thread every `flush_sec` seconds, so a call only costs an
+    append. A frame cut by a crash is dropped when read.
+
+    Example:
+        recorder = TerminalRecorder(mt5, 'Records/1234_20211019_220000.ngrec').start()
+        recorder.broker_ns = clock.now_ns
+        terminal = Terminal(recorder).start()
+
+    Args:
+        module (module): `MetaTrader5`, or a module with the same functions
+        path (str or Path): file of the log, its directory is created if missing
+        flush_sec (float, optional): max seconds between frames. Defaults to 1.
+        clock_ns (callable, optional): wall time in ns since 1970-1-1. Defaults to `time.time_ns`.
+    """
+
+    FLUSH_SEC = 1.0
+
+    def __init__(self, module, path, flush_sec=FLUSH_SEC, clock_ns=time.time_ns):
+        self.module = module
+        self.path = Path(path)
+        self.flush_sec = flush_sec
+        self.clock_ns = clock_ns
+        # Broker time in ns, e.g. `BrokerClock.now_ns` once it is set
+        self.broker_ns = None
+        self.n_calls = 0
+        self._pending = []
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._calls = {}
+        self._stop = Event()
+        self._thread = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(self.path, 'wb')
+        self._f.write(MAGIC)
+        constants = {k: v for k, v in vars(module).items() if k.isupper() and isinstance(v, (int, float, str))}
+        self._write({'version': 1, 'module': module.__name__, 'constants': constants, 'started_ns': clock_ns()})
+
+    def start(self):
+        """Start writing frames in the background, returns self"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='TerminalRecorder', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def close(self):
+        """Write the calls pending and close the log"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._write_lock:
+            if not self._f.closed:
+                self._f.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_sec):
+            self.flush()
+
+    def _write(self, frame):
+        data = zlib.compress(pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._write_lock:
+            if self._f.closed:
+                return
+            self._f.write(_FRAME.pack(len(data)) + data)
+            self._f.flush()
+
+    def flush(self):
+        """Write the calls since the last frame as a frame"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            # Encoded here, off the thread calling the terminal
+            self._write([(*c[:4], _encode(c[4]), _encode(c[5]), _encode(c[6]), c[7]) for c in pending])
+
+    def call(self, name, *args, **kwargs):
+        """Call `name` of the module and log it"""
+        fn = getattr(self.module, name)
+        broker_ns = self.broker_ns() if self.broker_ns is not None else 0
+        wall_ns = self.clock_ns()
+        t0 = time.perf_counter_ns()
+        error = None
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            result, error = None, RuntimeError(f'{type(e).__name__}: {e}')
+            raise
+        finally:
+            with self._lock:
+                self._pending.append((wall_ns, broker_ns, time.perf_counter_ns() - t0, name, args, kwargs, result, error))
+                self.n_calls += 1
+        return result
+
+    def __getattr__(self, name):
+        # Only called for names not found on the recorder: functions and constants of the module
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = getattr(self.module, name)
+        if not callable(value):
+            return value
+        call = self._calls.get(name)
+        if call is None:
+            def call(*args, **kwargs):
+                return self.call(name, *args, **kwargs)
+            call.__name__ = name
+            self._calls[name] = call
+        return call
+
+
+class ReplayClock:
+    """Virtual broker clock of a replay, runs in real time while busy and skips idle time
+
+    A drop in replacement of `BrokerClock` for `MT5Api`, and a `TaskScheduler` clock.
+    A scheduler wait jumps the clock to its deadline at once, unless `busy()` is true,
+    e.g. while fired tasks are still running, then it waits in real time. Calls in
+    between advance it in real time, so a close takes as long as it does.
+
+    Args:
+        start (datetime): broker time the clock starts at
+        offset (timedelta, optional): broker time ahead of UTC. Defaults to 0.
+        poll_sec (float, optional): seconds between checks of `busy` while waiting. Defaults to 0.005.
+    """
+
+    POLL_SEC = 0.005
+
+    def __init__(self, start, offset=timedelta(0), poll_sec=POLL_SEC):
+        self._offset = offset
+        self.poll_sec = poll_sec
+        self.busy = lambda: False
+        self.n_samples = 0
+        self.synced = True
+        self.jumps = 0
+        # (broker ns, perf_counter ns) replaced as a whole, so `now_ns` needs no lock
+        self._model = ((start - _EPOCH) // timedelta(microseconds=1) * 1000, time.perf_counter_ns())
+
+    @property
+    def offset(self):
+        """Offset of broker time from UTC of the recording"""
+        return self._offset
+
+    def set_offset(self, delta):
+        """Ignored, broker time is the one of the recording"""
+        logging.debug(f'Replay keeps broker time of the recording, ignored offset {delta}')
+
+    def sample(self):
+        return False
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def error_bound(self):
+        return 0.0
+
+    def now_ns(self):
+        """Broker time in ns since 1970-1-1"""
+        base, t0 = self._model
+        return base + time.perf_counter_ns() - t0
+
+    def now(self):
+        """Broker time as `datetime`"""
+        return _EPOCH + timedelta(microseconds=self.now_ns() // 1000)
+
+    def wall_ns(self):
+        """UTC time of the recording in ns since 1970-1-1"""
+        return self.now_ns() - self._offset // timedelta(microseconds=1) * 1000
+
+    def advance(self, seconds):
+        """Jump forward by `seconds`"""
+        t = time.perf_counter_ns()
+        base, t0 = self._model
+        self._model = (base + t - t0 + int(seconds * 1e9), t)
+        self.jumps += 1
+
+    def wait(self, cond, timeout):
+        """Block on `cond` (already acquired) while busy, then jump to the end of `timeout`"""
+        if timeout is None:
+            return cond.wait()
+        end_ns = self.now_ns() + int(timeout * 1e9)
+        while self.busy():
+            remaining = (end_ns - self.now_ns()) / 1e9
+            if remaining <= 0:
+                return False
+            if cond.wait(min(remaining, self.poll_sec)):
+                return True
+        remaining = (end_ns - self.now_ns()) / 1e9
+        if remaining > 0:
+            self.advance(remaining)
+        return False
+
+
+class TerminalReplay:
+    """Module answering the calls of `MT5Api` from a log of `TerminalRecorder`
+
+    `module` stands in for `MetaTrader5` (constants of the recording and functions
+    for any call) and `clock` is a `ReplayClock` starting at the first call, so a
+    night recorded on a terminal runs again on a box without it, see `replay`.
+
+    Calls are matched on their function and arguments, except times and prices,
+    which differ in a replay, or on their function alone if these arguments were never
+    recorded. Calls with the same key are answered in the order recorded, skipping
+    those started before the time of `clock`. Each answer takes the recorded duration
+    times `latency`. Calls never recorded return None and are counted in `missed`.
+
+    Example:
+        replay = TerminalReplay('Records/1234_20211019_220000.ngrec').install()
+        run('Config.ini', 'Replay', nights=1, replay=replay)
+
+    Args:
+        path (str or Path): log of `TerminalRecorder`
+        latency (float, optional): factor of the recorded duration each call takes,
+            0 answers at once. Defaults to 1.
+    """
+
+    def __init__(self, path, latency=1.0):
+        self.path = Path(path)
+        self.latency = latency
+        self.header, self.calls = read_log(self.path)
+        self.missed = Counter()
+        self._lock = Lock()
+        # key -> [start times, calls, cursor], by arguments and by function alone
+        self._by_key = {}
+        self._by_name = {}
+        for call in self.calls:
+            call = call._replace(result=_decode(call.result))
+            for index, key in ((self._by_key, call_key(call.name, call.args, call.kwargs)), (self._by_name, call.name)):
+                entry = index.setdefault(key, [[], [], 0])
+                entry[0].append(call.wall_ns)
+                entry[1].append(call)
+
+        synced = [c for c in self.calls if c.broker_ns]
+        offset = timedelta(microseconds=(synced[0].broker_ns - synced[0].wall_ns) // 1000) if synced else timedelta(0)
+        start_ns = self.calls[0].wall_ns if self.calls else self.header['started_ns']
+        self.clock = ReplayClock(_EPOCH + timedelta(microseconds=start_ns // 1000) + offset, offset)
+
+        self.module = types.ModuleType(self.header.get('module', 'MetaTrader5'))
+        self.module.__dict__.update(self.header['constants'])
+        self.module.__getattr__ = self._function
+
+    @property
+    def duration(self):
+        """Seconds from the first to the last call recorded"""
+        if not self.calls:
+            return 0.0
+        return (self.calls[-1].wall_ns - self.calls[0].wall_ns) / 1e9
+
+    def install(self):
+        """Register `module` as `MetaTrader5` in `sys.modules`, returns self"""
+        sys.modules['MetaTrader5'] = self.module
+        return self
+
+    def _function(self, name):
+        if name.startswith('_') or not name.islower():
+            raise AttributeError(f'module {self.module.__name__!r} has no attribute {name!r}')
+
+        def call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        call.__name__ = name
+        setattr(self.module, name, call)
+        return call
+
+    def _next(self, name, args, kwargs):
+        entry = self._by_key.get(call_key(name, args, kwargs)) or self._by_name.get(name)
+        if entry is None:
+            return None
+        times, calls, cursor = entry
+        with self._lock:
+            cursor = max(cursor, bisect.bisect_right(times, self.clock.wall_ns()) - 1)
+            entry[2] = min(cursor + 1, len(calls) - 1)
+        return calls[cursor]
+
+    def call(self, name, *args, **kwargs):
+        """Answer the call of `name` from the log"""
+        call = self._next(name, args, kwargs)
+        if call is None:
+            self.missed[name] += 1
+            logging.debug(f'Replay: {name} never recorded, returns None')
+            return None
+        if self.latency:
+            time.sleep(call.duration_ns / 1e9 * self.latency)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class _Stats:
+    """Stats of a `cProfile.Profile` still running, for `pstats.Stats`"""
+
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+class ThreadProfiler:
+    """`cProfile` of the calling thread and of every thread started while enabled
+
+    `cProfile.Profile` only sees the thread enabling it, while a night runs on the
+    scheduler, dispatcher and terminal threads. Each thread started after `enable`
+    gets its own profile, merged by `stats`.
+
+    Example:
+        profiler = ThreadProfiler()
+        profiler.enable()
+        run(...)
+        profiler.disable()
+        profiler.stats().sort_stats('cumulative').print_stats(30)
+    """
+
+    def __init__(self):
+        self._profiles = []
+        self._lock = Lock()
+
+    def _profile_thread(self, frame, event, arg):
+        # First event of a new thread, profiling replaces this hook from here on
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def enable(self):
+        threading.setprofile(self._profile_thread)
+        self._profile_thread(None, None, None)
+
+    def disable(self):
+        threading.setprofile(None)
+        self._profiles[0].disable()
+
+    def stats(self):
+        """`pstats.Stats` of all threads"""
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(_Stats(profiles[0]))
+        for profile in profiles[1:]:
+            stats.add(_Stats(profile))
+        return stats
+
+
+def replay(log_path, config_path, report_fn_prefix='Replay', nights=1, latency=1.0, profile_path=None):
+    """Run nights of `runner.run` on a log of `TerminalRecorder`, skipping idle time
+
+    The night starts at the broker time of the first call recorded. Rules are read from
+    the current symbol_stopT.csv, reports and the journal are written with
+    `report_fn_prefix`, and the history cache is not used. With `profile_path`, all
+    threads are profiled and the stats written to it, see `pstats`.
+
+    Returns:
+        tuple: (seconds of the replay, `pstats.Stats` or None)
+    """
+    terminal_replay = TerminalReplay(log_path, latency=latency).install()
+    logging.info(f'Replaying {len(terminal_replay.calls)} calls over {terminal_replay.duration / 3600:.1f} hours '
+                 f'from {terminal_replay.clock.now()}')
+    from .runner import run
+
+    profiler = ThreadProfiler() if profile_path else None
+    t0 = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        run(config_path, report_fn_prefix, nights=nights, replay=terminal_replay)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    elapsed = time.perf_counter() - t0
+    logging.info(f'Replayed in {elapsed:.2f}s, ended at {terminal_replay.clock.now()}')
+    if terminal_replay.missed:
+        logging.warning(f'Calls never recorded, answered None: {dict(terminal_replay.missed)}')
+    stats = None
+    if profiler is not None:
+        stats = profiler.stats()
+        stats.dump_stats(profile_path)
+        logging.info(f'Profile written to {profile_path}')
+    return elapsed, stats
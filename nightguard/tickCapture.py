@@ -0,0 +1,221 @@
+from datetime import timedelta
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter, sleep
+
+import numpy as np
+
+from . import logging
+from .ringBuffer import RingBuffer
+
+
+TICK_DTYPE = np.dtype([('time_msc', '<i8'), ('bid', '<f8'), ('ask', '<f8')])
+
+
+class TickCapture:
+    """Polls ticks of watched symbols at a steady rate into per symbol ring buffers
+
+    Each pass reads the tick of every symbol with a watch window covering the current
+    broker time, so only symbols closing soon are polled. A symbol has one window per
+    key, e.g. per rule closing it, and is polled within any of them. Passes are scheduled on
+    absolute deadlines, a pass running longer than `interval` counts as an overrun
+    and the next deadlines are skipped instead of bursting.
+
+    Example:
+        capture = TickCapture(mt5.symbol_info_tick, clock, interval=0.1)
+        capture.watch('EURUSD', stop_dt - timedelta(seconds=90), stop_dt + timedelta(seconds=30))
+        capture.start()
+        ticks = capture.ticks('EURUSD')  # view with fields time_msc, bid, ask
+
+    Args:
+        symbol_info_tick (callable): `MetaTrader5.symbol_info_tick`
+        clock (BrokerClock): broker time source
+        interval (float, optional): seconds between passes. Defaults to 0.1.
+        capacity (int, optional): ticks kept per symbol. Defaults to 8192.
+    """
+
+    INTERVAL = 0.1
+    CAPACITY = 8192
+
+    def __init__(self, symbol_info_tick, clock, interval=INTERVAL, capacity=CAPACITY):
+        self._symbol_info_tick = symbol_info_tick
+        self.clock = clock
+        self.interval = interval
+        self.capacity = capacity
+        self._buffers = {}
+        self._watches = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+        self.passes = 0
+        self.overruns = 0
+        self.max_pass_sec = 0.0
+
+    def watch(self, symbol, start_dt, end_dt, key=None):
+        """Poll `symbol` while broker time is within [start_dt, end_dt], replacing the window of `key`"""
+        with self._lock:
+            self._watches.setdefault(symbol, {})[key] = (start_dt, end_dt)
+            if symbol not in self._buffers:
+                self._buffers[symbol] = RingBuffer(self.capacity, TICK_DTYPE)
+
+    def unwatch(self, symbol, key=None):
+        """Remove the window of `key` on `symbol`, windows of other keys are kept"""
+        with self._lock:
+            windows = self._watches.get(symbol, {})
+            windows.pop(key, None)
+            if not windows:
+                self._watches.pop(symbol, None)
+
+    def active_symbols(self, now=None):
+        now = self.clock.now() if now is None else now
+        with self._lock:
+            return [sym for sym, windows in self._watches.items()
+                    if any(start <= now <= end for start, end in windows.values())]
+
+    def ticks(self, symbol, n=None):
+        """View of the last `n` captured ticks of `symbol` (all if None), oldest first"""
+        buf = self._buffers.get(symbol)
+        if buf is None:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        return buf.last(n)
+
+    def last_tick(self, symbol):
+        """Newest captured tick of `symbol` as a record with attributes time_msc, bid, ask, None if none"""
+        ticks = self.ticks(symbol, 1)
+        # A recarray row reads `tick.bid` like a tick of mt5, e.g. in `MT5Api.get_price_to_close`
+        return ticks.view(np.recarray)[0] if len(ticks) else None
+
+    def poll(self, symbols=None):
+        """Run one pass over `symbols` (active symbols if None), returns number of new ticks"""
+        symbols = self.active_symbols() if symbols is None else symbols
+        n_new = 0
+        for sym in symbols:
+            tick = self._symbol_info_tick(sym)
+            if tick is None:
+                continue
+            buf = self._buffers[sym]
+            if len(buf) and buf.last(1)[0]['time_msc'] >= tick.time_msc:
+                continue
+            buf.append((tick.time_msc, tick.bid, tick.ask))
+            n_new += 1
+        return n_new
+
+    def start(self):
+        """Start polling in a background thread, returns self"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='TickCapture', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        next_pass = monotonic()
+        while not self._stop.wait(max(next_pass - monotonic(), 0)):
+            t0 = perf_counter()
+            try:
+                self.poll()
+            except Exception as e:
+                logging.warning(f'Tick capture pass failed: {e}')
+            pass_sec = perf_counter() - t0
+            self.passes += 1
+            self.max_pass_sec = max(self.max_pass_sec, pass_sec)
+            next_pass += self.interval
+            now = monotonic()
+            if now > next_pass:
+                missed = int((now - next_pass) / self.interval) + 1
+                self.overruns += missed
+                next_pass += missed * self.interval
+
+
+class CloseWindow:
+    """Decides when to close within StopT ± N seconds, from captured ticks
+
+    The baseline spread is the median spread of ticks captured in the `baseline_sec`
+    before the window opens. Within the window the close fires once the current
+    spread is at most `max_spread_ratio` times the baseline, and the mid price moved
+    less than `max_jump_ratio` baseline spreads over the last `jump_sec` seconds.
+    At the end of the window it fires regardless.
+
+    Args:
+        capture (TickCapture): capture of the symbols
+        window_sec (float): N, the window is StopT ± N seconds
+        baseline_sec (float, optional): seconds before the window for the baseline. Defaults to 60.
+        max_spread_ratio (float, optional): max spread relative to baseline. Defaults to 1.5.
+        max_jump_ratio (float, optional): max mid range in baseline spreads. Defaults to 3.
+        jump_sec (float, optional): seconds of the mid range. Defaults to 2.
+    """
+
+    BASELINE_SEC = 60
+    MAX_SPREAD_RATIO = 1.5
+    MAX_JUMP_RATIO = 3.0
+    JUMP_SEC = 2.0
+
+    def __init__(self, capture, window_sec, baseline_sec=BASELINE_SEC, max_spread_ratio=MAX_SPREAD_RATIO,
+                 max_jump_ratio=MAX_JUMP_RATIO, jump_sec=JUMP_SEC):
+        self.capture = capture
+        self.window_sec = window_sec
+        self.baseline_sec = baseline_sec
+        self.max_spread_ratio = max_spread_ratio
+        self.max_jump_ratio = max_jump_ratio
+        self.jump_sec = jump_sec
+
+    def watch(self, symbol, stop_dt, key=None):
+        """Capture ticks of `symbol` for the baseline and the window around `stop_dt` of `key`"""
+        self.capture.watch(
+            symbol,
+            stop_dt - timedelta(seconds=self.window_sec + self.baseline_sec),
+            stop_dt + timedelta(seconds=self.window_sec),
+            key,
+        )
+
+    def unwatch(self, symbol, key=None):
+        """Stop capturing ticks of `symbol` for `key`, windows of other keys are kept"""
+        self.capture.unwatch(symbol, key)
+
+    def ready(self, symbol, window_open_msc):
+        """Return (bool, reason) whether conditions to close `symbol` are met now
+
+        Args:
+            symbol (str): symbol to close
+            window_open_msc (int): broker time in ms the window opened
+        """
+        ticks = self.capture.ticks(symbol)
+        if len(ticks) == 0:
+            return False, 'no ticks'
+        time_msc = ticks['time_msc']
+        spread = ticks['ask'] - ticks['bid']
+        base = spread[(time_msc < window_open_msc) & (time_msc >= window_open_msc - self.baseline_sec * 1000)]
+        if len(base) == 0:
+            return False, 'no baseline'
+        base_spread = float(np.median(base))
+        cur_spread = float(spread[-1])
+        if cur_spread > self.max_spread_ratio * base_spread:
+            return False, f'spread {cur_spread:.6g} > {self.max_spread_ratio} x baseline {base_spread:.6g}'
+        recent = time_msc >= time_msc[-1] - self.jump_sec * 1000
+        mid = (ticks['bid'][recent] + ticks['ask'][recent]) / 2
+        jump = float(mid.max() - mid.min())
+        if jump > self.max_jump_ratio * base_spread:
+            return False, f'mid moved {jump:.6g} > {self.max_jump_ratio} x baseline spread'
+        return True, f'spread {cur_spread:.6g}, baseline {base_spread:.6g}'
+
+    def wait(self, symbol, deadline):
+        """Block till conditions to close `symbol` are met or broker time reaches `deadline`
+
+        Returns:
+            str: reason of firing
+        """
+        clock = self.capture.clock
+        window_open_msc = clock.now_ns() // 1_000_000
+        while True:
+            ok, reason = self.ready(symbol, window_open_msc)
+            if ok:
+                return reason
+            if clock.now() >= deadline:
+                return f'deadline reached, {reason}'
+            sleep(self.capture.interval)
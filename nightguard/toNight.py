@@ -1,11 +1,16 @@
 from logging import log
+import calendar
 import pandas as pd
 
-from time import sleep
 from datetime import datetime, time, timedelta
 
 from . import logging, PAK_DIR
 from .mt5Api import MT5Api
+from .reportStore import ReportStore, append_csv, merge_records
+from .tickCapture import CloseWindow
+from .stopRules import MAGIC_ALL, StopRule, RuleIndex, load_rules, diff_rules, rule_key, is_pattern, format_magics
+from .telemetry import TIME_TO_FLAT
+from .journal import Journal
 
 from configobj import ConfigObj
 from pathlib import Path
@@ -18,11 +23,12 @@ class Tonight:
 
     # Task name identifiers
     CLOSE_POSITION = 'CLOSE_POSITION'
+    RELOAD_RULES = 'RELOAD_RULES'
     END = 'END'
 
     name = 'ST'
 
-    MAGIC_ALL = -3418239482
+    MAGIC_ALL = MAGIC_ALL
 
     def __init__(self, mt5api, config_path=PAK_DIR/'Config.ini'):
         self.mt5 = mt5api
@@ -36,27 +42,90 @@ class Tonight:
         else:
             night_date = cur_time.date() + timedelta(days=1)
 
-        if night_date.weekday() == 5:
-            logging.info(f'Weekend ahead, positions will be managed on monday.')
-            self.tonight_date = night_date + timedelta(days=2)
-        else:
-            self.tonight_date = night_date
+        # Nights after the market closed, of weekends and holidays, are skipped
+        self.tonight_date = night_date
+        while self.tonight_date.weekday() >= 5 or self.mt5.calendar.is_holiday(self.tonight_date):
+            self.tonight_date += timedelta(days=1)
+        if self.tonight_date != night_date:
+            logging.info(f'Market closed on {night_date}, positions will be managed on {self.tonight_date}.')
 
         ## `tonight_end_dt` is the end of night also is the start of next night
         #end_time = time(nightConf.as_int('NS_START_HOUR'), nightConf.as_int('NS_START_MINUTE'))
         self.tonight_end_dt = datetime.combine(self.tonight_date+timedelta(days=1), time(0,0,1))
         self.tonight_start_dt = datetime.combine(self.tonight_date-timedelta(days=1), time(23,0))
+        # Same as MT5 position time, seconds since 1970-1-1 of broker time
+        self.tonight_start_ts = calendar.timegm(self.tonight_start_dt.timetuple())
         
-        raw_stop_df = pd.read_csv(symstop_fn.as_posix(), index_col=0)
-        raw_stop_df.Magics.fillna(self.MAGIC_ALL, inplace=True)
-        raw_stop_df['Magics'] = raw_stop_df['Magics'].apply(
-            lambda ms: [int(float(m)) for m in str(ms).split(';')]
-        ) 
-        self.raw_stop_df = raw_stop_df
+        # {key: StopRule} of symbol_stopT.csv, compiled to find the rule of a position,
+        # and handles of the tasks armed for them
+        self.rules_path = symstop_fn
+        self._rule_cache = {}
+        self.rules = load_rules(self.rules_path, self._rule_cache)
+        self._armed = {}
+        self._pq_in = None
+
+        # Seconds between checks of symbol_stopT.csv for changes, 0 reads it only once a night
+        self.rules_reload_sec = nightConf.as_float('RULES_RELOAD_SEC') if 'RULES_RELOAD_SEC' in nightConf else 1.0
+
+        # Max number of close orders in flight, 1 sends them one by one
+        self.close_workers = nightConf.as_int('CLOSE_WORKERS') if 'CLOSE_WORKERS' in nightConf else 8
+
+        # Max number of symbols closed at the same time, 1 runs close tasks one by one
+        self.symbol_workers = nightConf.as_int('SYMBOL_WORKERS') if 'SYMBOL_WORKERS' in nightConf else 8
+
+        # Seconds a close task keeps resending orders of positions not yet flat
+        self.close_deadline_sec = (nightConf.as_float('CLOSE_DEADLINE_SEC') if 'CLOSE_DEADLINE_SEC' in nightConf
+                                   else MT5Api.CLOSE_DEADLINE_SEC)
+
+        # Close within StopT ± CLOSE_WINDOW_SEC once spread and price settle, 0 closes at StopT
+        window_sec = nightConf.as_float('CLOSE_WINDOW_SEC') if 'CLOSE_WINDOW_SEC' in nightConf else 0
+        self.close_window = None
+        if window_sec > 0:
+            self.close_window = CloseWindow(
+                self.mt5.tick_capture, window_sec,
+                max_spread_ratio=nightConf.as_float('MAX_SPREAD_RATIO') if 'MAX_SPREAD_RATIO' in nightConf else CloseWindow.MAX_SPREAD_RATIO,
+                max_jump_ratio=nightConf.as_float('MAX_JUMP_RATIO') if 'MAX_JUMP_RATIO' in nightConf else CloseWindow.MAX_JUMP_RATIO,
+            )
+
+        # fsync the journal at most every JOURNAL_SYNC_SEC seconds, 0 fsyncs every event
+        self.journal_sync_sec = nightConf.as_float('JOURNAL_SYNC_SEC') if 'JOURNAL_SYNC_SEC' in nightConf else Journal.SYNC_SEC
+        self.journal = None
+        # StopT of finished close tasks, and rules interrupted while closing, by rule key, see `recover`
+        self._done = {}
+        self._interrupted = set()
 
         self._mangaged_pids = []
         self._record = {}
 
+    def recover(self, journal):
+        """Log tonight's events to `journal`, first restoring those logged before a restart
+
+        Managed positions and recorded fields are restored, close tasks already done
+        are not armed again by `arrange_tonight_tasks`, and those interrupted while
+        closing are armed to fire at once.
+
+        Args:
+            journal (Journal): journal of the report, see `journal_path`
+
+        Returns:
+            NightState: state of tonight found in the journal
+        """
+        state = journal.replay(self.tonight_date)
+        self.journal = journal
+        if state.events:
+            self._mangaged_pids = state.managed_pids
+            self._record = state.records
+            self._done = state.done
+            self._interrupted = state.in_flight
+            logging.info(f'Recovered tonight from {journal.path.name}: {state.events} events, '
+                         f'{len(state.managed_pids)} managed positions, done {sorted(state.done)}, '
+                         f'interrupted {sorted(state.in_flight)}')
+        return state
+
+    def _log(self, event, **fields):
+        if self.journal is not None:
+            self.journal.append(self.tonight_date, event, **fields)
+
     def arrange_tonight_tasks(self, pq_in):
         """Returns a list of task tuple that instruct a timmer queue to process
 
@@ -67,92 +136,278 @@ class Tonight:
         Example: 
             (close_time, {task: close, symbol: EURUSD, magics: [2,3]}
 
+        Tasks are kept by rule key, so `reload_rules` can cancel or move them later.
+
         Args:
-            pq_in (PiorityQueue): Queue to put into
+            pq_in (TaskScheduler): scheduler to put into
         
         Returns:
-            list: list of task tuple instruct the closing 
+            dict: `ScheduledTask` handles by rule key, see `StopRule.key`
         """
-        stop_df = self.raw_stop_df.copy()
+        self._pq_in = pq_in
+        rules = sorted(self.rules.values(), key=lambda r: r.stop_time)
+        logging.info(f'**** Tonight arrangement ****\n{self._arrangement(rules)}')
+        for rule in rules:
+            if self._done.get(rule.key) == rule.stop_time.isoformat():
+                logging.info(f'{rule.key}: closed before restart, not armed again')
+            elif rule.key in self._interrupted:
+                logging.info(f'{rule.key}: interrupted while closing, armed to close now')
+                self._arm(rule, due=self.mt5.broker_time_local)
+            else:
+                self._arm(rule)
+        if self.close_window is not None:
+            self.close_window.capture.start()
+        return dict(self._armed)
+
+    @property
+    def rules(self):
+        """{key: StopRule} of symbol_stopT.csv"""
+        return self._ruleset[0]
 
-        stop_df['StopT'] = pd.to_datetime(str(self.tonight_date) + ' ' + stop_df['StopT'])
-        stop_df = stop_df[stop_df.Magics.apply(lambda ms:len(ms)) >= 1]
-        stop_df = stop_df.sort_values('StopT')
+    @rules.setter
+    def rules(self, rules):
+        self._ruleset = (rules, self._compile(rules))
 
-        stop_df_print = stop_df.copy()
-        stop_df_print['Magics to Stop'] = stop_df_print.Magics.apply(
-            lambda m: 'ALL' if m==[self.MAGIC_ALL] else str(m)) 
-        stop_df_print = stop_df_print[['StopT', 'Magics to Stop']]
-        print(f'**** Tonight arrangement ****')
-        print(f"{stop_df_print}")
-        #print(f"{stop_df.to_markdown()}")
+    @property
+    def rule_index(self):
+        """`RuleIndex` of `rules`"""
+        return self._ruleset[1]
 
-        sym_time_stopT = pd.read_csv(symstop_fn.as_posix(), index_col=0)
-        sym_time_stopT['StopT'] = sym_time_stopT.StopT.apply(lambda t: pd.to_datetime(t).time())
+    def reload_rules(self):
+        """Read symbol_stopT.csv again and update the armed tasks of changed rows only
+
+        Tasks of removed rows are cancelled, rows with a new StopT have their task moved,
+        and new rows, or rows with new magics, get a new task. Already fired rows which
+        changed are armed again. Positions managed so far are kept.
+        Requires `arrange_tonight_tasks` to have been called with a `TaskScheduler`.
+
+        Only the symbols of changed rows are compiled again in a new `RuleIndex`, see
+        `RuleIndex.updated`, published with the rules in one assignment, as close tasks
+        read both from dispatcher threads.
+
+        Returns:
+            tuple: (added, removed, changed) rule keys
+        """
+        try:
+            rules = load_rules(self.rules_path, self._rule_cache)
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning(f'Keep current rules, failed to read {self.rules_path.name}: {e}')
+            return [], [], []
+        added, removed, changed = diff_rules(self.rules, rules)
+        symbols = ({self.rules[key].symbol for key in removed + changed}
+                   | {rules[key].symbol for key in added + changed})
+        index = self._compile(rules, symbols) if symbols else self.rule_index
+        for key in removed:
+            self._disarm(key)
+        for key in changed:
+            handle = self._armed.get(key)
+            if handle is not None and handle.pending:
+                self._move(handle, rules[key])
+            else:
+                self._disarm(key)
+                self._arm(rules[key])
+        for key in added:
+            self._arm(rules[key])
+        self._ruleset = (rules, index)
+        if added or removed or changed:
+            logging.info(f'Rules reloaded, added {added}, removed {removed}, changed {changed}\n'
+                         f'{self._arrangement([rules[key] for key in added + changed])}')
+        return added, removed, changed
 
-        for i, (sym, row) in enumerate(stop_df.iterrows()):
+    def _compile(self, rules, symbols=None):
+        """`RuleIndex` of `rules`, updating the current one if only rules of `symbols` changed"""
+        index = RuleIndex(rules.values()) if symbols is None else self.rule_index.updated(rules.values(), symbols)
+        for conflict in index.conflicts:
+            logging.warning(f'Conflicting rules in {self.rules_path.name}, {conflict}')
+        return index
 
-            pq_in.put((
-            row.StopT + timedelta(microseconds=i), {'task': self.CLOSE_POSITION, 'symbol': sym, 'magics': row.Magics}
-            ))
+    def _stop_dt(self, rule):
+        return datetime.combine(self.tonight_date, rule.stop_time)
 
-    def close_position(self, symbol, magics):
+    def _due(self, rule):
+        """Returns (time the task fires, deadline of the close window or None) of `rule`"""
+        stop_dt = self._stop_dt(rule)
+        # Ticks are captured by symbol, patterns close at StopT
+        if self.close_window is None or is_pattern(rule.symbol):
+            return stop_dt, None
+        # Open the window N seconds before StopT, close at the latest N seconds after
+        window = timedelta(seconds=self.close_window.window_sec)
+        return stop_dt - window, stop_dt + window
+
+    def _arm(self, rule, due=None):
+        task = {'task': self.CLOSE_POSITION, 'symbol': rule.symbol, 'magics': list(rule.magics)}
+        rule_due, deadline = self._due(rule)
+        due = rule_due if due is None else due
+        if deadline is not None:
+            task['deadline'] = deadline
+            self.close_window.watch(rule.symbol, self._stop_dt(rule), rule.key)
+        self._armed[rule.key] = self._pq_in.put((due, task))
+        self._log('arm', rule=rule.key, due=due)
+
+    def _move(self, handle, rule):
+        due, deadline = self._due(rule)
+        if deadline is not None:
+            handle.task['deadline'] = deadline
+            self.close_window.watch(rule.symbol, self._stop_dt(rule), rule.key)
+        self._pq_in.reschedule(handle, due)
+        self._log('arm', rule=rule.key, due=due)
+
+    def _disarm(self, key):
+        handle = self._armed.pop(key, None)
+        if handle is not None:
+            self._pq_in.cancel(handle)
+        # Windows of other rules of the symbol are kept
+        if self.close_window is not None and key in self.rules:
+            self.close_window.unwatch(self.rules[key].symbol, key)
+
+    def _arrangement(self, rules):
+        stop_df = pd.DataFrame({
+            'StopT': [self._stop_dt(r) for r in rules],
+            'Magics to Stop': [format_magics(r.magics) for r in rules],
+        }, index=pd.Index([r.symbol for r in rules], name='Symbol'))
+        return stop_df
+
+    def close_position(self, symbol, magics, deadline=None):
         '''
         Monitor/Proces open position until it gets closed.
         After it closed, update thhe report
 
+        `symbol` and `magics` are of a rule, see `StopRule`: the positions closed are
+        those this rule governs, see `RuleIndex`. They are closed together with `MT5Api.close_positions`,
+        at most `close_workers` orders in flight. Requotes and partial fills are
+        resent till flat or `close_deadline_sec`, positions left open are alerted
+        as critical and marked in the report by `ST-close_status`.
+
+        With a close window and a `deadline`, it first waits till spread and price
+        meet the thresholds of `close_window`, or the deadline.
+
+        Firing, managed positions, records and the end of the task are logged to
+        the journal, if any, see `recover`.
         '''
-        cur_positions = self.mt5.cur_positions
-        logging.debug(f'Trying to match cur_pos {cur_positions}')
-        for pos in cur_positions:
-            magic_match = (pos.magic in magics) or (magics[0] == self.MAGIC_ALL)
-            time_con = pd.to_datetime(pos.time, unit='s') >= self.tonight_start_dt
-            logging.debug(f'Position: {pos.symbol}, magic {pos.magic}')
-            logging.debug(f'Magic match: {magic_match}, time con : {time_con}')
-            if pos.symbol == symbol and magic_match and time_con:
-                self._mangaged_pids += [pos.identifier]
-                pos_str = f'Position {pos.symbol}  Magic {pos.magic} Current profit {pos.profit}'
-                if self.mt5.TEST_MODE:
-                    logging.info(f'TEST MODE Recording current profit as if we close it. {pos_str}')
-                    volume = pos.volume if pos.type == 0 else -pos.volume
-                    self._record[pos.identifier] = {
-                        '-'.join([self.name, 'profit']): pos.profit,
-                        '-'.join([self.name, 'Ex_Time']): self.mt5.broker_time,
-                        '-'.join([self.name, 'Ex_Price']): self.mt5.get_price_to_close(pos),
-                    }
+        key = rule_key(symbol, magics)
+        # Rules and their index of one reload, see `reload_rules`
+        rules, index = self._ruleset
+        rule = rules.get(key)
+        # e.g. a rule removed after it fired, it only competes with itself
+        if rule is None:
+            rule = StopRule(symbol, None, tuple(magics))
+            index = RuleIndex([rule])
+        self._log('fire', rule=key)
+        tick = None
+        if deadline is not None and self.close_window is not None:
+            reason = self.close_window.wait(symbol, deadline)
+            logging.info(f'{symbol}: close window fired, {reason}')
+            tick = self.close_window.capture.last_tick(symbol)
+
+        store = self.mt5.position_store
+        if is_pattern(symbol):
+            store.refresh()
+            candidates = [pos for sym in store.symbols() for pos in store.match(sym, since=self.tonight_start_ts)]
+        else:
+            store.refresh(symbol)
+            match_magics = None if any(m == self.MAGIC_ALL or isinstance(m, tuple) for m in rule.magics) else rule.magics
+            candidates = store.match(symbol, match_magics, since=self.tonight_start_ts)
+        to_close = []
+        matched = [pos for pos in candidates if index.governs(rule, pos)]
+        for pos in matched:
+            logging.debug(f'Matched position: {pos.symbol}, magic {pos.magic}, ticket {pos.identifier}')
+            self._mangaged_pids += [pos.identifier]
+            pos_str = f'Position {pos.symbol}  Magic {pos.magic} Current profit {pos.profit}'
+            if self.mt5.TEST_MODE:
+                logging.info(f'TEST MODE Recording current profit as if we close it. {pos_str}')
+                self._record[pos.identifier] = {
+                    '-'.join([self.name, 'profit']): pos.profit,
+                    '-'.join([self.name, 'Ex_Time']): self.mt5.broker_time_local,
+                    '-'.join([self.name, 'Ex_Price']): self.mt5.get_price_to_close(pos, tick),
+                }
+            else:
+                logging.info(f'Closing position: {pos_str}')
+                to_close.append(pos)
+        self._log('managed', pids=[pos.identifier for pos in matched])
+        if self.mt5.TEST_MODE:
+            for pos in matched:
+                self._log('record', pid=pos.identifier, fields=self._record[pos.identifier])
+
+        if to_close:
+            results, time_to_flat = self.mt5.close_positions(
+                to_close, comment=self.name, max_workers=self.close_workers, deadline_sec=self.close_deadline_sec)
+            for res in results:
+                if res.ok:
+                    logging.info(f'  Position {res.position_id} Closed! {res.attempts} attempts, '
+                                 f'time to flat {res.time_to_flat*1000:.1f}ms, last latency {res.latency*1000:.1f}ms')
                 else:
-                    logging.info(f'Closing position: {pos_str}')
-                    self.mt5.close_position(pos, comment=self.name)
-                    logging.info('Closed!')
+                    logging.critical(f'  Position {res.position_id} of {symbol} NOT CLOSED, {res.status} after '
+                                     f'{res.attempts} attempts, retcode {res.retcode}, {res.remaining} lots open!')
+                self._record[res.position_id] = {
+                    '-'.join([self.name, 'close_status']): res.status,
+                    '-'.join([self.name, 'close_attempts']): res.attempts,
+                }
+                self._log('record', pid=res.position_id, fields=self._record[res.position_id])
+            store.discard([res.position_id for res in results if res.ok])
+            TIME_TO_FLAT.labels(symbol).observe(time_to_flat)
+            n_ok = sum(res.ok for res in results)
+            logging.info(f'{symbol}: {n_ok}/{len(results)} positions closed, time to flat {time_to_flat*1000:.1f}ms, '
+                         f'broker clock error bound {self.mt5.clock.error_bound()*1000:.1f}ms')
+        self._log('done', rule=key, stop_time=rule.stop_time.isoformat() if rule.stop_time is not None else None)
 
     def close(self, report_fn_prefix=None):
         """
-        Save reports of positions started from previous `night_end_dt` till `tonigh_end_dt`
+        Save reports of managed positions started from `tonight_start_dt` till `tonigh_end_dt`
         If TEST_MODE is on, also saves columns as if we close the positions.
+
+        Positions are appended to `PositionReport.sqlite` (see `ReportStore`) and
+        to `PositionReport.csv`, both without reading the rows of previous nights.
+        The rollups of tonight are updated and logged by symbol.
+
+        Returns:
+            dataframe: tonight's positions as written to the report
         """
-        start_dt = self.tonight_end_dt - timedelta(days=1)
-        pos_hist = self.mt5.get_history_positions(start_dt, self.tonight_end_dt)
-        pos_hist.to_csv('hist_pos.csv',index=True)
+        # Managed positions are entered from 23:00 of the day before
+        pos_hist = self.mt5.get_history_positions(self.tonight_start_dt, self.tonight_end_dt)
         # Filtout_magics
         logging.debug(f'Managed pids: {self._mangaged_pids}, pos_hist_pids: {pos_hist.index}')
         pos_hist = pos_hist[pos_hist.index.isin(self._mangaged_pids)]
-        for pid, info in self._record.items():
-            for k,v in info.items():
-                pos_hist.loc[pid, k] = v
-        
-        logging.info('**** Tonight finished positions ****')
-        print(pos_hist)
+        pos_hist = merge_records(pos_hist, self._record)
+
+        logging.info(f'**** Tonight finished positions ****\n{pos_hist}')
+
+        report_fn = self.report_path(report_fn_prefix)
+        store = self.report_store(report_fn_prefix)
+        store.append(self.tonight_date, pos_hist)
+        if not append_csv(report_fn, pos_hist):
+            logging.info(f'New report columns, re-export {report_fn.name}')
+            store.export_csv(report_fn)
+        if len(pos_hist):
+            logging.info(f'**** Tonight by symbol ****\n'
+                         f'{store.rollup(self.tonight_date, self.tonight_date, by=["symbol"])}')
+        store.close()
+        if self.journal is not None:
+            self._log('end')
+            self.journal.truncate()
+        return pos_hist
 
+    @staticmethod
+    def report_path(report_fn_prefix=None, suffix='.csv'):
+        """Return path of the position report, `prefix_PositionReport.csv` if prefix given"""
         if report_fn_prefix is None:
-            report_fn = PAK_DIR / 'PositionReport.csv'
-        else:
-            report_fn = PAK_DIR / (report_fn_prefix + '_' + 'PositionReport.csv')
+            return PAK_DIR / ('PositionReport' + suffix)
+        return PAK_DIR / (report_fn_prefix + '_' + 'PositionReport' + suffix)
 
-        if report_fn.exists():
-            report_df = pd.read_csv(report_fn.as_posix(), index_col=0)
-        else:
-            report_df = pd.DataFrame()
-        
-        report_df = report_df.append(pos_hist)
-        report_df.to_csv(report_fn.as_posix(), index=True)
-        
\ No newline at end of file
+    @staticmethod
+    def journal_path(report_fn_prefix=None):
+        """Return path of the journal of the report, `prefix_Journal.jsonl` if prefix given"""
+        if report_fn_prefix is None:
+            return PAK_DIR / 'Journal.jsonl'
+        return PAK_DIR / (report_fn_prefix + '_' + 'Journal.jsonl')
+
+    @classmethod
+    def report_store(cls, report_fn_prefix=None):
+        """Open the `ReportStore` of the report, importing an existing CSV report the first time"""
+        db_fn = cls.report_path(report_fn_prefix, suffix='.sqlite')
+        is_new = not db_fn.exists()
+        store = ReportStore(db_fn)
+        csv_fn = cls.report_path(report_fn_prefix)
+        if is_new and csv_fn.exists():
+            n = store.import_csv(csv_fn)
+            logging.info(f'Imported {n} positions from {csv_fn.name} into {db_fn.name}')
+        return store